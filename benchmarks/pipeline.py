@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synthetic_flir import generate_dataset
+
+STAGES = ['metadata_read', 'raw_decode', 'raw2temp', 'embedded_decode', 'crop_downscale', 'csv_export',
+          'thermal_data_modifier', 'canopy_empirical', 'vegetation_index']
+# analysis stages that can be left out, the extraction stages feed them
+OPTIONAL_STAGES = ['thermal_data_modifier', 'canopy_empirical', 'vegetation_index']
+
+DEFAULT_SIZES = [1, 100, 10000]
+
+
+class StageTimer:
+    """
+    Accumulates the wall time of named stages over many images
+    """
+
+    def __init__(self):
+        self.totals = OrderedDict((stage, 0.0) for stage in STAGES)
+
+    pass
+
+    def run(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.totals[stage] += time.perf_counter() - start
+        return result
+
+
+def run_pipeline(image_paths, extractor_kwargs, skip=()):
+    """
+    Run every stage on each image, from the dataset folder
+    :param image_paths: images relative to the current folder, ex. images/img_20200814_100000_00000.jpg
+    :param extractor_kwargs: FlirImageExtractor arguments
+    :param skip: optional stages left out
+    :return: dictionary stage -> total seconds
+    """
+    from flir_image_extractor import FlirImageExtractor
+    from thermal_values import write_thermal_values_csv
+    from thermal_data_modifier import ThermalDataModifier
+    from canopy_empirical import ThermalDataModifier as CanopyEmpirical
+    from leaf_recognition_baseline import LeafRecognitionBaseline
+
+    fie = FlirImageExtractor(**extractor_kwargs)
+    canopy = CanopyEmpirical()
+    canopy.at = 28.0
+    canopy.set_add_sub([5, 5])
+    lrb = LeafRecognitionBaseline()
+    timer = StageTimer()
+
+    for image_path in image_paths:
+        def read_metadata():
+            record = fie.parse_flir_record(image_path)
+            return record, fie.read_image_metadata(image_path, record)
+
+        record, metadata = timer.run('metadata_read', read_metadata)
+        raw_np = timer.run('raw_decode', fie.decode_raw_thermal_image, image_path, record, metadata, fie.fix_endian)
+        calibration_parameters = fie.get_calibration_parameters(metadata, fie.default_distance)
+        thermal_np = timer.run('raw2temp', fie.convert_raw_to_temperature, raw_np, calibration_parameters)
+        rgb_np = timer.run('embedded_decode', fie.decode_embedded_image, image_path, record, fie.use_thumbnail)
+
+        def crop_downscale():
+            geometry = fie.get_sensor_geometry(metadata, (rgb_np.shape[1], rgb_np.shape[0]),
+                                               (raw_np.shape[1], raw_np.shape[0]))
+            cropped_np = geometry.crop(rgb_np)
+            return cropped_np, geometry.downscale(cropped_np)
+
+        cropped_np, downscaled_np = timer.run('crop_downscale', crop_downscale)
+
+        directory = os.path.splitext(image_path)[0]
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        csv_path = os.path.join(directory, os.path.basename(directory) + fie.csv_suffix)
+        timer.run('csv_export', write_thermal_values_csv, csv_path, thermal_np, downscaled_np)
+
+        if 'thermal_data_modifier' not in skip:
+            timer.run('thermal_data_modifier', ThermalDataModifier(directory=directory).process_thermal_data)
+        if 'canopy_empirical' not in skip:
+            timer.run('canopy_empirical', canopy.process_thermal_data, directory)
+        if 'vegetation_index' not in skip:
+            lrb.rgb_image_np = cropped_np
+            timer.run('vegetation_index', lrb.calculate_vegetation_index)
+
+    fie.close()
+    for stage in skip:
+        timer.totals.pop(stage, None)
+    return timer.totals
+
+
+def benchmark(dataset_dir, sizes, extractor_kwargs, skip=(), unique=16):
+    """
+    Generate the dataset and time the stages for each number of images
+    :return: json serializable results
+    """
+    image_paths = generate_dataset(dataset_dir, max(sizes), unique=unique)
+
+    results = OrderedDict()
+    results['python'] = platform.python_version()
+    results['numpy'] = np.__version__
+    results['platform'] = platform.platform()
+    results['extractor'] = extractor_kwargs
+    results['runs'] = OrderedDict()
+
+    cwd = os.getcwd()
+    os.chdir(dataset_dir)
+    try:
+        for size in sizes:
+            # the extractor prints the metadata of every image, keep it out of the timings and the output
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                totals = run_pipeline(image_paths[:size], extractor_kwargs, skip=skip)
+                elapsed = time.perf_counter() - start
+
+            stages = OrderedDict()
+            for stage, total in totals.items():
+                stages[stage] = {'total_s': round(total, 6), 'per_image_ms': round(1000.0 * total / size, 4)}
+            results['runs'][str(size)] = {'images': size, 'total_s': round(elapsed, 6),
+                                          'images_per_s': round(size / elapsed, 3), 'stages': stages}
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2, noise_floor_ms=0.05):
+    """
+    :param tolerance: relative slowdown allowed per stage
+    :param noise_floor_ms: differences smaller than this are ignored
+    :return: list of messages, one per regression
+    """
+    regressions = []
+    for size, run in results['runs'].items():
+        baseline_run = baseline.get('runs', {}).get(size)
+        if baseline_run is None:
+            continue
+        for stage, timing in run['stages'].items():
+            baseline_timing = baseline_run['stages'].get(stage)
+            if baseline_timing is None:
+                continue
+            new, old = timing['per_image_ms'], baseline_timing['per_image_ms']
+            if new > old * (1 + tolerance) and new - old > noise_floor_ms:
+                regressions.append("{} images, {}: {:.3f} ms/image, baseline {:.3f} ms/image (+{:.0f}%)".format(
+                    size, stage, new, old, 100.0 * (new - old) / old))
+    return regressions
+
+
+def print_results(results):
+    for size, run in results['runs'].items():
+        print("{} images: {:.2f} s, {:.1f} images/s".format(size, run['total_s'], run['images_per_s']))
+        for stage, timing in run['stages'].items():
+            print("  {:<24} {:>10.3f} ms/image {:>10.3f} s".format(stage, timing['per_image_ms'], timing['total_s']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of the pipeline on synthetic FLIR images')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', help='Numbers of images, default 1 100 10000',
+                        required=False, default=DEFAULT_SIZES)
+    parser.add_argument('--skip', type=str, nargs='+', help='Analysis stages to leave out', required=False,
+                        default=[], choices=OPTIONAL_STAGES)
+    parser.add_argument('--unique', type=int, help='Distinct synthetic scenes', required=False, default=16)
+    parser.add_argument('--lut-cache-size', type=int, help='Passed to the extractor, 0 times raw2temp itself',
+                        required=False, default=8)
+    parser.add_argument('--workdir', type=str, help='Dataset folder, a temporary one is used and removed otherwise',
+                        required=False, default=None)
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this json file', required=False,
+                        default=None)
+    parser.add_argument('--baseline', type=str, help='Results of an earlier run to compare against',
+                        required=False, default=None)
+    parser.add_argument('--tolerance', type=float, help='Relative slowdown allowed per stage (default 0.2)',
+                        required=False, default=0.2)
+    args = parser.parse_args()
+
+    extractor_kwargs = {'lut_cache_size': args.lut_cache_size}
+    dataset_dir = args.workdir or tempfile.mkdtemp(prefix='flir_benchmark_')
+    try:
+        results = benchmark(dataset_dir, sorted(set(args.sizes)), extractor_kwargs, skip=args.skip,
+                            unique=args.unique)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            regressions = compare(results, json.load(fh), tolerance=args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        sys.exit(1 if regressions else 0)
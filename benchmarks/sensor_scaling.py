@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from benchmarks.pipeline import run_pipeline, OPTIONAL_STAGES
+from benchmarks.synthetic_flir import generate_dataset
+
+# thermal size, visual size, Real2IR (None: no PiP record, like the 80x60 cameras)
+DEFAULT_SENSORS = ['80x60:640x480', '320x240:1280x960:1.6', '640x512:1280x1024:1.25']
+
+# stages working on the visual image, their cost follows its size instead of the thermal one
+VISUAL_STAGES = ['embedded_decode', 'crop_downscale', 'vegetation_index']
+
+
+def parse_sensor(spec):
+    """
+    :param spec: WIDTHxHEIGHT:VISUAL_WIDTHxVISUAL_HEIGHT[:REAL2IR], ex. 320x240:1280x960:1.6
+    :return: (thermal size, visual size, real2ir or None)
+    """
+    parts = spec.split(':')
+    if len(parts) not in (2, 3):
+        raise ValueError("Invalid sensor: {}".format(spec))
+    thermal_size = tuple(int(value) for value in parts[0].lower().split('x'))
+    visual_size = tuple(int(value) for value in parts[1].lower().split('x'))
+    real2ir = float(parts[2]) if len(parts) == 3 else None
+    return thermal_size, visual_size, real2ir
+
+
+def benchmark(work_dir, sensors, count, extractor_kwargs, skip=(), unique=4):
+    """
+    Time the pipeline on a synthetic dataset of each sensor
+    :param sensors: list of sensor specs, see parse_sensor
+    :return: json serializable results
+    """
+    results = OrderedDict()
+    results['python'] = platform.python_version()
+    results['numpy'] = np.__version__
+    results['platform'] = platform.platform()
+    results['images'] = count
+    results['sensors'] = OrderedDict()
+
+    cwd = os.getcwd()
+    for spec in sensors:
+        thermal_size, visual_size, real2ir = parse_sensor(spec)
+        dataset_dir = os.path.join(work_dir, spec.replace(':', '_'))
+        image_paths = generate_dataset(dataset_dir, count, unique=unique, raw_size=thermal_size,
+                                       visual_size=visual_size, real2ir=real2ir)
+
+        os.chdir(dataset_dir)
+        try:
+            # the extractor prints the metadata of every image, keep it out of the timings and the output
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                totals = run_pipeline(image_paths, extractor_kwargs, skip=skip)
+                elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+        pixels = {'thermal': thermal_size[0] * thermal_size[1], 'visual': visual_size[0] * visual_size[1]}
+        stages = OrderedDict()
+        for stage, total in totals.items():
+            basis = 'visual' if stage in VISUAL_STAGES else 'thermal'
+            stages[stage] = OrderedDict([('per_image_ms', round(1000.0 * total / count, 4)), ('pixels', basis),
+                                         ('ns_per_pixel', round(1e9 * total / count / pixels[basis], 3))])
+        results['sensors'][spec] = OrderedDict([('thermal_size', thermal_size), ('visual_size', visual_size),
+                                                ('real2ir', real2ir), ('total_s', round(elapsed, 6)),
+                                                ('images_per_s', round(count / elapsed, 3)), ('stages', stages)])
+
+    add_scaling(results)
+    return results
+
+
+def add_scaling(results):
+    """
+    Per pixel cost of each stage relative to the first sensor: about 1 (or less, fixed costs
+    get spread over more pixels) when a stage scales linearly, clearly above 1 when it doesn't
+    :return:
+    """
+    sensors = list(results['sensors'].values())
+    reference = sensors[0]['stages']
+    for sensor in sensors:
+        for stage, timing in sensor['stages'].items():
+            reference_ns = reference[stage]['ns_per_pixel']
+            timing['scaling'] = round(timing['ns_per_pixel'] / reference_ns, 3) if reference_ns else None
+
+
+def check_scaling(results, max_scaling):
+    """
+    :return: list of messages, one per stage whose per pixel cost grew more than max_scaling times
+    """
+    problems = []
+    for spec, sensor in results['sensors'].items():
+        for stage, timing in sensor['stages'].items():
+            if timing['scaling'] is not None and timing['scaling'] > max_scaling:
+                problems.append("{}, {}: {:.1f} ns/pixel, {:.2f}x the per pixel cost of {}".format(
+                    spec, stage, timing['ns_per_pixel'], timing['scaling'], list(results['sensors'])[0]))
+    return problems
+
+
+def print_results(results):
+    for spec, sensor in results['sensors'].items():
+        print("{}: {:.2f} s, {:.1f} images/s".format(spec, sensor['total_s'], sensor['images_per_s']))
+        for stage, timing in sensor['stages'].items():
+            print("  {:<24} {:>10.3f} ms/image {:>10.2f} ns/{} pixel  x{}".format(
+                stage, timing['per_image_ms'], timing['ns_per_pixel'], timing['pixels'], timing['scaling']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of the pipeline for several thermal sensor sizes')
+    parser.add_argument('--sensors', type=str, nargs='+',
+                        help='WIDTHxHEIGHT:VISUAL_WIDTHxVISUAL_HEIGHT[:REAL2IR] of each sensor, the first one is the '
+                        'reference (default: ' + ' '.join(DEFAULT_SENSORS) + ')', required=False,
+                        default=DEFAULT_SENSORS)
+    parser.add_argument('-n', '--count', type=int, help='Images per sensor (default: 20)', required=False, default=20)
+    parser.add_argument('--unique', type=int, help='Distinct synthetic scenes per sensor', required=False, default=4)
+    parser.add_argument('--skip', type=str, nargs='+', help='Analysis stages to leave out', required=False,
+                        default=[], choices=OPTIONAL_STAGES)
+    parser.add_argument('--workdir', type=str, help='Dataset folder, a temporary one is used and removed otherwise',
+                        required=False, default=None)
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this json file', required=False,
+                        default=None)
+    parser.add_argument('--max-scaling', type=float, help='Fail when the per pixel cost of a stage grows more than '
+                        'this many times over the reference sensor', required=False, default=None)
+    args = parser.parse_args()
+
+    work_dir = args.workdir or tempfile.mkdtemp(prefix='flir_sensor_scaling_')
+    try:
+        results = benchmark(work_dir, args.sensors, args.count, {}, skip=args.skip, unique=args.unique)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=1)
+
+    if args.max_scaling:
+        problems = check_scaling(results, args.max_scaling)
+        for problem in problems:
+            print("NOT LINEAR: " + problem)
+        sys.exit(1 if problems else 0)
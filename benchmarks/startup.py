@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import os.path
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_budget.json')
+
+
+def measure_import(module, repeat=5):
+    """
+    Import a module in a fresh interpreter with "python -X importtime" and read its cost
+    :param module: module name, ex. flir_image_extractor
+    :param repeat: number of interpreters started, the median is kept
+    :return: dictionary with the median cumulative import time in ms and the top level packages it imported
+    """
+    timings = []
+    packages = set()
+    for _ in range(repeat):
+        output = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                                  cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[1]
+
+        # lines look like "import time:   self [us] | cumulative | imported package"
+        for line in output.decode('utf-8', 'replace').splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            fields = line[len('import time:'):].split('|')
+            name = fields[2].rstrip()
+            packages.add(name.strip().split('.')[0])
+            if name.strip() == module and not name.startswith('  '):
+                timings.append(int(fields[1]) / 1000.0)
+
+    if not timings:
+        raise RuntimeError("Unable to import {}".format(module))
+
+    timings.sort()
+    return {'import_ms': timings[len(timings) // 2], 'packages': sorted(packages)}
+
+
+def check_budget(results, budget):
+    """
+    :return: list of messages, one per module over its budget or importing a forbidden package
+    """
+    violations = []
+    for module, limits in sorted(budget.items()):
+        result = results[module]
+        if result['import_ms'] > limits['max_import_ms']:
+            violations.append("{} imports in {:.1f} ms, budget is {} ms".format(
+                module, result['import_ms'], limits['max_import_ms']))
+        for package in limits.get('forbidden', []):
+            if package in result['packages']:
+                violations.append("{} imports {} at startup".format(module, package))
+    return violations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the import time of the command line tools against a budget')
+    parser.add_argument('--budget', type=str, help='Budget file', required=False, default=BUDGET_FILE)
+    parser.add_argument('--repeat', type=int, help='Interpreters started per module, the median is kept',
+                        required=False, default=5)
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this json file', required=False,
+                        default=None)
+    args = parser.parse_args()
+
+    with open(args.budget, 'r') as fh:
+        budget = json.load(fh)
+
+    results = {}
+    for module in sorted(budget):
+        results[module] = measure_import(module, repeat=args.repeat)
+        print("{:<30} {:>8.1f} ms  (budget {} ms)".format(module, results[module]['import_ms'],
+                                                        budget[module]['max_import_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'python': sys.version.split()[0], 'results': results}, fh, indent=1, sort_keys=True)
+
+    violations = check_budget(results, budget)
+    for violation in violations:
+        print("OVER BUDGET: " + violation)
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import os.path
+import shutil
+import struct
+
+import numpy as np
+
+# AX8 like calibration, temperatures in C, relative humidity as a fraction like the camera stores it
+DEFAULT_CALIBRATION = {
+    'Emissivity': 0.95, 'ObjectDistance': 1.0, 'ReflectedApparentTemperature': 20.0,
+    'AtmosphericTemperature': 20.0, 'IRWindowTemperature': 20.0, 'IRWindowTransmission': 1.0,
+    'RelativeHumidity': 0.5, 'PlanckR1': 13366.938, 'PlanckB': 1366.0, 'PlanckF': 1.65, 'PlanckO': -6835,
+    'PlanckR2': 0.01355973,
+}
+
+RAW_SIZE = (80, 60)
+VISUAL_SIZE = (640, 480)
+
+FLIR_SEGMENT_SIZE = 65000
+
+
+def make_scene(seed, raw_size=RAW_SIZE):
+    """
+    A plant canopy in front of warmer soil
+    :return: (temperatures in C of raw_size, leaf mask of the same size)
+    """
+    rng = np.random.RandomState(seed)
+    width, height = raw_size
+    y, x = np.mgrid[0:height, 0:width] / np.array([height, width], dtype=np.float64).reshape(2, 1, 1)
+
+    soil = 30.0 + 6.0 * x + 2.0 * y + rng.uniform(-2, 2)
+    leaves = np.zeros((height, width), dtype=bool)
+    for _ in range(rng.randint(3, 7)):
+        cx, cy, r = rng.uniform(0.2, 0.8), rng.uniform(0.2, 0.8), rng.uniform(0.08, 0.2)
+        leaves |= ((x - cx) ** 2 + ((y - cy) * height / width) ** 2) < r ** 2
+
+    temperatures = np.where(leaves, 24.0 + 3.0 * y, soil) + rng.normal(0, 0.15, (height, width))
+    return temperatures, leaves
+
+
+def make_visual(leaves, seed, visual_size=VISUAL_SIZE):
+    """
+    Visible image matching the leaf mask: green leaves on brown soil
+    :return: (height, width, 3) uint8
+    """
+    import cv2 as cv
+
+    rng = np.random.RandomState(seed)
+    width, height = visual_size
+    leaves_np = cv.resize(leaves.astype(np.uint8), (width, height), interpolation=cv.INTER_NEAREST).astype(bool)
+
+    visual = np.empty((height, width, 3), dtype=np.float64)
+    visual[...] = (120, 90, 60)
+    visual[leaves_np] = (50, 140, 40)
+    visual += rng.normal(0, 4, visual.shape)
+    return np.clip(visual, 0, 255).astype(np.uint8)
+
+
+def temperatures_to_raw(temperatures, calibration=DEFAULT_CALIBRATION, subject_distance=15.24):
+    """
+    Invert raw2temp: the raw counts the camera would have stored for the given temperatures.
+    The extractor uses its default distance instead of the one of the file, so that is the default here too
+    :return: uint16 array
+    """
+    from flir_image_extractor import FlirImageExtractor
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lut = FlirImageExtractor.raw2temp(
+            np.arange(65536), E=calibration['Emissivity'], OD=subject_distance,
+            RTemp=calibration['ReflectedApparentTemperature'], ATemp=calibration['AtmosphericTemperature'],
+            IRWTemp=calibration['IRWindowTemperature'], IRT=calibration['IRWindowTransmission'],
+            RH=calibration['RelativeHumidity'] * 100, PR1=calibration['PlanckR1'], PB=calibration['PlanckB'],
+            PF=calibration['PlanckF'], PO=calibration['PlanckO'], PR2=calibration['PlanckR2'])
+
+    raws = np.flatnonzero(np.isfinite(lut))
+    index = np.searchsorted(lut[raws], temperatures)
+    return raws[np.clip(index, 0, raws.shape[0] - 1)].astype(np.uint16)
+
+
+def camera_info_record(calibration=DEFAULT_CALIBRATION, model=b'Synthetic AX8'):
+    """
+    Little endian CameraInfo record, temperatures in K
+    :return: bytes
+    """
+    from flir_fff_parser import FlirFffParser
+
+    record = bytearray(0x380)
+    struct.pack_into('<H', record, 0, 2)
+    for name, (offset, fmt) in FlirFffParser.CAMERA_INFO_FIELDS.items():
+        value = calibration[name]
+        if name in FlirFffParser.TEMPERATURE_FIELDS:
+            value += 273.15
+        struct.pack_into('<' + fmt, record, offset, value)
+    record[0xd4:0xd4 + len(model)] = model
+    return bytes(record)
+
+
+def image_record(width, height, payload):
+    """
+    RawData / EmbeddedImage record: little endian header followed by the image at 0x20
+    :return: bytes
+    """
+    header = bytearray(0x20)
+    struct.pack_into('<HHH', header, 0, 2, width, height)
+    return bytes(header) + payload
+
+
+def pip_record(real2ir, offset=(0, 0)):
+    """
+    Little endian picture in picture record: Real2IR, OffsetX, OffsetY
+    :return: bytes
+    """
+    record = bytearray(0x20)
+    struct.pack_into('<fhh', record, 0, real2ir, offset[0], offset[1])
+    return bytes(record)
+
+
+def fff_file(records):
+    """
+    FFF container with a big endian directory
+    :param records: list of (record type, bytes)
+    :return: bytes
+    """
+    index_offset = 0x40
+    data_offset = index_offset + 0x20 * len(records)
+
+    header = bytearray(index_offset)
+    header[0:4] = b'FFF\x00'
+    header[4:13] = b'Synthetic'
+    struct.pack_into('>III', header, 0x14, 100, index_offset, len(records))
+
+    directory = b''
+    offset = data_offset
+    for number, (record_type, record) in enumerate(records):
+        directory += struct.pack('>HHIIII', record_type, 0, 100, number + 1, offset, len(record)) + b'\x00' * 12
+        offset += len(record)
+
+    return bytes(header) + directory + b''.join(record for _, record in records)
+
+
+def exif_segment(subject_distance):
+    """
+    APP1 Exif segment with just the SubjectDistance tag
+    :return: bytes
+    """
+    tiff = b'II*\x00' + struct.pack('<I', 8)
+    # IFD0: pointer to the Exif IFD at 26
+    tiff += struct.pack('<HHHII', 1, 0x8769, 4, 1, 26) + struct.pack('<I', 0)
+    # Exif IFD: SubjectDistance rational at 44
+    tiff += struct.pack('<HHHII', 1, 0x9206, 5, 1, 44) + struct.pack('<I', 0)
+    tiff += struct.pack('<II', int(round(subject_distance * 100)), 100)
+
+    payload = b'Exif\x00\x00' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def flir_segments(fff):
+    """
+    Split an FFF file over APP1 "FLIR" segments
+    :return: bytes
+    """
+    chunks = [fff[i:i + FLIR_SEGMENT_SIZE] for i in range(0, len(fff), FLIR_SEGMENT_SIZE)]
+    segments = b''
+    for index, chunk in enumerate(chunks):
+        payload = b'FLIR\x00\x01' + struct.pack('>BB', index, len(chunks) - 1) + chunk
+        segments += b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+    return segments
+
+
+def make_flir_jpeg(seed=0, calibration=DEFAULT_CALIBRATION, jpeg_quality=90, raw_size=RAW_SIZE,
+                   visual_size=VISUAL_SIZE, real2ir=None, offset=(0, 0)):
+    """
+    A radiometric JPEG laid out like the AX8 ones: the visible image as main JPEG, the FLIR
+    FFF record (CameraInfo, RawData as a PNG with swapped byte order, EmbeddedImage and, when
+    real2ir is given, PiP) in APP1 segments
+    :param raw_size: (width, height) of the thermal core
+    :param visual_size: (width, height) of the visible image
+    :return: (jpeg bytes, temperatures in C, leaf mask of the raw image)
+    """
+    from PIL import Image
+
+    temperatures, leaves = make_scene(seed, raw_size)
+    raw = temperatures_to_raw(temperatures, calibration)
+
+    # the camera writes the 16 bit counts little endian inside a PNG, which is big endian
+    png = io.BytesIO()
+    Image.fromarray(raw.byteswap()).save(png, format='PNG')
+
+    visual = io.BytesIO()
+    Image.fromarray(make_visual(leaves, seed, visual_size)).save(visual, format='JPEG', quality=jpeg_quality)
+    visual = visual.getvalue()
+
+    records = [
+        (0x20, camera_info_record(calibration)),
+        (0x01, image_record(raw_size[0], raw_size[1], png.getvalue())),
+        (0x0e, image_record(visual_size[0], visual_size[1], visual)),
+    ]
+    if real2ir is not None:
+        records.append((0x2a, pip_record(real2ir, offset)))
+    fff = fff_file(records)
+
+    jpeg = b'\xff\xd8' + exif_segment(calibration['ObjectDistance']) + flir_segments(fff) + visual[2:]
+    return jpeg, temperatures, leaves
+
+
+def make_mask(leaves, geometry):
+    """
+    mask.txt content for the cropped visual image, 1 for leaves
+    :param geometry: SensorGeometry the extractor uses for the capture
+    :return: (height, width) int array
+    """
+    import cv2 as cv
+
+    # the visual image shows the whole raw image, the mask covers the part the extractor crops
+    width, height = geometry.visual_size
+    visual_leaves = cv.resize(leaves.astype(np.uint8), (width, height), interpolation=cv.INTER_NEAREST)
+    return geometry.crop(visual_leaves).astype(int)
+
+
+def image_name(number):
+    """
+    File name following the camera naming, one capture per second from 10:00:00
+    """
+    seconds = 10 * 3600 + number
+    return "img_20200814_{:02d}{:02d}{:02d}_{:05d}".format(seconds // 3600 % 24, seconds // 60 % 60, seconds % 60,
+                                                          number)
+
+
+def link_or_copy(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, destination)
+
+
+def generate_dataset(dataset_dir, count, unique=16, seed=0, with_masks=True, raw_size=RAW_SIZE,
+                     visual_size=VISUAL_SIZE, real2ir=None, mask_format='txt'):
+    """
+    Write count synthetic captures to dataset_dir/images, the way the tools expect them.
+    Only unique different scenes are rendered, the other files are hard links to them (copies
+    where links aren't supported), so large datasets take little disk space
+    :param dataset_dir: root folder, the tools are run from there
+    :param count: number of images
+    :param unique: number of distinct scenes
+    :param with_masks: also write images/<name>/mask.txt, or the mask of mask_format
+    :param raw_size: (width, height) of the thermal core
+    :param visual_size: (width, height) of the visible image
+    :param real2ir: stored in a PiP record when given
+    :param mask_format: one of leaf_mask.MASK_FORMATS
+    :return: list of image paths relative to dataset_dir
+    """
+    from sensor_geometry import SensorGeometry
+    from leaf_mask import MASK_FILE_NAMES, write_mask
+
+    geometry = SensorGeometry(raw_size, visual_size, real2ir=real2ir)
+
+    images_dir = os.path.join(dataset_dir, 'images')
+    if not os.path.isdir(images_dir):
+        os.makedirs(images_dir)
+
+    # (image path, mask path or None) of each distinct scene
+    scenes = []
+    image_paths = []
+    for number in range(count):
+        name = image_name(number)
+        image_path = os.path.join(images_dir, name + '.jpg')
+        mask_path = None
+        if with_masks:
+            mask_path = os.path.join(images_dir, name, MASK_FILE_NAMES[mask_format])
+            if not os.path.isdir(os.path.dirname(mask_path)):
+                os.mkdir(os.path.dirname(mask_path))
+
+        if number < unique:
+            jpeg, _, leaves = make_flir_jpeg(seed + number, raw_size=raw_size, visual_size=visual_size,
+                                             real2ir=real2ir)
+            with open(image_path, 'wb') as fh:
+                fh.write(jpeg)
+            if mask_path:
+                write_mask(mask_path, make_mask(leaves, geometry))
+            scenes.append((image_path, mask_path))
+        else:
+            scene_image_path, scene_mask_path = scenes[number % unique]
+            link_or_copy(scene_image_path, image_path)
+            if mask_path:
+                link_or_copy(scene_mask_path, mask_path)
+
+        image_paths.append('images/' + name + '.jpg')
+
+    return image_paths
+
+
+if __name__ == '__main__':
+    from leaf_mask import MASK_FORMATS
+
+    parser = argparse.ArgumentParser(description='Generate synthetic FLIR radiometric JPEGs')
+    parser.add_argument('-o', '--output', type=str, help='Dataset folder, the images go to <output>/images',
+                        required=True)
+    parser.add_argument('-n', '--count', type=int, help='Number of images', required=False, default=100)
+    parser.add_argument('--unique', type=int, help='Number of distinct scenes', required=False, default=16)
+    parser.add_argument('--seed', type=int, help='Random seed', required=False, default=0)
+    parser.add_argument('--no-masks', help='Don\'t write mask.txt files', required=False, action='store_true')
+    parser.add_argument('--raw-size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='Thermal resolution (default: 80 60)', required=False, default=list(RAW_SIZE))
+    parser.add_argument('--visual-size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='Visible image resolution (default: 640 480)', required=False, default=list(VISUAL_SIZE))
+    parser.add_argument('--mask-format', type=str, help='Format of the masks (default: txt)', required=False,
+                        default='txt', choices=MASK_FORMATS)
+    parser.add_argument('--real2ir', type=float, help='Write a PiP record with this visual to IR ratio',
+                        required=False, default=None)
+    args = parser.parse_args()
+
+    paths = generate_dataset(args.output, args.count, unique=args.unique, seed=args.seed,
+                             with_masks=not args.no_masks, raw_size=tuple(args.raw_size),
+                             visual_size=tuple(args.visual_size), real2ir=args.real2ir,
+                             mask_format=args.mask_format)
+    print("Generated {} images in {}".format(len(paths), os.path.join(args.output, 'images')))
@@ -5,22 +5,30 @@ import glob
 
 import csv
 import numpy as np
-import cv2 as cv
-import pandas as pd
+
+from weather_index import WeatherIndex, WEATHER_FILE, EXACT, LOOKUP_MODES
+from stage_profiler import StageProfiler, profiled, profile_stage
+from thermal_values import read_thermal_values_columns
 
 
 # -*- coding: utf-8 -*-
 
 class ThermalDataModifier:
 
-    def __init__(self, is_debug=False):
+    def __init__(self, is_debug=False, profiler=None):
         self.is_debug = is_debug
+        # optional StageProfiler
+        self.profiler = profiler
         self.unmodified_data_suffix = '_thermal_values.csv'
         self.metadata_in_file = False
         self.at = 0.00
         self.sub = 0
         self.add = 0
+        self.weather_index = None
+        self.weather_match = EXACT
+        self.weather_tolerance = 30 * 60
 
+    @profiled('process_thermal_data')
     def process_thermal_data(self, directory):
         """
         Maps the extracted mask to the thermal data
@@ -57,7 +65,12 @@ class ThermalDataModifier:
         if self.is_debug:
             print("DEBUG Threshold low: %.2f, Threshold high %.2f" % (thresh_low, thresh_high))
 
-        data = pd.read_csv(loaded_csv_files[0], sep=',', parse_dates=False)
+        with profile_stage(self.profiler, 'read_csv'):
+            import pandas as pd
+
+            # parsed once, memory mapped from the _thermal_values.cache next to the csv afterwards
+            columns = read_thermal_values_columns(loaded_csv_files[0])
+            data = pd.DataFrame({'Temp(c)': columns['Temp(c)']})
 
         # Create a new column that has rounded temperatures
         data['Temp_rounded(c)'] = data['Temp(c)'].map(lambda tempc: round(tempc))
@@ -95,39 +108,25 @@ class ThermalDataModifier:
         temps_freq_df = temps_freq_df.sort_values(by=['Temp_rounded(c)'])
         
         # Export to csv
-        temps_freq_df.to_csv(os.path.join(directory, 'canopy_empirical.csv'), header=True, index=False)
+        with profile_stage(self.profiler, 'write_csv'):
+            temps_freq_df.to_csv(os.path.join(directory, 'canopy_empirical.csv'), header=True, index=False)
 
         if self.is_debug:
             print('DEBUG canopy_empirical.csv created')
 
+    @profiled('parse_weather_data')
     def parse_weather_data(self):
-        file_name = 'images/weather_data.xlsx'
-        dfs = pd.read_excel(file_name, header=None, skiprows=1, keep_default_na=False)
-
-        # Dataframe keys
-        dfs.columns = ['DateTime_1', 'Temp_1', 'RH_1', 'DateTime_2', 'Temp_2', 'RH_2', 'DateTime_3',
-                       'Temp_3', 'RH_3']
-
-        self.weather_df = dfs
+        self.weather_index = WeatherIndex(WEATHER_FILE, is_debug=self.is_debug)
 
+    @profiled('weather_lookup')
     def check_if_metadata_present(self, folder_name):
         self.metadata_in_file = False
-        img_name = folder_name.split('\\')[3]
-        img_time = img_name.split("_")[2]
-
-        # Date modification so that we get an exact match
-        joined_date = ''.join(folder_name.split("\\")[1] + " " + img_time[:2] + ":15:00" )
-
-        for i, j in self.weather_df.iterrows():
-            if str(j[0]) == joined_date:
-                self.metadata_in_file = True
-                self.at = j[1]
-            elif str(j[3]) == joined_date:
-                self.metadata_in_file = True
-                self.at = j[4]
-            elif str(j[6]) == joined_date:
-                self.metadata_in_file = True
-                self.at = j[7]
+
+        weather = self.weather_index.lookup_image(folder_name, mode=self.weather_match,
+                                                  tolerance=self.weather_tolerance)
+        if weather is not None:
+            self.metadata_in_file = True
+            self.at = weather[0]
 
         if self.metadata_in_file:
             pass
@@ -145,20 +144,42 @@ if __name__ == "__main__":
     parser.add_argument('-dir', '--directory', type=str, help='Path to directory. Ex. images/test2/', required=False)
     parser.add_argument('-act', '--actions', help='Performs the action for all images inside folders with .csv and mask.txt files', required=False,  action='store_true')
     parser.add_argument('-val', '--values', type=int, nargs=2, help='Number to subtract from Tair and number to add to Tair', required=True)
+    parser.add_argument('--weather-match', type=str, help='How images are matched to the weather_data.xlsx readings: '
+                        'exact (quarter past the hour of the capture, default), nearest or interpolate',
+                        required=False, default=EXACT, choices=LOOKUP_MODES)
+    parser.add_argument('--weather-tolerance', type=float, help='Maximum distance in minutes to the readings used by '
+                        'nearest and interpolate', required=False, default=30)
+    parser.add_argument('--profile', type=str, help='Time every stage into this JSON-lines trace and print a summary table',
+                        required=False, default=None)
     parser.add_argument('-d', '--debug', help='Set the debug flag', required=False, action='store_true')
     parsed_args = parser.parse_args()
 
-    tdm = ThermalDataModifier(is_debug=parsed_args.debug)
+    profiler = None
+    if parsed_args.profile:
+        profiler = StageProfiler(parsed_args.profile)
+        profiler.start()
+
+    tdm = ThermalDataModifier(is_debug=parsed_args.debug, profiler=profiler)
+    tdm.weather_match = parsed_args.weather_match
+    tdm.weather_tolerance = parsed_args.weather_tolerance * 60
     tdm.parse_weather_data()
     tdm.set_add_sub(parsed_args.values)
 
     if parsed_args.actions:
         folder_path_list = glob.glob("images/*-*-*/Camera_*/*/")
         for folder_path in folder_path_list:
+            if profiler is not None:
+                profiler.set_item(folder_path)
             tdm.check_if_metadata_present(folder_path)
             tdm.process_thermal_data(folder_path)
             if parsed_args.debug:
                 print("-------------------------------------------------------")
     else:
+        if profiler is not None:
+            profiler.set_item(parsed_args.directory)
         tdm.check_if_metadata_present(parsed_args.directory)
-        tdm.process_thermal_data(parsed_args.directory)
\ No newline at end of file
+        tdm.process_thermal_data(parsed_args.directory)
+
+    if profiler is not None:
+        profiler.close()
+        profiler.print_summary()
\ No newline at end of file
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import json
+import os
+import os.path
+import subprocess
+import threading
+
+from stage_profiler import count_event
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class ExifToolError(RuntimeError):
+    """
+    Raised when an exiftool worker dies or returns garbage
+    """
+    pass
+
+
+class ExifToolProcess:
+    """
+    A single exiftool started with "-stay_open True -@ -".
+    Arguments are written to stdin one per line and each command is terminated
+    by "-execute<n>", exiftool answers with the output followed by "{ready<n>}"
+    """
+
+    def __init__(self, exiftool_path="exiftool", is_debug=False):
+        self.exiftool_path = exiftool_path
+        self.is_debug = is_debug
+        self.process = None
+        self.command_number = 0
+        self.start()
+
+    pass
+
+    def start(self):
+        """
+        Spawn the exiftool process
+        :return:
+        """
+        if self.is_debug:
+            print("DEBUG Starting exiftool worker: {}".format(self.exiftool_path))
+
+        self.devnull = open(os.devnull, 'w')
+        count_event('subprocesses')
+        self.process = subprocess.Popen(
+            [self.exiftool_path, '-stay_open', 'True', '-@', '-', '-common_args', '-charset', 'filename=utf8'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.devnull)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, *args):
+        """
+        Run one exiftool command and return its raw stdout
+        :param args: exiftool arguments, ex. "-RawThermalImage", "-b", "img.jpg"
+        :return: bytes
+        """
+        if not self.is_alive():
+            raise ExifToolError("exiftool worker is not running")
+
+        self.command_number += 1
+        count_event('exiftool_calls')
+        ready = "{{ready{}}}".format(self.command_number).encode()
+
+        lines = [arg if isinstance(arg, bytes) else arg.encode('utf-8') for arg in args]
+        lines.append("-execute{}".format(self.command_number).encode())
+        try:
+            self.process.stdin.write(b'\n'.join(lines) + b'\n')
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            raise ExifToolError("Unable to send the command to exiftool")
+
+        # exiftool ends the output with "{ready<n>}" and a line ending (CRLF on Windows), wait
+        # for all of it so nothing of this command is left for the next one
+        output = b''
+        fd = self.process.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise ExifToolError("exiftool worker exited unexpectedly")
+            output += chunk
+            trailer_end = len(output) - 1
+            if output.endswith(b'\r\n'):
+                trailer_end -= 1
+            if output.endswith(b'\n') and output[:trailer_end].endswith(ready):
+                break
+
+        # only drop the trailer: -b payloads come without a line ending of their own and
+        # may well end with a 0x0a or 0x0d byte
+        return output[:trailer_end - len(ready)]
+
+    def terminate(self):
+        """
+        Ask exiftool to exit, kill it if it doesn't
+        :return:
+        """
+        if self.is_alive():
+            try:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                self.process.kill()
+        self.process = None
+        self.devnull.close()
+
+
+class ExifToolPool:
+    """
+    A fixed number of long lived exiftool workers.
+    execute() borrows an idle worker, so the pool can be shared between threads.
+    Workers that crash are replaced and the command is retried once.
+    """
+
+    def __init__(self, exiftool_path="exiftool", size=1, is_debug=False):
+        self.exiftool_path = exiftool_path
+        self.size = max(1, size)
+        self.is_debug = is_debug
+        self.idle_workers = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.started = False
+
+    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        Start the workers, called lazily by the first execute()
+        :return:
+        """
+        with self.lock:
+            if self.started:
+                return
+            for _ in range(self.size):
+                worker = ExifToolProcess(self.exiftool_path, is_debug=self.is_debug)
+                self.workers.append(worker)
+                self.idle_workers.put(worker)
+            self.started = True
+
+    def execute(self, *args):
+        """
+        Run one exiftool command on an idle worker
+        :return: bytes written by exiftool to stdout
+        """
+        self.start()
+        worker = self.idle_workers.get()
+        try:
+            try:
+                return worker.execute(*args)
+            except ExifToolError as e:
+                if self.is_debug:
+                    print("DEBUG exiftool worker failed ({}), restarting it".format(e))
+                worker = self.restart_worker(worker)
+                return worker.execute(*args)
+        finally:
+            self.idle_workers.put(worker)
+
+    def execute_json(self, *args):
+        """
+        Run one exiftool command with -j and decode the output
+        :return: list of dictionaries, one per file
+        """
+        output = self.execute(*(list(args) + ['-j']))
+        if not output.strip():
+            return []
+        return json.loads(output.decode('utf-8'))
+
+    def prefetch_metadata(self, image_path_list, tags):
+        """
+        Read the given tags for many images with a single exiftool call
+        :param image_path_list: list of image paths
+        :param tags: list of exiftool tags, ex. ['-PlanckR1', '-PlanckB']
+        :return: dictionary normalized path -> metadata
+        """
+        if not image_path_list:
+            return {}
+
+        metadata = {}
+        for meta in self.execute_json(*(list(tags) + list(image_path_list))):
+            metadata[os.path.normpath(meta['SourceFile'])] = meta
+
+        if self.is_debug:
+            print("DEBUG Prefetched metadata for {} images".format(len(metadata)))
+
+        return metadata
+
+    def restart_worker(self, worker):
+        """
+        Replace a dead worker with a fresh one
+        :return: the new worker
+        """
+        with self.lock:
+            try:
+                worker.terminate()
+            except (IOError, OSError):
+                pass
+            new_worker = ExifToolProcess(self.exiftool_path, is_debug=self.is_debug)
+            self.workers[self.workers.index(worker)] = new_worker
+        return new_worker
+
+    def close(self):
+        """
+        Stop all the workers
+        :return:
+        """
+        with self.lock:
+            for worker in self.workers:
+                worker.terminate()
+            self.workers = []
+            self.idle_workers = queue.Queue()
+            self.started = False
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import os.path
+
+
+class ExtractionManifest:
+    """
+    Remembers which captures have already been extracted and with which inputs.
+
+    Each source image is recorded with its size, mtime and sha1, the outputs it produced,
+    the tool version and the calibration/weather settings. A capture is up to date when
+    all of these still match and its outputs exist; size and mtime are checked first so
+    unchanged files are never read, the hash only decides when the stat changed
+    (ex. a file copied again with the same content).
+    """
+
+    def __init__(self, manifest_path, tool_version, settings, is_debug=False):
+        """
+        :param manifest_path: json file, ex. extraction_manifest.json next to the images folder
+        :param tool_version: version of the extractor, outputs of other versions are rebuilt
+        :param settings: json serializable calibration and weather inputs
+        """
+        self.manifest_path = manifest_path
+        self.tool_version = tool_version
+        self.settings = settings
+        self.is_debug = is_debug
+        self.entries = {}
+        self.load()
+
+    pass
+
+    def load(self):
+        """
+        Read the manifest, a missing or unreadable file means nothing is up to date
+        :return:
+        """
+        self.entries = {}
+        if not os.path.isfile(self.manifest_path):
+            return
+
+        try:
+            with open(self.manifest_path, 'r') as fh:
+                manifest = json.load(fh)
+        except (IOError, ValueError):
+            print("Unable to read {}, all images will be processed".format(self.manifest_path))
+            return
+
+        self.entries = manifest.get('images', {})
+
+    def save(self):
+        """
+        Write the manifest, through a temporary file so an interrupted run keeps the previous one
+        :return:
+        """
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump({'images': self.entries}, fh, indent=1, sort_keys=True)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        os.rename(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def key(image_path):
+        return os.path.normpath(image_path).replace("\\", "/")
+
+    @staticmethod
+    def hash_file(path):
+        """
+        :return: sha1 of the file content
+        """
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def is_up_to_date(self, image_path, output_paths):
+        """
+        :param image_path: source image
+        :param output_paths: files the extraction of the image produces
+        :return: True if the image doesn't need to be processed again
+        """
+        entry = self.entries.get(ExtractionManifest.key(image_path))
+        if entry is None:
+            return False
+
+        if entry.get('tool_version') != self.tool_version or entry.get('settings') != self.settings:
+            return False
+
+        if sorted(entry.get('outputs', [])) != sorted(ExtractionManifest.key(p) for p in output_paths):
+            return False
+        for output_path in output_paths:
+            if not os.path.isfile(output_path):
+                return False
+
+        stat = os.stat(image_path)
+        if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            return True
+
+        if entry.get('size') != stat.st_size or entry.get('sha1') != ExtractionManifest.hash_file(image_path):
+            return False
+
+        # Same content, only touched: remember the new mtime so it isn't hashed again next time
+        entry['mtime'] = stat.st_mtime
+        return True
+
+    def record(self, image_path, output_paths):
+        """
+        Remember a successful extraction
+        :return:
+        """
+        stat = os.stat(image_path)
+        self.entries[ExtractionManifest.key(image_path)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha1': ExtractionManifest.hash_file(image_path),
+            'tool_version': self.tool_version,
+            'settings': self.settings,
+            'outputs': sorted(ExtractionManifest.key(p) for p in output_paths),
+        }
+
+    def forget(self, image_path):
+        """
+        Drop an image, ex. after a failed extraction
+        :return:
+        """
+        self.entries.pop(ExtractionManifest.key(image_path), None)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from stage_profiler import profile_stage
+
+READ_STAGE = 'read'
+DECODE_STAGE = 'decode'
+WRITE_STAGE = 'write'
+PIPELINE_STAGES = [READ_STAGE, DECODE_STAGE, WRITE_STAGE]
+
+# Put on a queue once per consumer thread when there is nothing left to process
+END = None
+
+
+class StageStats:
+    """
+    Busy time and item count of the threads of one stage, and depth of the queue feeding it
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.items = 0
+        self.busy_time = 0.0
+        self.queue_samples = 0
+        self.queue_depth_total = 0
+        self.queue_depth_max = 0
+        self.lock = threading.Lock()
+
+    pass
+
+    def add_busy_time(self, busy_time):
+        with self.lock:
+            self.items += 1
+            self.busy_time += busy_time
+
+    def sample_queue(self, depth):
+        with self.lock:
+            self.queue_samples += 1
+            self.queue_depth_total += depth
+            self.queue_depth_max = max(self.queue_depth_max, depth)
+
+    def to_dict(self, wall_time):
+        """
+        :param wall_time: duration of the whole run
+        :return: json serializable summary, utilization is the busy share of the threads of the stage
+        """
+        utilization = 0.0
+        if wall_time > 0:
+            utilization = self.busy_time / (wall_time * self.workers)
+        queue_depth_mean = 0.0
+        if self.queue_samples:
+            queue_depth_mean = float(self.queue_depth_total) / self.queue_samples
+        return OrderedDict([('workers', self.workers), ('items', self.items), ('busy_s', round(self.busy_time, 6)),
+                            ('utilization', round(utilization, 4)), ('queue_depth_mean', round(queue_depth_mean, 3)),
+                            ('queue_depth_max', self.queue_depth_max)])
+
+
+class ExtractionPipeline:
+    """
+    Runs the -act extraction as three overlapping stages connected by bounded queues:
+
+        reader thread -> decode queue -> decoder threads -> write queue -> writer threads
+
+    The reader loads the file bytes, the decoders parse and convert them into a
+    ThermalCapture (FlirImageExtractor.extract) and the writers write the csv files
+    and images (FlirImageExtractor.write_outputs). The queues hold at most
+    queue_size items each, so a fast stage blocks instead of piling images up in
+    memory, and the disk keeps working while the numeric work runs.
+
+    Decoding and encoding mostly happen in numpy, PIL and OpenCV, which release
+    the GIL, so threads are enough for the stages to overlap.
+    """
+
+    def __init__(self, extractor, decoders=2, writers=2, queue_size=8, is_debug=False):
+        """
+        :param extractor: FlirImageExtractor shared by every thread
+        :param decoders: number of decoder threads
+        :param writers: number of writer threads
+        :param queue_size: capacity of each queue
+        """
+        self.extractor = extractor
+        self.decoders = max(1, decoders)
+        self.writers = max(1, writers)
+        self.queue_size = max(1, queue_size)
+        self.is_debug = is_debug
+
+        self.decode_queue = queue.Queue(maxsize=self.queue_size)
+        self.write_queue = queue.Queue(maxsize=self.queue_size)
+        self.stage_stats = OrderedDict([(READ_STAGE, StageStats(1)), (DECODE_STAGE, StageStats(self.decoders)),
+                                        (WRITE_STAGE, StageStats(self.writers))])
+        # image path -> error message or None
+        self.errors = {}
+        self.errors_lock = threading.Lock()
+        self.wall_time = 0.0
+
+    pass
+
+    def run(self, image_path_list):
+        """
+        Extract and write every image
+        :param image_path_list:
+        :return: list of (image path, error message or None), in the order of image_path_list
+        """
+        start = time.perf_counter()
+
+        threads = [threading.Thread(target=self.read_images, args=(image_path_list,), name='pipeline-reader')]
+        threads += [threading.Thread(target=self.decode_images, name='pipeline-decoder-{}'.format(number))
+                    for number in range(self.decoders)]
+        writer_threads = [threading.Thread(target=self.write_images, name='pipeline-writer-{}'.format(number))
+                          for number in range(self.writers)]
+        for thread in threads + writer_threads:
+            thread.daemon = True
+            thread.start()
+
+        # the writers are told to stop once every decoder is done
+        for thread in threads:
+            thread.join()
+        for _ in range(self.writers):
+            self.write_queue.put(END)
+        for thread in writer_threads:
+            thread.join()
+
+        self.wall_time = time.perf_counter() - start
+        if self.is_debug:
+            self.print_stats()
+
+        return [(image_path, self.errors.get(image_path)) for image_path in image_path_list]
+
+    def fail(self, image_path):
+        with self.errors_lock:
+            self.errors[image_path] = traceback.format_exc()
+
+    def put(self, stage_queue, stage, item):
+        """
+        Queue an item for the given stage, blocking while the queue is full
+        :return:
+        """
+        self.stage_stats[stage].sample_queue(stage_queue.qsize())
+        stage_queue.put(item)
+
+    def read_images(self, image_path_list):
+        """
+        Reader thread: load the content of every file
+        :return:
+        """
+        stats = self.stage_stats[READ_STAGE]
+        profiler = self.extractor.profiler
+        try:
+            for image_path in image_path_list:
+                start = time.perf_counter()
+                try:
+                    if profiler is not None:
+                        profiler.set_item(image_path)
+                    with profile_stage(profiler, 'read_file'), open(image_path, 'rb') as fh:
+                        data = fh.read()
+                except Exception:
+                    self.fail(image_path)
+                    continue
+                finally:
+                    stats.add_busy_time(time.perf_counter() - start)
+                self.put(self.decode_queue, DECODE_STAGE, (image_path, data))
+        finally:
+            for _ in range(self.decoders):
+                self.decode_queue.put(END)
+
+    def decode_images(self):
+        """
+        Decoder thread: parse, convert, crop and downscale the images
+        :return:
+        """
+        stats = self.stage_stats[DECODE_STAGE]
+        profiler = self.extractor.profiler
+        while True:
+            item = self.decode_queue.get()
+            if item is END:
+                return
+            image_path, data = item
+
+            start = time.perf_counter()
+            try:
+                if profiler is not None:
+                    profiler.set_item(image_path)
+                with profile_stage(profiler, 'extract'):
+                    capture = self.extractor.extract(image_path, data=data, outputs=self.extractor.outputs)
+            except Exception:
+                self.fail(image_path)
+                continue
+            finally:
+                stats.add_busy_time(time.perf_counter() - start)
+            # the file bytes can go, only the decoded arrays travel further
+            del item, data
+            self.put(self.write_queue, WRITE_STAGE, capture)
+
+    def write_images(self):
+        """
+        Writer thread: write the csv files, images and archive entry of each capture
+        :return:
+        """
+        stats = self.stage_stats[WRITE_STAGE]
+        profiler = self.extractor.profiler
+        while True:
+            capture = self.write_queue.get()
+            if capture is END:
+                return
+
+            start = time.perf_counter()
+            try:
+                if profiler is not None:
+                    profiler.set_item(capture.flir_img_filename)
+                self.extractor.write_outputs(capture)
+            except Exception:
+                self.fail(capture.flir_img_filename)
+            finally:
+                stats.add_busy_time(time.perf_counter() - start)
+
+    def stats(self):
+        """
+        :return: json serializable per stage utilization and queue depth of the last run
+        """
+        stats = OrderedDict()
+        stats['wall_s'] = round(self.wall_time, 6)
+        stats['queue_size'] = self.queue_size
+        for stage, stage_stats in self.stage_stats.items():
+            stats[stage] = stage_stats.to_dict(self.wall_time)
+        return stats
+
+    def print_stats(self):
+        stats = self.stats()
+        print("DEBUG Pipeline wall time: {:.2f} s, queue size: {}".format(stats['wall_s'], stats['queue_size']))
+        for stage in PIPELINE_STAGES:
+            print("DEBUG   {:<7} {workers} threads, {items} items, busy {busy_s:.2f} s, utilization {utilization:.0%}, "
+                  "queue depth mean {queue_depth_mean:.1f} max {queue_depth_max}".format(stage, **stats[stage]))
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import struct
+
+
+class FlirFormatError(ValueError):
+    """
+    Raised when a file does not contain a FLIR FFF record this parser understands
+    """
+    pass
+
+
+class FlirRecord:
+    """
+    Everything FlirImageExtractor needs from a single radiometric capture.
+    The metadata dictionary uses the exiftool tag names and value formatting
+    so the rest of the pipeline can consume it without knowing which backend produced it.
+    """
+
+    def __init__(self):
+        self.metadata = {}
+        self.raw_thermal_image_bytes = None
+        self.embedded_image_bytes = None
+        self.thumbnail_image_bytes = None
+
+    pass
+
+
+class FlirFffParser:
+    """
+    Pure python reader for FLIR radiometric JPEGs.
+
+    The FFF record is split over several APP1 "FLIR" segments. The file is read once,
+    the segments are concatenated and the records needed for the temperature conversion
+    (CameraInfo, RawData and EmbeddedImage) are decoded directly.
+    The layout follows Image::ExifTool::FLIR (https://exiftool.org/TagNames/FLIR.html)
+    """
+
+    # FFF directory record types
+    RECORD_RAW_DATA = 0x01
+    RECORD_EMBEDDED_IMAGE = 0x0e
+    RECORD_CAMERA_INFO = 0x20
+    RECORD_PIP = 0x2a
+
+    # JPEG markers
+    MARKER_SOI = 0xd8
+    MARKER_SOS = 0xda
+    MARKER_EOI = 0xd9
+    MARKER_APP1 = 0xe1
+
+    # EXIF tags
+    EXIF_IFD_POINTER = 0x8769
+    EXIF_SUBJECT_DISTANCE = 0x9206
+    EXIF_THUMBNAIL_OFFSET = 0x201
+    EXIF_THUMBNAIL_LENGTH = 0x202
+
+    # CameraInfo offsets: name -> (offset, struct format)
+    CAMERA_INFO_FIELDS = {
+        'Emissivity': (0x20, 'f'),
+        'ObjectDistance': (0x24, 'f'),
+        'ReflectedApparentTemperature': (0x28, 'f'),
+        'AtmosphericTemperature': (0x2c, 'f'),
+        'IRWindowTemperature': (0x30, 'f'),
+        'IRWindowTransmission': (0x34, 'f'),
+        'RelativeHumidity': (0x3c, 'f'),
+        'PlanckR1': (0x58, 'f'),
+        'PlanckB': (0x5c, 'f'),
+        'PlanckF': (0x60, 'f'),
+        'PlanckO': (0x308, 'i'),
+        'PlanckR2': (0x30c, 'f'),
+    }
+
+    TEMPERATURE_FIELDS = ['ReflectedApparentTemperature', 'AtmosphericTemperature', 'IRWindowTemperature']
+    PLANCK_FIELDS = ['PlanckR1', 'PlanckB', 'PlanckF', 'PlanckO', 'PlanckR2']
+
+    def __init__(self, is_debug=False):
+        self.is_debug = is_debug
+
+    pass
+
+    def parse_file(self, flir_img_filename):
+        """
+        Read the file once and decode its FLIR records
+        :param flir_img_filename:
+        :return: FlirRecord
+        """
+        with open(flir_img_filename, 'rb') as fh:
+            data = fh.read()
+
+        return self.parse_bytes(data)
+
+    def parse_bytes(self, data):
+        """
+        Decode the FLIR records of an in-memory JPEG
+        :param data: bytes of the whole file
+        :return: FlirRecord
+        """
+        try:
+            fff, exif = self.read_app1_segments(data)
+            if not fff:
+                raise FlirFormatError("No FLIR APP1 segments found")
+            records = self.read_fff_records(fff)
+        except struct.error:
+            raise FlirFormatError("Truncated JPEG or FFF structure")
+
+        if FlirFffParser.RECORD_CAMERA_INFO not in records or FlirFffParser.RECORD_RAW_DATA not in records:
+            raise FlirFormatError("FFF record is missing the CameraInfo or RawData entries")
+
+        record = FlirRecord()
+        record.metadata.update(self.parse_camera_info(records[FlirFffParser.RECORD_CAMERA_INFO]))
+
+        raw_type, raw_width, raw_height, raw_bytes = self.parse_image_record(records[FlirFffParser.RECORD_RAW_DATA])
+        record.metadata['RawThermalImageType'] = raw_type
+        record.metadata['RawThermalImageWidth'] = raw_width
+        record.metadata['RawThermalImageHeight'] = raw_height
+        record.raw_thermal_image_bytes = raw_bytes
+
+        if FlirFffParser.RECORD_EMBEDDED_IMAGE in records:
+            image_type, image_width, image_height, image_bytes = self.parse_image_record(
+                records[FlirFffParser.RECORD_EMBEDDED_IMAGE])
+            record.metadata['EmbeddedImageType'] = image_type
+            record.metadata['EmbeddedImageWidth'] = image_width
+            record.metadata['EmbeddedImageHeight'] = image_height
+            record.embedded_image_bytes = image_bytes
+
+        if FlirFffParser.RECORD_PIP in records:
+            record.metadata.update(self.parse_pip(records[FlirFffParser.RECORD_PIP],
+                                                  FlirFffParser.record_byte_order(records[FlirFffParser.RECORD_CAMERA_INFO])))
+
+        # Same fallback exiftool uses when the EXIF tag is absent
+        record.metadata['SubjectDistance'] = record.metadata['ObjectDistance']
+        if exif:
+            subject_distance, thumbnail = self.parse_exif(exif)
+            if subject_distance is not None:
+                record.metadata['SubjectDistance'] = "{:g} m".format(subject_distance)
+            record.thumbnail_image_bytes = thumbnail
+
+        if self.is_debug:
+            print("DEBUG Native FFF parser found records: {}".format(sorted(records.keys())))
+
+        return record
+
+    def read_app1_segments(self, data):
+        """
+        Walk the JPEG markers up to the start of scan and collect
+        the FLIR payloads (in segment order) and the EXIF payload
+        :return: (fff bytes, exif bytes)
+        """
+        if struct.unpack_from('>BB', data, 0) != (0xff, FlirFffParser.MARKER_SOI):
+            raise FlirFormatError("Not a JPEG file")
+
+        flir_chunks = {}
+        exif = None
+        pos = 2
+        while pos + 4 <= len(data):
+            prefix, marker = struct.unpack_from('>BB', data, pos)
+            if prefix != 0xff:
+                raise FlirFormatError("Corrupt JPEG marker at offset {}".format(pos))
+            if marker in (FlirFffParser.MARKER_SOS, FlirFffParser.MARKER_EOI):
+                break
+            length = struct.unpack_from('>H', data, pos + 2)[0]
+            payload = data[pos + 4:pos + 2 + length]
+            if marker == FlirFffParser.MARKER_APP1:
+                if payload[:5] == b'FLIR\x00':
+                    # 'FLIR\0', 0x01, segment index, index of the last segment
+                    segment_index = struct.unpack_from('>B', payload, 6)[0]
+                    flir_chunks[segment_index] = payload[8:]
+                elif payload[:6] == b'Exif\x00\x00' and exif is None:
+                    exif = payload[6:]
+            pos += 2 + length
+
+        fff = b''.join(flir_chunks[k] for k in sorted(flir_chunks))
+        return fff, exif
+
+    def read_fff_records(self, fff):
+        """
+        Parse the FFF directory
+        :return: dictionary record type -> record bytes
+        """
+        if fff[:4] != b'FFF\x00':
+            raise FlirFormatError("Missing FFF header")
+
+        # the version number (100 <= v < 200) tells us the byte order of the header
+        byte_order = '>'
+        version = struct.unpack_from('>I', fff, 0x14)[0]
+        if not 100 <= version < 200:
+            byte_order = '<'
+            version = struct.unpack_from('<I', fff, 0x14)[0]
+            if not 100 <= version < 200:
+                raise FlirFormatError("Unsupported FFF version")
+
+        index_offset, number_of_entries = struct.unpack_from(byte_order + 'II', fff, 0x18)
+
+        records = {}
+        for i in range(number_of_entries):
+            entry = index_offset + i * 0x20
+            if entry + 0x14 > len(fff):
+                raise FlirFormatError("Truncated FFF directory")
+            record_type = struct.unpack_from(byte_order + 'H', fff, entry)[0]
+            record_offset, record_length = struct.unpack_from(byte_order + 'II', fff, entry + 0x0c)
+            if record_type == 0 or record_type in records:
+                continue
+            if record_offset + record_length > len(fff):
+                raise FlirFormatError("Truncated FFF record of type {}".format(record_type))
+            records[record_type] = fff[record_offset:record_offset + record_length]
+
+        return records
+
+    @staticmethod
+    def record_byte_order(record):
+        """
+        Records start with a small int16 (2 or 3), which gives away their byte order
+        :return:
+        """
+        if struct.unpack_from('<H', record, 0)[0] > 0xff:
+            return '>'
+        return '<'
+
+    def parse_camera_info(self, record):
+        """
+        Decode the calibration parameters, formatted the way exiftool prints them
+        :return: dictionary of exiftool tag names
+        """
+        if len(record) < 0x310:
+            raise FlirFormatError("CameraInfo record is too short")
+
+        byte_order = FlirFffParser.record_byte_order(record)
+        values = {}
+        for name, (offset, fmt) in FlirFffParser.CAMERA_INFO_FIELDS.items():
+            values[name] = struct.unpack_from(byte_order + fmt, record, offset)[0]
+
+        meta = {}
+        meta['Emissivity'] = float("%.2f" % values['Emissivity'])
+        meta['IRWindowTransmission'] = float("%.2f" % values['IRWindowTransmission'])
+        meta['ObjectDistance'] = "%.2f m" % values['ObjectDistance']
+        for name in FlirFffParser.TEMPERATURE_FIELDS:
+            meta[name] = "%.1f C" % (values[name] - 273.15)
+
+        relative_humidity = values['RelativeHumidity']
+        if relative_humidity > 2:
+            relative_humidity /= 100
+        meta['RelativeHumidity'] = "%.1f %%" % (relative_humidity * 100)
+
+        for name in FlirFffParser.PLANCK_FIELDS:
+            meta[name] = self._cast_float("%.8g" % values[name])
+
+        model = record[0xd4:0xd4 + 32].split(b'\x00')[0]
+        meta['CameraModel'] = model.decode('latin-1')
+
+        return meta
+
+    def parse_pip(self, record, byte_order):
+        """
+        Picture in picture record: how the IR field of view sits in the visual image.
+        It starts with a float, so its byte order is taken from the CameraInfo record
+        :return: dictionary with Real2IR, OffsetX and OffsetY, empty if the record is unusable
+        """
+        if len(record) < 8:
+            return {}
+
+        real2ir, offset_x, offset_y = struct.unpack_from(byte_order + 'fhh', record, 0)
+        if not 0.1 < real2ir < 100:
+            return {}
+
+        return {'Real2IR': self._cast_float("%.10g" % real2ir), 'OffsetX': offset_x, 'OffsetY': offset_y}
+
+    def parse_image_record(self, record):
+        """
+        RawData and EmbeddedImage records share the same layout:
+        width and height as int16 at 0x02/0x04 and the image payload at 0x20
+        :return: (type, width, height, bytes)
+        """
+        if len(record) < 0x20:
+            raise FlirFormatError("Image record is too short")
+
+        byte_order = FlirFffParser.record_byte_order(record)
+        width, height = struct.unpack_from(byte_order + 'HH', record, 2)
+        payload = record[0x20:]
+
+        if payload[:8] == b'\x89PNG\r\n\x1a\n':
+            image_type = 'PNG'
+        elif payload[:4] in (b'II*\x00', b'MM\x00*'):
+            image_type = 'TIFF'
+        elif payload[:3] == b'\xff\xd8\xff':
+            image_type = 'JPG'
+        else:
+            # headerless 16 bit counts in the byte order of the record
+            image_type = 'DAT' if byte_order == '<' else 'DAT_BE'
+
+        return image_type, width, height, payload
+
+    def parse_exif(self, exif):
+        """
+        Pull the EXIF SubjectDistance and the IFD1 thumbnail out of the TIFF structure
+        :return: (subject distance in metres or None, thumbnail bytes or None)
+        """
+        if exif[:2] == b'II':
+            byte_order = '<'
+        elif exif[:2] == b'MM':
+            byte_order = '>'
+        else:
+            return None, None
+
+        try:
+            ifd0, ifd1_offset = self._read_ifd(exif, byte_order, struct.unpack_from(byte_order + 'I', exif, 4)[0])
+
+            subject_distance = None
+            if FlirFffParser.EXIF_IFD_POINTER in ifd0:
+                exif_ifd, _ = self._read_ifd(exif, byte_order, ifd0[FlirFffParser.EXIF_IFD_POINTER])
+                if FlirFffParser.EXIF_SUBJECT_DISTANCE in exif_ifd:
+                    numerator, denominator = struct.unpack_from(
+                        byte_order + 'II', exif, exif_ifd[FlirFffParser.EXIF_SUBJECT_DISTANCE])
+                    if denominator:
+                        subject_distance = float(numerator) / denominator
+
+            thumbnail = None
+            if ifd1_offset:
+                ifd1, _ = self._read_ifd(exif, byte_order, ifd1_offset)
+                if FlirFffParser.EXIF_THUMBNAIL_OFFSET in ifd1 and FlirFffParser.EXIF_THUMBNAIL_LENGTH in ifd1:
+                    start = ifd1[FlirFffParser.EXIF_THUMBNAIL_OFFSET]
+                    thumbnail = exif[start:start + ifd1[FlirFffParser.EXIF_THUMBNAIL_LENGTH]] or None
+        except struct.error:
+            if self.is_debug:
+                print("DEBUG Unable to parse the EXIF segment")
+            return None, None
+
+        return subject_distance, thumbnail
+
+    @staticmethod
+    def _read_ifd(tiff, byte_order, offset):
+        """
+        Read a TIFF IFD, keeping the value/offset field of each entry
+        :return: (dictionary tag -> value or offset, offset of the next IFD)
+        """
+        number_of_entries = struct.unpack_from(byte_order + 'H', tiff, offset)[0]
+        entries = {}
+        for i in range(number_of_entries):
+            tag, field_type, count = struct.unpack_from(byte_order + 'HHI', tiff, offset + 2 + 12 * i)
+            if field_type == 3 and count == 1:
+                value = struct.unpack_from(byte_order + 'H', tiff, offset + 10 + 12 * i)[0]
+            else:
+                value = struct.unpack_from(byte_order + 'I', tiff, offset + 10 + 12 * i)[0]
+            entries[tag] = value
+        next_offset = struct.unpack_from(byte_order + 'I', tiff, offset + 2 + 12 * number_of_entries)[0]
+        return entries, next_offset
+
+    @staticmethod
+    def _cast_float(value):
+        """
+        Mirror json.loads on exiftool output: integral numbers become int
+        :return:
+        """
+        value = float(value)
+        if value == int(value):
+            return int(value)
+        return value
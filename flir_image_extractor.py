@@ -13,22 +13,121 @@ import os.path
 import re
 import csv
 import subprocess
-from PIL import Image
-from math import sqrt, exp, log
-from matplotlib import cm
-from matplotlib import pyplot as plt
-from itertools import izip_longest
+import time
+import threading
+import traceback
+from math import sqrt, exp
 
 import numpy as np
-import cv2 as cv
-import pandas as pd
+
+from flir_fff_parser import FlirFffParser, FlirFormatError
+from exiftool_pool import ExifToolPool
+from raw2temp_lut import Raw2TempLutCache
+from thermal_capture import ThermalCapture
+from extraction_manifest import ExtractionManifest
+from thermal_values import write_thermal_values_csv
+from thermal_archive import ThermalArchiveWriter, build_archive_index, archived_captures, capture_key
+from extraction_pipeline import ExtractionPipeline
+from weather_index import WeatherIndex, WEATHER_FILE, EXACT
+from thermal_render import save_thermal_png, DEFAULT_PALETTE, PALETTE_NAMES
+from sensor_geometry import SensorGeometry, metadata_size, GEOMETRY_AUTO, GEOMETRY_MODES, LEGACY_THERMAL_SIZE
+from thermal_registration import RegistrationMapCache, load_alignment, aligned_geometry, REGISTRATION_RESIZE, \
+    REGISTRATION_REMAP, REGISTRATION_MODES
+from stage_profiler import StageProfiler, profiled, profile_stage, count_event, worker_trace_path, \
+    merge_worker_traces, read_trace, summarize, print_summary
+
+# Bump when the content of the generated files changes, so incremental runs rebuild them
+TOOL_VERSION = "2.3"
+
+# Files (and archive entry) -act can write for each image
+OUTPUT_THERMAL_PNG = 'thermal_png'
+OUTPUT_RGB = 'rgb'
+OUTPUT_RGB_CROPPED = 'rgb_cropped'
+OUTPUT_RGB_DOWNSCALED = 'rgb_downscaled'
+OUTPUT_VALUES_CSV = 'values_csv'
+OUTPUT_METADATA_CSV = 'metadata_csv'
+OUTPUT_ARCHIVE = 'archive'
+OUTPUT_NAMES = [OUTPUT_THERMAL_PNG, OUTPUT_RGB, OUTPUT_RGB_CROPPED, OUTPUT_RGB_DOWNSCALED, OUTPUT_VALUES_CSV,
+                OUTPUT_METADATA_CSV, OUTPUT_ARCHIVE]
+# the archive is only written when an archive folder is given
+DEFAULT_OUTPUTS = OUTPUT_NAMES[:-1]
+
+
+def is_jpeg(image_bytes):
+    """
+    :return: True if the encoded image is a jpeg, which can be written out without decoding it
+    """
+    return image_bytes is not None and image_bytes[:3] == b'\xff\xd8\xff'
 
 
 class FlirImageExtractor:
 
-    def __init__(self, exiftool_path="exiftool", is_debug=False):
+    def __init__(self, exiftool_path="exiftool", is_debug=False, backend="native", exiftool_workers=1,
+                 lut_cache_size=8, lut_cache_dir=None, archive_dir=None, palette=DEFAULT_PALETTE,
+                 temperature_range=None, profiler=None, outputs=None, jpeg_quality=75, jpeg_optimize=False,
+                 png_compress_level=None, geometry=GEOMETRY_AUTO, registration=REGISTRATION_RESIZE,
+                 alignment_file=None):
+        """
+        :param outputs: names of OUTPUT_NAMES written for each image, DEFAULT_OUTPUTS (and the archive
+        when archive_dir is given) if None
+        :param jpeg_quality: quality of the cropped and downscaled rgb jpegs (1-95)
+        :param jpeg_optimize: let PIL optimize the jpeg huffman tables
+        :param png_compress_level: zlib level (0-9) of the thermal png, None optimizes it for size
+        :param geometry: how the rgb image is cropped to the thermal field of view, one of GEOMETRY_MODES
+        :param registration: how the rgb image is brought to the thermal resolution, one of REGISTRATION_MODES:
+        resize averages the cropped image (cv.INTER_AREA), remap samples it through cached lookup maps
+        :param alignment_file: json file of per camera model Real2IR/OffsetX/OffsetY, see load_alignment
+        """
         self.exiftool_path = exiftool_path
         self.is_debug = is_debug
+        # number of long lived "-stay_open" exiftool processes, 0 spawns exiftool for every call
+        self.exiftool_workers = exiftool_workers
+        self.exiftool_pool = None
+        self.exiftool_pool_lock = threading.Lock()
+        self.prefetched_metadata = {}
+        # raw -> temperature lookup tables keyed by the calibration parameters, 0 disables them
+        self.lut_cache = None
+        if lut_cache_size > 0:
+            self.lut_cache = Raw2TempLutCache(FlirImageExtractor.raw2temp, max_entries=lut_cache_size,
+                                              cache_dir=lut_cache_dir, is_debug=is_debug)
+        # "native" reads the FLIR segments in python and only falls back to exiftool
+        # when the file can't be decoded, "exiftool" always spawns exiftool
+        self.backend = backend
+        # optional binary archive receiving the raw counts, downscaled rgb and metadata of every image
+        self.archive_dir = archive_dir
+        # what -act writes, artifacts no output needs are never computed
+        if outputs is None:
+            outputs = DEFAULT_OUTPUTS + ([OUTPUT_ARCHIVE] if archive_dir else [])
+        self.outputs = [output for output in OUTPUT_NAMES if output in outputs]
+        unknown_outputs = set(outputs) - set(OUTPUT_NAMES)
+        if unknown_outputs:
+            raise ValueError("Unknown outputs: {}".format(", ".join(sorted(unknown_outputs))))
+        if OUTPUT_ARCHIVE in self.outputs and not archive_dir:
+            raise ValueError("The archive output needs an archive folder")
+        self.archive_writer = None
+        if archive_dir and OUTPUT_ARCHIVE in self.outputs:
+            self.archive_writer = ThermalArchiveWriter(archive_dir, is_debug=is_debug)
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_optimize = jpeg_optimize
+        self.png_compress_level = png_compress_level
+        if geometry not in GEOMETRY_MODES:
+            raise ValueError("Unknown geometry: {}".format(geometry))
+        self.geometry = geometry
+        if registration not in REGISTRATION_MODES:
+            raise ValueError("Unknown registration: {}".format(registration))
+        self.registration = registration
+        self.alignment_file = alignment_file
+        self.alignment = load_alignment(alignment_file) if alignment_file else {}
+        # remap lookup maps of each camera geometry met so far
+        self.registration_maps = RegistrationMapCache(is_debug=is_debug)
+        self.archive_lock = threading.Lock()
+        self.fff_parser = FlirFffParser(is_debug=is_debug)
+        # colors of the thermal png, a fixed (min, max) temperature range keeps them comparable between images
+        self.palette = palette
+        self.temperature_range = tuple(temperature_range) if temperature_range else None
+        # optional StageProfiler timing the stages of every image
+        self.profiler = profiler
+        self.flir_record = None
         self.is_debug_number_of_images = 0
         self.is_debug_number_of_images_with_metadata = 0
         self.flir_img_filename = ""
@@ -49,11 +148,25 @@ class FlirImageExtractor:
         self.rgb_image_np = None
         self.downscaled_rgb_image_np = None
         self.cropped_visual_np = None
+        # raw sensor counts are kept, temperatures and the products derived
+        # from them are only computed (once) when something asks for them
+        self.raw_thermal_np = None
         self.thermal_image_np = None
+        self.thermal_normalized_np = None
 
         self.metadata = None
-
-        self.weather_df = None
+        # products of the current image, each one computed at most once per image
+        self.artifacts = {}
+        self.metadata_tags = ['-Emissivity', '-SubjectDistance', '-AtmosphericTemperature',
+                              '-ReflectedApparentTemperature', '-IRWindowTemperature', '-IRWindowTransmission',
+                              '-RelativeHumidity', '-PlanckR1', '-PlanckB', '-PlanckF', '-PlanckO', '-PlanckR2',
+                              '-RawThermalImageWidth', '-RawThermalImageHeight', '-EmbeddedImageWidth',
+                              '-EmbeddedImageHeight', '-Real2IR', '-OffsetX', '-OffsetY', '-CameraModel']
+
+        self.weather_index = None
+        # how images are matched to the weather file readings, see WeatherIndex.lookup
+        self.weather_match = EXACT
+        self.weather_tolerance = 30 * 60
         self.emissivity = 0.98
         self.rt = 30.00
         self.default_distance = 15.24
@@ -70,6 +183,18 @@ class FlirImageExtractor:
         :param flir_img_filename:
         :return:
         """
+        self.open_image(flir_img_filename)
+
+        self.rgb_image_np = self.get_rgb_np()
+        self.raw_thermal_np = self.get_raw_thermal_np()
+
+    def open_image(self, flir_img_filename):
+        """
+        Make the given file the current image without decoding anything yet,
+        the getters decode what they need on first use
+        :param flir_img_filename:
+        :return:
+        """
         if self.is_debug:
             print("INFO Flir image filepath:{}".format(flir_img_filename))
 
@@ -77,6 +202,10 @@ class FlirImageExtractor:
             raise ValueError("Input file does not exist or this user don't have permission on this file")
 
         self.flir_img_filename = flir_img_filename
+        if self.profiler is not None:
+            self.profiler.set_item(flir_img_filename)
+        self.reset_artifacts()
+        self.flir_record = self.get_artifact('flir_record', self.read_flir_record)
 
         if self.get_image_type().upper().strip() == "TIFF":
             # valid for tiff images from Zenmuse XTR
@@ -84,116 +213,548 @@ class FlirImageExtractor:
             self.use_thumbnail = True
             self.fix_endian = False
 
-        self.rgb_image_np = self.extract_embedded_image()
-        self.thermal_image_np = self.extract_thermal_image()
+    def extract(self, flir_img_filename, at=None, rh=None, data=None, outputs=None):
+        """
+        Extract everything needed from an image without touching the state of the extractor,
+        so one instance can be shared by several threads and the result kept around
+        :param flir_img_filename:
+        :param at: atmospheric temperature override in C, used along with rh
+        :param rh: relative humidity override in %
+        :param data: content of the file if it was already read, it is read from flir_img_filename otherwise
+        :param outputs: only decode what these outputs need, the arrays nothing needs are None.
+        Everything is decoded if None
+        :return: ThermalCapture
+        """
+        if self.is_debug:
+            print("INFO Flir image filepath:{}".format(flir_img_filename))
+
+        if data is None and not os.path.isfile(flir_img_filename):
+            raise ValueError("Input file does not exist or this user don't have permission on this file")
+
+        flir_record = self.parse_flir_record(flir_img_filename, data)
+        profiler = self.profiler
+
+        # the sub-steps are timed under the stage names of the methods run_all_actions calls
+        use_thumbnail = self.use_thumbnail
+        fix_endian = self.fix_endian
+        with profile_stage(profiler, 'get_image_type'):
+            image_type = self.read_image_type(flir_img_filename, flir_record)
+        if image_type.upper().strip() == "TIFF":
+            # valid for tiff images from Zenmuse XTR
+            use_thumbnail = True
+            fix_endian = False
+
+        if outputs is None:
+            outputs = OUTPUT_NAMES
+        needs_thermal = OUTPUT_THERMAL_PNG in outputs or OUTPUT_VALUES_CSV in outputs
+        needs_downscaled = bool({OUTPUT_RGB_DOWNSCALED, OUTPUT_VALUES_CSV, OUTPUT_ARCHIVE} & set(outputs))
+        needs_cropped = needs_downscaled or OUTPUT_RGB_CROPPED in outputs
+
+        with profile_stage(profiler, 'read_metadata'):
+            metadata = self.read_image_metadata(flir_img_filename, flir_record)
+        calibration_parameters = self.get_calibration_parameters(metadata, self.default_distance, at=at, rh=rh)
+
+        embedded_image_bytes = None
+        rgb_np = None
+        with profile_stage(profiler, 'extract_embedded_image'):
+            if OUTPUT_RGB in outputs or needs_cropped:
+                embedded_image_bytes = self.read_embedded_image_bytes(flir_img_filename, flir_record, use_thumbnail)
+            if needs_cropped or (OUTPUT_RGB in outputs and not is_jpeg(embedded_image_bytes)):
+                rgb_np = self.decode_image_bytes(embedded_image_bytes)
+
+        raw_thermal_np = None
+        thermal_np = None
+        thermal_size = metadata_size(metadata, 'RawThermalImageWidth', 'RawThermalImageHeight')
+        with profile_stage(profiler, 'extract_thermal_image'):
+            if needs_thermal or OUTPUT_ARCHIVE in outputs or (needs_cropped and thermal_size is None):
+                with profile_stage(profiler, 'extract_raw_thermal_image'):
+                    raw_thermal_np = self.decode_raw_thermal_image(flir_img_filename, flir_record, metadata,
+                                                                   fix_endian)
+            if needs_thermal:
+                with profile_stage(profiler, 'raw_to_temperature'):
+                    thermal_np = self.convert_raw_to_temperature(raw_thermal_np, calibration_parameters)
+
+        cropped_rgb_np = None
+        downscaled_rgb_np = None
+        if needs_cropped:
+            if raw_thermal_np is not None:
+                thermal_size = (raw_thermal_np.shape[1], raw_thermal_np.shape[0])
+            with profile_stage(profiler, 'crop_rgb_image'):
+                geometry = self.get_sensor_geometry(metadata, (rgb_np.shape[1], rgb_np.shape[0]), thermal_size)
+                cropped_rgb_np = geometry.crop(rgb_np)
+            if needs_downscaled:
+                with profile_stage(profiler, 'image_downscale'):
+                    downscaled_rgb_np = self.register_rgb_image(geometry, rgb_np, cropped_rgb_np)
+
+        return ThermalCapture(flir_img_filename, metadata, calibration_parameters, rgb_np, raw_thermal_np,
+                              thermal_np, cropped_rgb_np, downscaled_rgb_np,
+                              embedded_image_bytes=embedded_image_bytes if OUTPUT_RGB in outputs else None)
+
+    def read_flir_record(self):
+        """
+        Read the raw thermal image, the embedded image and the calibration metadata
+        of the current image in one pass over the file
+        :return:
+        """
+        return self.parse_flir_record(self.flir_img_filename)
+
+    def parse_flir_record(self, flir_img_filename, data=None):
+        """
+        Decode the FLIR segments of the given file.
+        Returns None if exiftool has to be used instead
+        :param data: content of the file if it was already read
+        :return:
+        """
+        if self.backend != "native":
+            return None
+
+        try:
+            if data is not None:
+                return self.fff_parser.parse_bytes(data)
+            return self.fff_parser.parse_file(flir_img_filename)
+        except FlirFormatError as e:
+            if self.is_debug:
+                print("DEBUG Native parser failed ({}), falling back to exiftool".format(e))
+            return None
+
+    def run_exiftool(self, *args):
+        """
+        Run exiftool with the given arguments, through the worker pool unless it is disabled
+        :return: exiftool's stdout
+        """
+        if self.exiftool_workers > 0:
+            return self.get_exiftool_pool().execute(*args)
+
+        count_event('subprocesses')
+        count_event('exiftool_calls')
+        return subprocess.check_output([self.exiftool_path] + list(args), shell=True)
+
+    def get_exiftool_pool(self):
+        """
+        Return the exiftool worker pool, starting it on first use
+        :return:
+        """
+        with self.exiftool_pool_lock:
+            if self.exiftool_pool is None:
+                self.exiftool_pool = ExifToolPool(self.exiftool_path, size=max(1, self.exiftool_workers),
+                                                  is_debug=self.is_debug)
+            return self.exiftool_pool
+
+    def prefetch_metadata(self, image_path_list):
+        """
+        Read the metadata of all the given images with a single exiftool -j call.
+        Only useful with the exiftool backend, the native parser reads it along with the image
+        :param image_path_list:
+        :return:
+        """
+        if self.backend == "native" or not image_path_list:
+            return
+
+        self.prefetched_metadata.update(self.get_exiftool_pool().prefetch_metadata(
+            image_path_list, self.metadata_tags + ['-RawThermalImageType']))
+
+    def get_prefetched_metadata(self):
+        """
+        Return the prefetched metadata of the current image, if any
+        :return:
+        """
+        return self.lookup_prefetched_metadata(self.flir_img_filename)
 
+    def lookup_prefetched_metadata(self, flir_img_filename):
+        """
+        Return the prefetched metadata of the given image, if any
+        :return:
+        """
+        return self.prefetched_metadata.get(os.path.normpath(flir_img_filename))
+
+    def close(self):
+        """
+        Stop the exiftool workers and write the pending archive shards
+        :return:
+        """
+        if self.archive_writer is not None:
+            self.archive_writer.flush()
+        if self.exiftool_pool is not None:
+            self.exiftool_pool.close()
+            self.exiftool_pool = None
+
+    def run_all_actions(self, flir_img_filename):
+        """
+        Process an image and write every output of the -act mode
+        :param flir_img_filename:
+        :return:
+        """
+        self.open_image(flir_img_filename)
+        self.create_subfolder()
+        if {OUTPUT_RGB_CROPPED, OUTPUT_RGB_DOWNSCALED, OUTPUT_VALUES_CSV, OUTPUT_ARCHIVE} & set(self.outputs):
+            self.crop_rgb_image()
+        if {OUTPUT_RGB_DOWNSCALED, OUTPUT_VALUES_CSV, OUTPUT_ARCHIVE} & set(self.outputs):
+            self.image_downscale()
+        if OUTPUT_VALUES_CSV in self.outputs:
+            self.export_data_to_csv()
+        if OUTPUT_METADATA_CSV in self.outputs:
+            self.image_metadata_to_csv()
+        self.save_images()
+        if self.archive_writer is not None:
+            self.add_to_archive()
+
+    @profiled('get_image_type')
     def get_image_type(self):
         """
         Get the embedded thermal image type, generally can be TIFF or PNG
         :return:
         """
-        meta_json = subprocess.check_output(
-            [self.exiftool_path, '-RawThermalImageType', '-j', self.flir_img_filename], shell=True)
-        meta = json.loads(meta_json.decode())[0]
+        return self.read_image_type(self.flir_img_filename, self.flir_record)
+
+    def read_image_type(self, flir_img_filename, flir_record):
+        """
+        Get the embedded thermal image type of the given file
+        :param flir_img_filename:
+        :param flir_record: natively parsed FLIR record, None to ask exiftool
+        :return:
+        """
+        if flir_record is not None:
+            return flir_record.metadata['RawThermalImageType']
+
+        meta = self.lookup_prefetched_metadata(flir_img_filename)
+        if meta is None:
+            meta_json = self.run_exiftool('-RawThermalImageType', '-j', flir_img_filename)
+            meta = json.loads(meta_json.decode())[0]
 
         return meta['RawThermalImageType']
 
+    def get_artifact(self, name, compute_function):
+        """
+        Return a product of the current image, computing it on first use only
+        :param name: key of the artifact, ex. 'rgb'
+        :param compute_function: called without arguments when the artifact is missing
+        :return:
+        """
+        if name not in self.artifacts:
+            self.artifacts[name] = compute_function()
+        return self.artifacts[name]
+
+    def reset_artifacts(self):
+        """
+        Forget everything computed for the previous image
+        :return:
+        """
+        self.artifacts = {}
+        self.flir_record = None
+        self.metadata = None
+        self.rgb_image_np = None
+        self.raw_thermal_np = None
+        self.cropped_visual_np = None
+        self.downscaled_rgb_image_np = None
+        self.thermal_image_np = None
+        self.thermal_normalized_np = None
+
+    def get_metadata(self):
+        """
+        Return the metadata of the current image
+        :return:
+        """
+        self.metadata = self.get_artifact('metadata', self.read_metadata)
+        return self.metadata
+
     def get_rgb_np(self):
         """
         Return the last extracted rgb image
         :return:
         """
+        self.rgb_image_np = self.get_artifact('rgb', self.extract_embedded_image)
         return self.rgb_image_np
 
+    def get_embedded_image_bytes(self):
+        """
+        Return the encoded embedded image (or thumbnail) of the current image, as stored in the file
+        :return:
+        """
+        return self.get_artifact('embedded_image_bytes', lambda: self.read_embedded_image_bytes(
+            self.flir_img_filename, self.flir_record, self.use_thumbnail))
+
+    def get_raw_thermal_np(self):
+        """
+        Return the raw sensor counts of the last extracted thermal image
+        :return:
+        """
+        self.raw_thermal_np = self.get_artifact('raw_thermal', self.extract_raw_thermal_image)
+        return self.raw_thermal_np
+
     def get_thermal_np(self):
         """
-        Return the last extracted thermal image
+        Return the last extracted thermal image, converting the raw counts on first use
         :return:
         """
+        self.thermal_image_np = self.get_artifact(
+            'thermal', lambda: self.raw_to_temperature(self.get_raw_thermal_np()))
         return self.thermal_image_np
 
+    def get_thermal_normalized_np(self):
+        """
+        Return the last extracted thermal image scaled to [0, 1]
+        :return:
+        """
+        def normalize():
+            thermal_np = self.get_thermal_np()
+            return (thermal_np - np.amin(thermal_np)) / (np.amax(thermal_np) - np.amin(thermal_np))
+
+        self.thermal_normalized_np = self.get_artifact('thermal_normalized', normalize)
+        return self.thermal_normalized_np
+
+    def get_geometry(self):
+        """
+        Return the SensorGeometry of the current image
+        :return:
+        """
+        def read_geometry():
+            rgb_np = self.get_rgb_np()
+            thermal_size = metadata_size(self.get_metadata(), 'RawThermalImageWidth', 'RawThermalImageHeight')
+            if thermal_size is None:
+                raw_thermal_np = self.get_raw_thermal_np()
+                thermal_size = (raw_thermal_np.shape[1], raw_thermal_np.shape[0])
+            return self.get_sensor_geometry(self.get_metadata(), (rgb_np.shape[1], rgb_np.shape[0]), thermal_size)
+
+        return self.get_artifact('geometry', read_geometry)
+
+    def get_sensor_geometry(self, metadata, visual_size, thermal_size=None):
+        """
+        Where the thermal image lies inside the rgb image of a capture
+        :param metadata: metadata of the capture, Real2IR and OffsetX/Y are used when present,
+        the alignment file entry of its CameraModel replaces them
+        :param visual_size: (width, height) of the decoded rgb image
+        :param thermal_size: (width, height) of the raw thermal image, read from the metadata if None
+        :return: SensorGeometry
+        """
+        geometry = aligned_geometry(self.alignment, metadata, thermal_size, visual_size, self.geometry)
+        if geometry is None:
+            geometry = SensorGeometry.from_metadata(metadata, thermal_size=thermal_size, visual_size=visual_size,
+                                                    mode=self.geometry)
+        if self.is_debug:
+            print("DEBUG {}".format(geometry))
+        return geometry
+
+    def get_cropped_rgb_np(self):
+        """
+        Return the rgb image cropped to the area seen by the thermal sensor
+        :return:
+        """
+        self.cropped_visual_np = self.get_artifact(
+            'cropped_rgb', lambda: self.get_geometry().crop(self.get_rgb_np()))
+        return self.cropped_visual_np
+
+    def get_downscaled_rgb_np(self):
+        """
+        Return the cropped rgb image resized to the thermal image's resolution
+        :return:
+        """
+        self.downscaled_rgb_image_np = self.get_artifact('downscaled_rgb', self.downscale_rgb_image)
+        return self.downscaled_rgb_image_np
+
+    def reset_temperatures(self):
+        """
+        Forget the temperatures computed from the raw counts,
+        they will be recomputed with the current calibration on next use
+        :return:
+        """
+        self.artifacts.pop('thermal', None)
+        self.artifacts.pop('thermal_normalized', None)
+        self.thermal_image_np = None
+        self.thermal_normalized_np = None
+
+    def set_calibration_overrides(self, at, rh, emissivity=None, rt=None):
+        """
+        Convert the current image with the given weather data instead of its metadata,
+        without decoding the image again
+        :param at: atmospheric temperature in C
+        :param rh: relative humidity in %
+        :param emissivity:
+        :param rt: reflected temperature in C
+        :return:
+        """
+        self.metadata_in_file = True
+        self.at = at
+        self.rh = rh
+        if emissivity is not None:
+            self.emissivity = emissivity
+        if rt is not None:
+            self.rt = rt
+        self.reset_temperatures()
+
+    @profiled('extract_embedded_image')
     def extract_embedded_image(self):
         """
         extracts the visual image as 2D numpy array of RGB values
         """
+        return self.decode_image_bytes(self.get_embedded_image_bytes())
+
+    def decode_embedded_image(self, flir_img_filename, flir_record, use_thumbnail):
+        """
+        extracts the visual image of the given file as 2D numpy array of RGB values
+        """
+        return self.decode_image_bytes(self.read_embedded_image_bytes(flir_img_filename, flir_record, use_thumbnail))
+
+    def read_embedded_image_bytes(self, flir_img_filename, flir_record, use_thumbnail):
+        """
+        reads the encoded visual image (generally a jpeg) of the given file
+        """
         image_tag = "-EmbeddedImage"
-        if self.use_thumbnail:
+        if use_thumbnail:
             image_tag = "-ThumbnailImage"
 
-        visual_img_bytes = subprocess.check_output([self.exiftool_path, image_tag, "-b", self.flir_img_filename], shell=True)
+        visual_img_bytes = None
+        if flir_record is not None:
+            if use_thumbnail:
+                visual_img_bytes = flir_record.thumbnail_image_bytes
+            else:
+                visual_img_bytes = flir_record.embedded_image_bytes
+
+        if visual_img_bytes is None:
+            visual_img_bytes = self.run_exiftool(image_tag, "-b", flir_img_filename)
+        return visual_img_bytes
+
+    def decode_image_bytes(self, visual_img_bytes):
+        """
+        decodes an encoded visual image as 2D numpy array of RGB values
+        """
         visual_img_stream = io.BytesIO(visual_img_bytes)
 
+        from PIL import Image
         visual_img = Image.open(visual_img_stream)
         visual_np = np.array(visual_img)
 
         return visual_np
 
+    @profiled('extract_thermal_image')
     def extract_thermal_image(self):
         """
         extracts the thermal image as 2D numpy array with temperatures in oC
         """
+        return self.raw_to_temperature(self.extract_raw_thermal_image())
 
-        # read image metadata needed for conversion of the raw sensor values
+    @profiled('read_metadata')
+    def read_metadata(self):
+        """
+        reads the image metadata needed for conversion of the raw sensor values
+        """
+        return self.read_image_metadata(self.flir_img_filename, self.flir_record)
+
+    def read_image_metadata(self, flir_img_filename, flir_record):
+        """
+        reads the metadata of the given file
+        """
         # E=1,SD=1,RTemp=20,ATemp=RTemp,IRWTemp=RTemp,IRT=1,RH=50,PR1=21106.77,PB=1501,PF=1,PO=-7340,PR2=0.012545258
-        meta_json = subprocess.check_output(
-            [self.exiftool_path, self.flir_img_filename, '-Emissivity', '-SubjectDistance', '-AtmosphericTemperature',
-             '-ReflectedApparentTemperature', '-IRWindowTemperature', '-IRWindowTransmission', '-RelativeHumidity',
-             '-PlanckR1', '-PlanckB', '-PlanckF', '-PlanckO', '-PlanckR2', '-j'], shell=True)
-        meta = json.loads(meta_json.decode())[0]
-        self.metadata = meta
-        print(self.metadata)
-        
-        # exifread can't extract the embedded thermal image, use exiftool instead
-        thermal_img_bytes = subprocess.check_output([self.exiftool_path, "-RawThermalImage", "-b", self.flir_img_filename], shell=True)
-        thermal_img_stream = io.BytesIO(thermal_img_bytes)
+        if flir_record is not None:
+            meta = flir_record.metadata
+        elif self.lookup_prefetched_metadata(flir_img_filename) is not None:
+            meta = self.lookup_prefetched_metadata(flir_img_filename)
+        else:
+            meta_json = self.run_exiftool(*([flir_img_filename] + self.metadata_tags + ['-j']))
+            meta = json.loads(meta_json.decode())[0]
+        print(meta)
+        return meta
 
-        thermal_img = Image.open(thermal_img_stream)
-        thermal_np = np.array(thermal_img)
+    @profiled('extract_raw_thermal_image')
+    def extract_raw_thermal_image(self):
+        """
+        extracts the raw sensor counts as 2D uint16 numpy array
+        """
+        return self.decode_raw_thermal_image(self.flir_img_filename, self.flir_record, self.get_metadata(),
+                                             self.fix_endian)
+
+    def decode_raw_thermal_image(self, flir_img_filename, flir_record, meta, fix_endian):
+        """
+        extracts the raw sensor counts of the given file as 2D uint16 numpy array
+        """
+        if flir_record is not None:
+            thermal_img_bytes = flir_record.raw_thermal_image_bytes
+        else:
+            # exifread can't extract the embedded thermal image, use exiftool instead
+            thermal_img_bytes = self.run_exiftool("-RawThermalImage", "-b", flir_img_filename)
+
+        if flir_record is not None and meta['RawThermalImageType'].startswith('DAT'):
+            # headerless counts (e.g. SC660), already in the byte order stated by the record
+            dtype = '<u2' if meta['RawThermalImageType'] == 'DAT' else '>u2'
+            thermal_np = np.frombuffer(thermal_img_bytes, dtype=dtype).reshape(
+                meta['RawThermalImageHeight'], meta['RawThermalImageWidth'])
+            fix_endian = False
+        else:
+            thermal_img_stream = io.BytesIO(thermal_img_bytes)
+
+            from PIL import Image
+            thermal_img = Image.open(thermal_img_stream)
+            thermal_np = np.array(thermal_img)
+
+        if fix_endian:
+            # fix endianness, the bytes in the embedded png are in the wrong order.
+            # Reinterpreting them with the opposite byte order is a view, nothing is copied
+            thermal_np = thermal_np.view(thermal_np.dtype.newbyteorder())
 
+        return thermal_np
+
+    @profiled('raw_to_temperature')
+    def raw_to_temperature(self, raw_np):
+        """
+        Convert raw sensor counts of the current image to temperatures in oC
+        using the metadata or the weather file overrides
+        :param raw_np:
+        :return:
+        """
         # raw values -> temperature
         subject_distance = self.default_distance
         
         # Distance is wrong in our metadata, uncomment lines below when it is fixed
-        #if 'SubjectDistance' in meta:
-            #subject_distance = FlirImageExtractor.extract_float(meta['SubjectDistance'])
+        #if 'SubjectDistance' in self.metadata:
+            #subject_distance = FlirImageExtractor.extract_float(self.metadata['SubjectDistance'])
+
+        calibration_parameters = self.get_calibration_parameters(self.get_metadata(), subject_distance)
+        return self.convert_raw_to_temperature(raw_np, calibration_parameters)
+
+    def convert_raw_to_temperature(self, raw_np, calibration_parameters):
+        """
+        Convert raw sensor counts to temperatures in oC with the given raw2temp parameters
+        :return:
+        """
+        if self.lut_cache is not None:
+            return self.lut_cache.convert(raw_np, calibration_parameters)
+        return FlirImageExtractor.raw2temp(raw_np, **calibration_parameters)
 
-        if self.fix_endian:
-            # fix endianness, the bytes in the embedded png are in the wrong order
-            thermal_np = np.vectorize(lambda x: (x >> 8) + ((x & 0x00ff) << 8))(thermal_np)
+    def get_calibration_parameters(self, meta, subject_distance, at=None, rh=None):
+        """
+        Collect the raw2temp parameters of an image
+        :param meta: exiftool style metadata of the image
+        :param subject_distance: object distance in m
+        :param at: atmospheric temperature override, the weather file values are used when None
+        :param rh: relative humidity override
+        :return: dictionary of raw2temp keyword arguments
+        """
+        if at is None or rh is None:
+            at, rh = self.at, self.rh
+            use_overrides = self.metadata_in_file
+        else:
+            use_overrides = True
 
         # Check if the image is present in the xlsx data
-        if self.metadata_in_file:
+        if use_overrides:
             # Use the metadata found in file
-            raw2tempfunc = np.vectorize(lambda x: FlirImageExtractor.raw2temp(x, 
-                                                                    E=self.emissivity, OD=subject_distance,
-                                                                    RTemp=self.rt,
-                                                                    ATemp=self.at,
-                                                                    IRWTemp=FlirImageExtractor.extract_float(
-                                                                        meta['IRWindowTemperature']),
-                                                                    IRT=meta['IRWindowTransmission'],
-                                                                    RH=self.rh,
-                                                                    PR1=meta['PlanckR1'], PB=meta['PlanckB'],
-                                                                    PF=meta['PlanckF'],
-                                                                    PO=meta['PlanckO'], PR2=meta['PlanckR2']))
-        
-        else:
-            # Use the metadata attached to the image
-            raw2tempfunc = np.vectorize(lambda x: FlirImageExtractor.raw2temp(x, 
-                                                                    E=meta['Emissivity'],               OD=subject_distance,
-                                                                    RTemp=FlirImageExtractor.extract_float(
-                                                                        meta['ReflectedApparentTemperature']),
-                                                                    ATemp=FlirImageExtractor.extract_float(
-                                                                        meta['AtmosphericTemperature']),
-                                                                    IRWTemp=FlirImageExtractor.extract_float(
-                                                                        meta['IRWindowTemperature']),
-                                                                    IRT=meta['IRWindowTransmission'],
-                                                                    RH=FlirImageExtractor.extract_float(
-                                                                        meta['RelativeHumidity']),
-                                                                    PR1=meta['PlanckR1'], PB=meta['PlanckB'],
-                                                                    PF=meta['PlanckF'],
-                                                                    PO=meta['PlanckO'], PR2=meta['PlanckR2']))
-        thermal_np = raw2tempfunc(thermal_np)
-        return thermal_np
+            return dict(E=self.emissivity, OD=subject_distance,
+                        RTemp=self.rt,
+                        ATemp=at,
+                        IRWTemp=FlirImageExtractor.extract_float(meta['IRWindowTemperature']),
+                        IRT=meta['IRWindowTransmission'],
+                        RH=rh,
+                        PR1=meta['PlanckR1'], PB=meta['PlanckB'], PF=meta['PlanckF'],
+                        PO=meta['PlanckO'], PR2=meta['PlanckR2'])
+
+        # Use the metadata attached to the image
+        return dict(E=meta['Emissivity'], OD=subject_distance,
+                    RTemp=FlirImageExtractor.extract_float(meta['ReflectedApparentTemperature']),
+                    ATemp=FlirImageExtractor.extract_float(meta['AtmosphericTemperature']),
+                    IRWTemp=FlirImageExtractor.extract_float(meta['IRWindowTemperature']),
+                    IRT=meta['IRWindowTransmission'],
+                    RH=FlirImageExtractor.extract_float(meta['RelativeHumidity']),
+                    PR1=meta['PlanckR1'], PB=meta['PlanckB'], PF=meta['PlanckF'],
+                    PO=meta['PlanckO'], PR2=meta['PlanckR2'])
 
     @staticmethod
     def raw2temp(raw, E=0.98, OD=15.24, RTemp=30, ATemp=20, IRWTemp=20, IRT=1, RH=50, PR1=21106.77, PB=1501, PF=1, PO=-7340,
@@ -203,6 +764,12 @@ class FlirImageExtractor:
         # this calculation has been ported to python from
         # https://github.com/gtatters/Thermimage/blob/master/R/raw2temp.R
         # a detailed explanation of what is going on here can be found there
+
+        raw can be a single value or a numpy array of any shape. The atmospheric, window
+        and reflection terms only depend on the parameters, so they are computed once and
+        the whole array is converted with broadcast numpy operations.
+        The result matches the former per-pixel math.exp/math.log version within 1e-9 C
+        (differences come only from np.log rounding the last bit differently).
         """
 
         # constants
@@ -234,11 +801,11 @@ class FlirImageExtractor:
         raw_refl2_attn = refl_wind / E / tau1 / IRT * raw_refl2
         raw_atm2 = PR1 / (PR2 * (exp(PB / (ATemp + 273.15)) - PF)) - PO
         raw_atm2_attn = (1 - tau2) / E / tau1 / IRT / tau2 * raw_atm2
-        raw_obj = (raw / E / tau1 / IRT / tau2 - raw_atm1_attn -
+        raw_obj = (np.asarray(raw, dtype=np.float64) / E / tau1 / IRT / tau2 - raw_atm1_attn -
                    raw_atm2_attn - raw_wind_attn - raw_refl1_attn - raw_refl2_attn)
 
         # temperature from radiance
-        temp_celcius = PB / log(PR1 / (PR2 * (raw_obj + PO)) + PF) - 273.15
+        temp_celcius = PB / np.log(PR1 / (PR2 * (raw_obj + PO)) + PF) - 273.15
         return temp_celcius
 
     @staticmethod
@@ -255,6 +822,8 @@ class FlirImageExtractor:
         Plot the rgb + thermal image (easy to see the pixel values)
         :return:
         """
+        from matplotlib import pyplot as plt
+
         rgb_np = self.get_rgb_np()
         thermal_np = self.get_thermal_np()
 
@@ -264,43 +833,81 @@ class FlirImageExtractor:
         plt.imshow(rgb_np)
         plt.show()
 
+    @profiled('save_images')
     def save_images(self):
         """
-        Save the extracted images
+        Save the extracted images selected by the outputs
         :return:
         """
-        rgb_np = self.get_rgb_np()
-        thermal_np = self.extract_thermal_image()
-
-        # Generate Images out of numpy arrays
-        img_visual = Image.fromarray(rgb_np)
-        thermal_normalized = (thermal_np - np.amin(thermal_np)) / (np.amax(thermal_np) - np.amin(thermal_np))
-        img_thermal = Image.fromarray(np.uint8(cm.inferno(thermal_normalized) * 255))
-        cropped_img_visual = Image.fromarray(self.cropped_visual_np)
-        downscaled_img_visual = Image.fromarray(self.downscaled_rgb_image_np)
+        embedded_image_bytes = None
+        rgb_np = None
+        if OUTPUT_RGB in self.outputs:
+            embedded_image_bytes = self.get_embedded_image_bytes()
+            if not is_jpeg(embedded_image_bytes):
+                rgb_np = self.get_rgb_np()
+
+        self.write_images(
+            self.flir_img_filename, rgb_np=rgb_np,
+            thermal_np=self.get_thermal_np() if OUTPUT_THERMAL_PNG in self.outputs else None,
+            cropped_rgb_np=self.get_cropped_rgb_np() if OUTPUT_RGB_CROPPED in self.outputs else None,
+            downscaled_rgb_np=self.get_downscaled_rgb_np() if OUTPUT_RGB_DOWNSCALED in self.outputs else None,
+            embedded_image_bytes=embedded_image_bytes)
+
+    def write_images(self, flir_img_filename, rgb_np=None, thermal_np=None, cropped_rgb_np=None,
+                     downscaled_rgb_np=None, embedded_image_bytes=None):
+        """
+        Save the rgb, thermal, cropped and downscaled images of the given file to its subfolder,
+        the ones passed as None are skipped.
+        A jpeg embedded image is written as it is, rgb_np is only encoded when it isn't one
+        :return:
+        """
+        from PIL import Image
 
-        fn_prefix, _ = os.path.splitext(self.flir_img_filename)
+        fn_prefix, _ = os.path.splitext(flir_img_filename)
         
         # Generate the paths for the images
-        thermal_filename = os.path.join(fn_prefix + '/' + fn_prefix.split('/')[1] + self.thermal_suffix)
-        image_filename = os.path.join(fn_prefix + '/' + fn_prefix.split('/')[1] + self.image_suffix)
-        cropped_image_filename = os.path.join(fn_prefix + '/' + fn_prefix.split('/')[1] + self.cropped_image_suffix)
-        downscaled_image_filename = os.path.join(fn_prefix + '/' + fn_prefix.split('/')[1] + self.downscaled_image_suffix)
+        thermal_filename = self.get_output_filename(self.thermal_suffix, flir_img_filename)
+        image_filename = self.get_output_filename(self.image_suffix, flir_img_filename)
+        cropped_image_filename = self.get_output_filename(self.cropped_image_suffix, flir_img_filename)
+        downscaled_image_filename = self.get_output_filename(self.downscaled_image_suffix, flir_img_filename)
 
         if self.use_thumbnail:
             image_filename = os.path.join(fn_prefix + '/' + fn_prefix.split('\\')[6] + self.thumbnail_suffix)
 
-        if self.is_debug:
-            print("DEBUG Saving RGB image to:{}".format(image_filename))
-            print("DEBUG Saving Thermal image to:{}".format(thermal_filename))
-            print("DEBUG Saving RGB cropped image image to:{}".format(cropped_image_filename))
-            print("DEBUG Saving RGB downscaled image to:{}".format(downscaled_image_filename))
+        if is_jpeg(embedded_image_bytes):
+            if self.is_debug:
+                print("DEBUG Copying the embedded RGB image to:{}".format(image_filename))
+            with open(image_filename, 'wb') as fh:
+                fh.write(embedded_image_bytes)
+        elif rgb_np is not None:
+            if self.is_debug:
+                print("DEBUG Saving RGB image to:{}".format(image_filename))
+            self.save_jpeg(image_filename, Image.fromarray(rgb_np))
 
-        img_visual.save(image_filename)
-        img_thermal.save(thermal_filename)
-        downscaled_img_visual.save(downscaled_image_filename)
-        cropped_img_visual.save(cropped_image_filename)
+        if thermal_np is not None:
+            if self.is_debug:
+                print("DEBUG Saving Thermal image to:{}".format(thermal_filename))
+            save_thermal_png(thermal_filename, thermal_np, self.palette, self.temperature_range,
+                             compress_level=self.png_compress_level)
+
+        if downscaled_rgb_np is not None:
+            if self.is_debug:
+                print("DEBUG Saving RGB downscaled image to:{}".format(downscaled_image_filename))
+            self.save_jpeg(downscaled_image_filename, Image.fromarray(downscaled_rgb_np))
 
+        if cropped_rgb_np is not None:
+            if self.is_debug:
+                print("DEBUG Saving RGB cropped image image to:{}".format(cropped_image_filename))
+            self.save_jpeg(cropped_image_filename, Image.fromarray(cropped_rgb_np))
+
+    def save_jpeg(self, path, image):
+        """
+        Encode a PIL image with the configured jpeg quality
+        :return:
+        """
+        image.save(path, quality=self.jpeg_quality, optimize=self.jpeg_optimize)
+
+    @profiled('export_data_to_csv')
     def export_data_to_csv(self):
         """
         Export thermal data, along with rgb information 
@@ -308,41 +915,9 @@ class FlirImageExtractor:
         :return:
         """
         
-        fn_prefix, _ = os.path.splitext(self.flir_img_filename)
-        path = os.path.join(fn_prefix + '/' + fn_prefix.split('/')[1] + self.csv_suffix)
-
+        path = self.get_output_filename(self.csv_suffix)
 
-        # list of pixel coordinates and thermal values
-        coords_and_thermal_values = []
-        for e in np.ndenumerate(self.thermal_image_np):
-            x, y = e[0]
-            c = e[1]
-            coords_and_thermal_values.append([x, y, c])
-    
-        # list of rgb values of the downscaled 60x80 image
-        rgb_values = []
-        for i in range(self.downscaled_rgb_image_np.shape[0]):
-            for j in range(self.downscaled_rgb_image_np.shape[1]):
-                R = self.downscaled_rgb_image_np[i,j,0]
-                G = self.downscaled_rgb_image_np[i,j,1]
-                B = self.downscaled_rgb_image_np[i,j,2]
-                rgb_values.append([R, G, B])
-        
-        # List of lists of lists [[[x,y,temp],[R,G,B]]]
-        merged_list = list(map(list,zip(coords_and_thermal_values, rgb_values)))
-        
-        # List of lists [[x,y,temp],[R,G,B]]
-        flat_list = [item for sublist in merged_list for item in sublist]
-
-        # Combination of consecutive sublists [x,y,temp,R,G,B] -> format needed for csv writer
-        x = iter(flat_list)
-        formatted_flat_list = [a+b for a, b in izip_longest(x, x, fillvalue=[])]
-
-        # wb instead of w cause python 2 on windows adds blank lines.
-        with open(path, 'wb') as fh:
-            writer = csv.writer(fh, delimiter=',')
-            writer.writerow(['x', 'y', 'Temp(c)', 'R', 'G', 'B'])
-            writer.writerows(formatted_flat_list)
+        write_thermal_values_csv(path, self.get_thermal_np(), self.get_downscaled_rgb_np())
         
         if self.is_debug:
             print("DEBUG Saving temperature and RGB data to:{}".format(path))
@@ -357,38 +932,153 @@ class FlirImageExtractor:
         starty = y // 2 - (cropy // 2)
         return img[starty:starty + cropy, startx:startx + cropx]
 
+    @profiled('crop_rgb_image')
     def crop_rgb_image(self):
 
-        self.cropped_visual_np = self.crop_center(self.rgb_image_np, 504, 342)
+        self.get_cropped_rgb_np()
 
+    @profiled('image_downscale')
     def image_downscale(self):
         """
-        Downscale the rgb image to 60x80 resolution
-        to match the thermal image's resolution
-        and save it
+        Downscale the rgb image to the thermal image's resolution
         :return:
         """
+        self.get_downscaled_rgb_np()
 
-        width = 80
-        height = 60
-        dim = (width, height)
+    def downscale_rgb_image(self):
+        """
+        Resize the cropped rgb image to the thermal resolution
+        :return:
+        """
+        return self.register_rgb_image(self.get_geometry(), self.get_rgb_np(), self.get_cropped_rgb_np())
 
-        # resize the rgb image
-        resized = cv.resize(self.cropped_visual_np, dim, interpolation=cv.INTER_AREA)
+    def register_rgb_image(self, geometry, rgb_np, cropped_rgb_np):
+        """
+        Bring the rgb image to the thermal resolution, pixel for pixel with the thermal image
+        :param geometry: SensorGeometry of the capture
+        :param rgb_np: full rgb image
+        :param cropped_rgb_np: the same cropped by geometry
+        :return:
+        """
+        if self.registration == REGISTRATION_REMAP:
+            return self.registration_maps.get_maps(geometry).register(rgb_np)
+        return geometry.downscale(cropped_rgb_np)
 
-        fn_prefix, _ = os.path.splitext(self.flir_img_filename)
-    
-        downscaled_img_visual = Image.fromarray(resized)
-        self.downscaled_rgb_image_np = np.array(downscaled_img_visual)
+    def downscale_image(self, cropped_visual_np, thermal_size=LEGACY_THERMAL_SIZE):
+        """
+        Resize a cropped rgb image to the given (width, height) thermal resolution
+        :return:
+        """
+        import cv2 as cv
+
+        # resize the rgb image
+        return cv.resize(cropped_visual_np, tuple(thermal_size), interpolation=cv.INTER_AREA)
         
-    def create_subfolder(self):
+    @profiled('add_to_archive')
+    def add_to_archive(self):
+        """
+        Queue the raw counts, downscaled rgb image and metadata of the current image for the archive
+        :return:
+        """
+        calibration_parameters = self.get_calibration_parameters(self.get_metadata(), self.default_distance)
+        with self.archive_lock:
+            self.archive_writer.add(self.flir_img_filename, self.get_raw_thermal_np(), self.get_downscaled_rgb_np(),
+                                    self.get_metadata(), calibration_parameters)
+
+    @profiled('write_outputs')
+    def write_outputs(self, capture):
+        """
+        Write every output of the -act mode for an extracted image, like run_all_actions does.
+        Only reads the state of the extractor, so several threads can write captures at the same time
+        :param capture: ThermalCapture
+        :return:
+        """
+        flir_img_filename = capture.flir_img_filename
+        self.create_subfolder(flir_img_filename)
+
+        # timed under the stage names of the methods run_all_actions calls
+        if OUTPUT_VALUES_CSV in self.outputs:
+            with profile_stage(self.profiler, 'export_data_to_csv'):
+                path = self.get_output_filename(self.csv_suffix, flir_img_filename)
+                write_thermal_values_csv(path, capture.thermal_image_np, capture.downscaled_rgb_image_np)
+            if self.is_debug:
+                print("DEBUG Saving temperature and RGB data to:{}".format(path))
+
+        if OUTPUT_METADATA_CSV in self.outputs:
+            with profile_stage(self.profiler, 'image_metadata_to_csv'):
+                self.write_metadata_csv(self.get_output_filename(self.metadata_csv_suffix, flir_img_filename),
+                                        capture.metadata)
+
+        def selected(output, value):
+            return value if output in self.outputs else None
+
+        with profile_stage(self.profiler, 'save_images'):
+            self.write_images(flir_img_filename, rgb_np=selected(OUTPUT_RGB, capture.rgb_image_np),
+                              thermal_np=selected(OUTPUT_THERMAL_PNG, capture.thermal_image_np),
+                              cropped_rgb_np=selected(OUTPUT_RGB_CROPPED, capture.cropped_visual_np),
+                              downscaled_rgb_np=selected(OUTPUT_RGB_DOWNSCALED, capture.downscaled_rgb_image_np),
+                              embedded_image_bytes=capture.embedded_image_bytes)
+
+        if self.archive_writer is not None:
+            with profile_stage(self.profiler, 'add_to_archive'), self.archive_lock:
+                self.archive_writer.add(flir_img_filename, capture.raw_thermal_np, capture.downscaled_rgb_image_np,
+                                        capture.metadata, capture.calibration_parameters)
+
+    def get_output_filename(self, suffix, flir_img_filename=None):
+        """
+        Path of a generated file inside the subfolder of the image
+        :param suffix: ex. self.csv_suffix
+        :param flir_img_filename: defaults to the current image
+        :return:
+        """
+        if flir_img_filename is None:
+            flir_img_filename = self.flir_img_filename
+        fn_prefix, _ = os.path.splitext(flir_img_filename)
+        return os.path.join(fn_prefix + '/' + fn_prefix.split('/')[1] + suffix)
+
+    def get_output_filenames(self, flir_img_filename):
+        """
+        All the files written by run_all_actions for the given image
+        :return:
+        """
+        flir_img_filename = flir_img_filename.replace("\\","/")
+        suffixes = {OUTPUT_THERMAL_PNG: self.thermal_suffix, OUTPUT_RGB: self.image_suffix,
+                    OUTPUT_RGB_CROPPED: self.cropped_image_suffix, OUTPUT_RGB_DOWNSCALED: self.downscaled_image_suffix,
+                    OUTPUT_VALUES_CSV: self.csv_suffix, OUTPUT_METADATA_CSV: self.metadata_csv_suffix}
+        return [self.get_output_filename(suffixes[output], flir_img_filename) for output in self.outputs
+                if output in suffixes]
+
+    def get_settings(self):
+        """
+        Calibration and weather inputs that affect the generated files. The archive is left out,
+        whether a capture is archived is checked against the archive itself
+        :return: json serializable dictionary
+        """
+        weather_file_mtime = None
+        if os.path.isfile(WEATHER_FILE):
+            weather_file_mtime = os.path.getmtime(WEATHER_FILE)
+
+        return {'emissivity': self.emissivity, 'rt': self.rt, 'default_distance': self.default_distance,
+                'metadata_in_file': self.metadata_in_file, 'at': self.at, 'rh': self.rh,
+                'weather_file_mtime': weather_file_mtime, 'weather_match': self.weather_match,
+                'weather_tolerance': self.weather_tolerance, 'palette': self.palette,
+                'outputs': [output for output in self.outputs if output != OUTPUT_ARCHIVE],
+                'jpeg_quality': self.jpeg_quality,
+                'jpeg_optimize': self.jpeg_optimize, 'png_compress_level': self.png_compress_level,
+                'geometry': self.geometry, 'registration': self.registration, 'alignment': self.alignment,
+                'temperature_range': list(self.temperature_range) if self.temperature_range else None}
+
+    def create_subfolder(self, flir_img_filename=None):
         """
         Create a subfolder inside the original image
         folder in order to save generated files
+        :param flir_img_filename: defaults to the current image
         :return:
         """
+        if flir_img_filename is None:
+            flir_img_filename = self.flir_img_filename
         # define the name of the directory to be created
-        fn_prefix, _ = os.path.splitext(self.flir_img_filename)
+        fn_prefix, _ = os.path.splitext(flir_img_filename)
         path = fn_prefix
 
         try:
@@ -403,49 +1093,35 @@ class FlirImageExtractor:
         return path
     
     def parse_weather_data(self):
-        file_name = 'images/weather_data.xlsx'
-        xl_file = pd.ExcelFile(file_name)
-        dfs = pd.read_excel(file_name, header=None, skiprows=1, keep_default_na=False)
-        
-        # Dataframe keys
-        dfs.columns = ['DateTime_1', 'Temp_1', 'RH_1', 'DateTime_2', 'Temp_2', 'RH_2', 'DateTime_3',
-                       'Temp_3', 'RH_3']
-        
-        self.weather_df = dfs
-        #print(self.weather_df)
+        self.weather_index = WeatherIndex(WEATHER_FILE, is_debug=self.is_debug)
 
     def check_if_metadata_present(self, file_name):
         self.metadata_in_file = False
-        img_name = os.path.split(file_name)[1]
-        img_time = img_name.split("_")[2]
-        
-        # Date modification so that we get an exact match
-        joined_date = ''.join(file_name.split("\\")[1] + " " + img_time[:2] + ":15:00" )
-     
-        for i, j in self.weather_df.iterrows():
-            if str(j[0]) == joined_date:
-                self.metadata_in_file = True
-                self.at = FlirImageExtractor.extract_float(str(j[1]))
-                self.rh = FlirImageExtractor.extract_float(str(j[2]))
-            elif str(j[3]) == joined_date:
-                self.metadata_in_file = True
-                self.at = FlirImageExtractor.extract_float(str(j[4]))
-                self.rh = FlirImageExtractor.extract_float(str(j[5]))
-            elif str(j[6]) == joined_date:
-                self.metadata_in_file = True
-                self.at = FlirImageExtractor.extract_float(str(j[7]))
-                self.rh = FlirImageExtractor.extract_float(str(j[8]))
+
+        weather = self.weather_index.lookup_image(file_name, mode=self.weather_match,
+                                                  tolerance=self.weather_tolerance)
+        if weather is not None:
+            self.metadata_in_file = True
+            self.at, self.rh = weather
         
         if self.metadata_in_file:
             self.is_debug_number_of_images_with_metadata+=1
         else:
             print("Weather data not found for: ", file_name)
+
+        # temperatures already computed for this image used the previous calibration
+        self.reset_temperatures()
     
+    @profiled('image_metadata_to_csv')
     def image_metadata_to_csv(self):
 
-        fn_prefix, _ = os.path.splitext(self.flir_img_filename)
-        path = os.path.join(fn_prefix + '/' + fn_prefix.split('/')[1] + self.metadata_csv_suffix)
+        self.write_metadata_csv(self.get_output_filename(self.metadata_csv_suffix), self.get_metadata())
 
+    def write_metadata_csv(self, path, metadata):
+        """
+        Write the calibration metadata of an image to a one row csv
+        :return:
+        """
         csv_columns = ['Emissivity', 'SubjectDistance', 'AtmosphericTemperature',
              'ReflectedApparentTemperature', 'IRWindowTemperature', 'IRWindowTransmission', 'RelativeHumidity',
              'PlanckR1', 'PlanckB', 'PlanckF', 'PlanckO', 'PlanckR2']
@@ -455,10 +1131,15 @@ class FlirImageExtractor:
             print("DEBUG Saving metadata information to:{}".format(path))
         
         try:
-            with open(path, 'wb') as csvfile:
+            # csv wants a binary file on python 2 (else windows adds blank lines) and newline='' on python 3
+            if sys.version_info[0] < 3:
+                csvfile = open(path, 'wb')
+            else:
+                csvfile = open(path, 'w', newline='')
+            with csvfile:
                 writer = csv.DictWriter(csvfile, fieldnames=csv_columns, delimiter = ',')
                 writer.writeheader()
-                data = {key: value for key, value in self.metadata.iteritems()
+                data = {key: value for key, value in metadata.items()
                 if key in csv_columns}
                 writer.writerow(data)
         except IOError:
@@ -466,6 +1147,166 @@ class FlirImageExtractor:
 
 
 
+# Extractor owned by the current batch worker process
+worker_extractor = None
+
+
+def init_batch_worker(extractor_kwargs, prefetched_metadata, profile_path=None, profile_memory=False):
+    """
+    Create the extractor (and its exiftool session) of a batch worker process
+    :param profile_path: trace of --profile, each worker writes its own part of it
+    :param profile_memory: also trace the python heap of every stage
+    :return:
+    """
+    from multiprocessing.util import Finalize
+
+    global worker_extractor
+    worker_extractor = FlirImageExtractor(**extractor_kwargs)
+    worker_extractor.prefetched_metadata = prefetched_metadata
+    Finalize(worker_extractor, worker_extractor.close, exitpriority=10)
+    if profile_path:
+        worker_extractor.profiler = StageProfiler(worker_trace_path(profile_path), trace_memory=profile_memory)
+        worker_extractor.profiler.start()
+        # closed after the extractor, so the last exiftool calls are in the trace
+        Finalize(worker_extractor.profiler, worker_extractor.profiler.close, exitpriority=5)
+
+
+def process_batch_image(image_path):
+    """
+    Run all actions for one image, failures are returned instead of raised
+    so that one bad capture doesn't stop the batch
+    :return: (image path, error message or None)
+    """
+    try:
+        worker_extractor.run_all_actions(image_path.replace("\\","/"))
+    except Exception:
+        return image_path, traceback.format_exc()
+    if worker_extractor.is_debug:
+        print("-------------------------------------------------------")
+    return image_path, None
+
+
+def process_images_incremental(image_path_list, extractor_kwargs, manifest_path, jobs=1, force=False,
+                               profile_path=None, profile_memory=False, pipeline=None):
+    """
+    Run all actions only for the images that changed since the last run recorded in the manifest
+    :param image_path_list:
+    :param extractor_kwargs: FlirImageExtractor arguments used by every worker
+    :param manifest_path: json manifest, created if missing
+    :param jobs: number of worker processes
+    :param force: process every image regardless of the manifest
+    :param profile_path: JSON-lines trace receiving the stages of every image, None disables profiling
+    :param profile_memory: also trace the python heap of every stage
+    :param pipeline: ExtractionPipeline arguments (decoders, writers, queue_size) used when jobs is 1,
+    None processes the images one after the other
+    :return: (list of (image path, error message or None), number of skipped images)
+    """
+    fie = FlirImageExtractor(**extractor_kwargs)
+    manifest = ExtractionManifest(manifest_path, TOOL_VERSION, fie.get_settings(), is_debug=fie.is_debug)
+
+    # the archive is no file of the image: a capture missing from it (archive turned on for an
+    # extracted folder, archive folder emptied...) is only archived when the files are up to date
+    archived = archived_captures(fie.archive_dir) if OUTPUT_ARCHIVE in fie.outputs else None
+
+    outdated_image_path_list = []
+    unarchived_image_path_list = []
+    for image_path in image_path_list:
+        if force or not manifest.is_up_to_date(image_path, fie.get_output_filenames(image_path)):
+            outdated_image_path_list.append(image_path)
+        elif archived is not None and capture_key(image_path) not in archived:
+            unarchived_image_path_list.append(image_path)
+    skipped = len(image_path_list) - len(outdated_image_path_list) - len(unarchived_image_path_list)
+
+    if fie.is_debug:
+        print("DEBUG {} images are up to date, {} will be processed, {} only archived".format(
+            skipped, len(outdated_image_path_list), len(unarchived_image_path_list)))
+
+    results = process_images_batch(outdated_image_path_list, extractor_kwargs, jobs=jobs, profile_path=profile_path,
+                                   profile_memory=profile_memory, pipeline=pipeline)
+    if unarchived_image_path_list:
+        results += process_images_batch(unarchived_image_path_list, dict(extractor_kwargs, outputs=[OUTPUT_ARCHIVE]),
+                                        jobs=jobs, profile_path=profile_path, profile_memory=profile_memory,
+                                        pipeline=pipeline)
+    if fie.archive_dir and (outdated_image_path_list or unarchived_image_path_list):
+        build_archive_index(fie.archive_dir)
+
+    for image_path, error in results:
+        if error is None:
+            manifest.record(image_path, fie.get_output_filenames(image_path))
+        else:
+            manifest.forget(image_path)
+    manifest.save()
+
+    return results, skipped
+
+
+def process_images_batch(image_path_list, extractor_kwargs, jobs=1, profile_path=None, profile_memory=False,
+                         pipeline=None):
+    """
+    Run all actions for every image, fanned out over a pool of processes when jobs > 1.
+    In a single process the reading, decoding and writing of consecutive images overlap when pipeline is given.
+    Results are returned in the order of image_path_list
+    :param image_path_list:
+    :param extractor_kwargs: FlirImageExtractor arguments used by every worker
+    :param jobs: number of worker processes
+    :param profile_path: JSON-lines trace receiving the stages of every image, None disables profiling
+    :param profile_memory: also trace the python heap of every stage
+    :param pipeline: ExtractionPipeline arguments (decoders, writers, queue_size) used when jobs is 1,
+    None processes the images one after the other
+    :return: list of (image path, error message or None)
+    """
+    if not image_path_list:
+        return []
+
+    prefetch_extractor = FlirImageExtractor(**extractor_kwargs)
+    prefetch_extractor.prefetch_metadata(image_path_list)
+    prefetch_extractor.close()
+    prefetched_metadata = prefetch_extractor.prefetched_metadata
+
+    if jobs <= 1:
+        init_batch_worker(extractor_kwargs, prefetched_metadata, profile_path, profile_memory)
+        try:
+            if pipeline is None:
+                return [process_batch_image(image_path) for image_path in image_path_list]
+
+            extraction_pipeline = ExtractionPipeline(worker_extractor, is_debug=worker_extractor.is_debug, **pipeline)
+            results = extraction_pipeline.run([image_path.replace("\\","/") for image_path in image_path_list])
+            return [(image_path, error) for image_path, (_, error) in zip(image_path_list, results)]
+        finally:
+            worker_extractor.close()
+            if worker_extractor.profiler is not None:
+                worker_extractor.profiler.close()
+                merge_worker_traces(profile_path)
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(processes=jobs, initializer=init_batch_worker,
+                                initargs=(extractor_kwargs, prefetched_metadata, profile_path, profile_memory))
+    try:
+        return pool.map(process_batch_image, image_path_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        if profile_path:
+            merge_worker_traces(profile_path)
+
+
+def print_batch_summary(results, elapsed_time, is_debug=False, skipped=0):
+    """
+    Print how many images succeeded, failed or were up to date and the wall time of the batch
+    :return:
+    """
+    failures = [(image_path, error) for image_path, error in results if error is not None]
+
+    for image_path, error in failures:
+        print("Failed to process {}".format(image_path))
+        if is_debug:
+            print(error)
+
+    print("Total number of images: {}, succeeded: {}, failed: {}, up to date: {}, wall time: {:.2f} s".format(
+        len(results) + skipped, len(results) - len(failures), len(failures), skipped, elapsed_time))
+
+
 class SmartFormatter(argparse.HelpFormatter):
 
 
@@ -489,42 +1330,124 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--plot', help='Generate a plot using matplotlib', required=False, action='store_true')
     parser.add_argument('-exif', '--exiftool', type=str, help='Custom path to exiftool', required=False,
                         default='exiftool')
+    parser.add_argument('--backend', type=str, help='R|How the FLIR segments are read.\n'
+                        'native: parse the file in python, fall back to exiftool if it fails (default)\n'
+                        'exiftool: always use exiftool', required=False, default='native', choices=['native', 'exiftool'])
+    parser.add_argument('-w', '--exiftool-workers', type=int, help='R|Number of persistent exiftool processes.\n'
+                        '0 starts a new exiftool for every call', required=False, default=1)
+    parser.add_argument('--lut-cache-size', type=int, help='R|Number of raw to temperature lookup tables kept in memory.\n'
+                        '0 converts every pixel with raw2temp instead', required=False, default=8)
+    parser.add_argument('--lut-cache-dir', type=str, help='Folder where lookup tables are persisted between runs',
+                        required=False, default=None)
     parser.add_argument('-csv', '--extractcsv', help='R|Export the data per pixel encoded as csv file.\n'
                         'Also export the image metadata into a separate csv file.\n',
                         required=False, action='store_true')
     parser.add_argument('-s', '--scale', help='Downscale the original image to match the thermal image\'s dimensions',
                         required=False, action='store_true')
+    parser.add_argument('--palette', type=str, help='Palette of the thermal png (default: inferno)', required=False,
+                        default=DEFAULT_PALETTE, choices=PALETTE_NAMES)
+    parser.add_argument('--temperature-range', type=float, nargs=2, metavar=('MIN', 'MAX'),
+                        help='R|Fixed temperature range in C of the thermal png, so colors are comparable\n'
+                        'between images. Each image is stretched over the whole palette otherwise',
+                        required=False, default=None)
+    parser.add_argument('--outputs', type=str, help='R|Comma separated outputs written for each image (default: all\n'
+                        'but archive, plus archive with --archive): ' + ','.join(OUTPUT_NAMES) + '\n'
+                        'rgb is the embedded jpeg copied as it is', required=False, default=None)
+    parser.add_argument('--jpeg-quality', type=int, help='Quality of the cropped and downscaled rgb jpegs, 1-95 '
+                        '(default: 75)', required=False, default=75)
+    parser.add_argument('--jpeg-optimize', help='Optimize the huffman tables of the rgb jpegs', required=False,
+                        action='store_true')
+    parser.add_argument('--png-compress-level', type=int, help='R|zlib level of the thermal png, 0 (fastest) to 9.\n'
+                        'It is optimized for size by default', required=False, default=None,
+                        choices=range(10))
+    parser.add_argument('--geometry', type=str, help='R|How the rgb image is cropped to the thermal field of view:\n'
+                        'metadata: from the Real2IR and OffsetX/Y of the capture\n'
+                        'legacy: the 504x342 center of a 640x480 image, as tuned for 80x60 cameras\n'
+                        'auto: legacy for 80x60 cameras, metadata otherwise (default)',
+                        required=False, default=GEOMETRY_AUTO, choices=GEOMETRY_MODES)
+    parser.add_argument('--registration', type=str, help='R|How the rgb image is brought to the thermal resolution:\n'
+                        'resize: average the cropped image (default)\n'
+                        'remap: sample it through lookup maps built once per camera',
+                        required=False, default=REGISTRATION_RESIZE, choices=REGISTRATION_MODES)
+    parser.add_argument('--alignment', type=str, help='R|Json file of per camera model Real2IR, OffsetX and OffsetY\n'
+                        'used instead of the ones of the images', required=False, default=None)
+    parser.add_argument('--archive', type=str, help='R|Also store the raw thermal counts, the downscaled rgb image\n'
+                        'and the metadata of every image in this binary, memory mappable archive folder.\n'
+                        'With -act, images already extracted but missing from it are only archived',
+                        required=False, default=None)
+    parser.add_argument('--manifest', type=str, help='Manifest used by -act to skip images whose outputs are up to date',
+                        required=False, default='extraction_manifest.json')
+    parser.add_argument('-f', '--force', help='Process every image with -act, even if it is up to date',
+                        required=False, action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes used with -act', required=False,
+                        default=1)
+    parser.add_argument('--sequential', help='R|Process the images of -act one after the other instead of\n'
+                        'overlapping the reading, decoding and writing of consecutive images', required=False,
+                        action='store_true')
+    parser.add_argument('--decoders', type=int, help='Number of decoder threads of the -act pipeline', required=False,
+                        default=2)
+    parser.add_argument('--writers', type=int, help='Number of writer threads of the -act pipeline', required=False,
+                        default=2)
+    parser.add_argument('--queue-size', type=int, help='R|Images waiting between two stages of the -act pipeline,\n'
+                        'bounds its memory use', required=False, default=8)
+    parser.add_argument('--profile', type=str, help='R|Time every stage (wall, CPU, I/O, exiftool calls, memory)\n'
+                        'into this JSON-lines trace and print a summary table', required=False, default=None)
+    parser.add_argument('--profile-memory', help='R|Also record the peak python heap of every stage with --profile\n'
+                        '(tracemalloc, slows the run down)', required=False, action='store_true')
     parser.add_argument('-d', '--debug', help='Set the debug flag', required=False,
                         action='store_true')
     args = parser.parse_args()
+
+    outputs = None
+    if args.outputs is not None:
+        outputs = [output.strip() for output in args.outputs.split(',') if output.strip()]
+        unknown_outputs = set(outputs) - set(OUTPUT_NAMES)
+        if unknown_outputs:
+            parser.error("unknown --outputs {}, choose from {}".format(
+                ", ".join(sorted(unknown_outputs)), ",".join(OUTPUT_NAMES)))
+        if OUTPUT_ARCHIVE in outputs and not args.archive:
+            parser.error("the archive output needs --archive")
     
     if args.debug:
         print("DEBUG Recommended Python version: 2.7")
         print("DEBUG Your system's Python version: "+str(sys.version_info[0])+"."+str(sys.version_info[1]))
 
-    fie = FlirImageExtractor(exiftool_path=args.exiftool, is_debug=args.debug)
+    extractor_kwargs = dict(exiftool_path=args.exiftool, is_debug=args.debug, backend=args.backend,
+                            exiftool_workers=args.exiftool_workers, lut_cache_size=args.lut_cache_size,
+                            lut_cache_dir=args.lut_cache_dir, archive_dir=args.archive,
+                            palette=args.palette, temperature_range=args.temperature_range, outputs=outputs,
+                            jpeg_quality=args.jpeg_quality, jpeg_optimize=args.jpeg_optimize,
+                            png_compress_level=args.png_compress_level, geometry=args.geometry,
+                            registration=args.registration, alignment_file=args.alignment)
     # fie.parse_weather_data()
+
+    if args.profile:
+        # start a new trace, the workers append to it
+        open(args.profile, 'w').close()
     
     if args.actions:
         # image_path_list = glob.glob("images/*-*-*/Camera_*/*.jpg")
         image_path_list = glob.glob("images/*.jpg")
-        
-        for image_path in image_path_list:
-            # fie.check_if_metadata_present(image_path)
-            fie.process_image(image_path.replace("\\","/"))
-            fie.create_subfolder()
-            fie.crop_rgb_image()
-            fie.image_downscale()
-            fie.export_data_to_csv()
-            fie.image_metadata_to_csv()
-            fie.save_images()
-            if args.debug:
-                print ("-------------------------------------------------------")
-        
-        print("Total number of images: ",len(image_path_list))
+
+        pipeline = None
+        if not args.sequential:
+            pipeline = dict(decoders=args.decoders, writers=args.writers, queue_size=args.queue_size)
+
+        start_time = time.time()
+        results, skipped = process_images_incremental(image_path_list, extractor_kwargs, args.manifest, jobs=args.jobs,
+                                                      force=args.force, profile_path=args.profile,
+                                                      profile_memory=args.profile_memory, pipeline=pipeline)
+        print_batch_summary(results, time.time() - start_time, is_debug=args.debug, skipped=skipped)
+        if args.profile:
+            print_summary(summarize(read_trace(args.profile)))
         # print("Total number of images with metadata present in the xlsx : ",fie.is_debug_number_of_images_with_metadata)
         
     else:
+        profiler = None
+        if args.profile:
+            profiler = StageProfiler(args.profile, trace_memory=args.profile_memory)
+            profiler.start()
+        fie = FlirImageExtractor(profiler=profiler, **extractor_kwargs)
         #fie.check_if_metadata_present(args.input)
         fie.process_image(args.input)
         fie.create_subfolder()
@@ -537,3 +1460,11 @@ if __name__ == '__main__':
             fie.image_metadata_to_csv()
             fie.export_data_to_csv()
         fie.save_images()
+        if fie.archive_writer is not None:
+            fie.add_to_archive()
+        fie.close()
+        if fie.archive_dir:
+            build_archive_index(fie.archive_dir)
+        if profiler is not None:
+            profiler.close()
+            profiler.print_summary()
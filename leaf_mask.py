@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import glob
+import hashlib
+import os
+import os.path
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+# Leaf masks of a capture folder, the most recently modified one is used, this order breaks ties
+MASK_FILE_NAMES = OrderedDict([('bits', 'mask.bits'), ('rle', 'mask.rle'), ('png', 'mask.png'), ('txt', 'mask.txt')])
+MASK_FORMATS = list(MASK_FILE_NAMES)
+
+# Header of the binary masks: magic, height, width and, for the resized mask cache, the sha1 of the source mask
+HEADER = struct.Struct('<4sII20s')
+BITS_MAGIC = b'MSKB'
+RLE_MAGIC = b'MSKR'
+CACHE_MAGIC = b'MSKC'
+NO_DIGEST = b'\x00' * 20
+
+
+def find_mask(directory):
+    """
+    A converted mask left next to its source goes stale as soon as the source is edited,
+    so when a folder has several masks the most recently modified one wins
+    :return: path of the mask of the folder, None if it has none
+    """
+    newest_path = None
+    newest_mtime = None
+    for file_name in MASK_FILE_NAMES.values():
+        path = os.path.join(directory, file_name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (IOError, OSError):
+            continue
+        if newest_mtime is None or mtime > newest_mtime:
+            newest_path, newest_mtime = path, mtime
+    return newest_path
+
+
+def mask_format(path):
+    """
+    :return: one of MASK_FORMATS, from the extension of the file
+    """
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension not in MASK_FILE_NAMES:
+        raise ValueError("Unknown mask format: {}".format(path))
+    return extension
+
+
+def read_header(data, magic):
+    """
+    :return: (height, width, digest) of a binary mask
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated mask file")
+    file_magic, height, width, digest = HEADER.unpack_from(data, 0)
+    if file_magic != magic:
+        raise ValueError("Not a {} mask file".format(magic.decode('ascii')))
+    return height, width, digest
+
+
+def unpack_bits(data, magic=BITS_MAGIC):
+    """
+    :return: (bool mask, digest stored in the header)
+    """
+    height, width, digest = read_header(data, magic)
+    bits = np.frombuffer(data, dtype=np.uint8, offset=HEADER.size)
+    if bits.shape[0] * 8 < height * width:
+        raise ValueError("Truncated mask file")
+    return np.unpackbits(bits, count=height * width).reshape(height, width).view(bool), digest
+
+
+def pack_bits(mask, magic=BITS_MAGIC, digest=NO_DIGEST):
+    """
+    :param mask: 2D array, non zero for leaves
+    :return: bytes, the header followed by one bit per pixel in row major order
+    """
+    height, width = mask.shape
+    return HEADER.pack(magic, height, width, digest) + np.packbits(np.asarray(mask) != 0).tobytes()
+
+
+def rle_decode(data):
+    """
+    :return: bool mask
+    """
+    height, width, _ = read_header(data, RLE_MAGIC)
+    runs = np.frombuffer(data, dtype='<u4', offset=HEADER.size)
+    if int(runs.sum()) != height * width:
+        raise ValueError("The runs don't cover the mask")
+    # runs alternate between background and leaves, starting with background
+    values = np.arange(runs.shape[0]) % 2 == 1
+    return np.repeat(values, runs).reshape(height, width)
+
+
+def rle_encode(mask):
+    """
+    Run length encode a mask, compact for the few large leaf areas of a typical capture
+    :param mask: 2D array, non zero for leaves
+    :return: bytes, the header followed by uint32 run lengths alternating background and leaves
+    """
+    height, width = mask.shape
+    flat = (np.asarray(mask) != 0).ravel()
+    # positions where the value changes, the first run is background even if empty
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate([[0], changes, [flat.shape[0]]])
+    runs = np.diff(boundaries)
+    if flat.shape[0] and flat[0]:
+        runs = np.concatenate([[0], runs])
+    return HEADER.pack(RLE_MAGIC, height, width, NO_DIGEST) + runs.astype('<u4').tobytes()
+
+
+def read_mask(path):
+    """
+    Read a mask in any of MASK_FORMATS
+    :return: 2D array, non zero for leaves: float64 values of a text mask, 0/1 uint8 otherwise
+    """
+    file_format = mask_format(path)
+    if file_format == 'txt':
+        return np.loadtxt(path)
+    if file_format == 'png':
+        from PIL import Image
+
+        with Image.open(path) as image:
+            return (np.asarray(image.convert('L')) != 0).view(np.uint8)
+
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    if file_format == 'rle':
+        return rle_decode(data).view(np.uint8)
+    return unpack_bits(data)[0].view(np.uint8)
+
+
+def write_mask(path, mask):
+    """
+    Write a mask in the format given by the extension of path
+    :param mask: 2D array, non zero for leaves
+    :return:
+    """
+    file_format = mask_format(path)
+    if file_format == 'txt':
+        np.savetxt(path, mask, fmt='%d')
+    elif file_format == 'png':
+        from PIL import Image
+
+        # 1 bit per pixel
+        Image.fromarray(np.asarray(mask) != 0).save(path, optimize=True)
+    else:
+        with open(path, 'wb') as fh:
+            fh.write(rle_encode(mask) if file_format == 'rle' else pack_bits(mask))
+
+
+def file_digest(path):
+    """
+    :return: sha1 of the content of the file
+    """
+    with open(path, 'rb') as fh:
+        return hashlib.sha1(fh.read()).digest()
+
+
+def resized_mask_cache_path(mask_path, thermal_size):
+    """
+    :param thermal_size: (width, height)
+    :return: path of the cached resized mask, next to the mask
+    """
+    width, height = thermal_size
+    return os.path.join(os.path.dirname(mask_path), 'mask_{}x{}.cache'.format(height, width))
+
+
+def read_packed_bits(path, magic):
+    """
+    :return: (bool mask, digest stored in the header), None if the file is missing or not a valid magic file
+    """
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        return unpack_bits(data, magic)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_packed_bits(path, mask, magic, digest=NO_DIGEST):
+    """
+    Write to a temporary file first, so parallel readers never see half a file
+    :return:
+    """
+    tmp_path = path + '.{}.tmp'.format(os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(pack_bits(mask, magic, digest))
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_resized_mask_cache(cache_path, digest, thermal_size):
+    """
+    :param digest: sha1 of the source mask
+    :return: bool mask of the thermal size, None if there is no cache or it is stale
+    """
+    cached = read_packed_bits(cache_path, CACHE_MAGIC)
+    if cached is None:
+        return None
+
+    labels, cached_digest = cached
+    if cached_digest != digest or labels.shape != (thermal_size[1], thermal_size[0]):
+        return None
+    return labels
+
+
+def write_resized_mask_cache(cache_path, digest, labels):
+    """
+    :return:
+    """
+    try:
+        write_packed_bits(cache_path, labels, CACHE_MAGIC, digest)
+    except (IOError, OSError):
+        # without the cache the mask is resized again next time
+        pass
+
+
+def resize_mask(mask, thermal_size):
+    """
+    Bring a mask of the cropped rgb image to the thermal resolution
+    :param thermal_size: (width, height)
+    :return: float64 array, non zero for leaves
+    """
+    import cv2 as cv
+
+    return cv.resize(np.asarray(mask, dtype=np.float64), dsize=tuple(thermal_size), interpolation=cv.INTER_CUBIC)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert leaf masks between the text, bit packed, run length encoded '
+                                                 'and 1 bit png formats')
+    parser.add_argument('-i', '--input', type=str, nargs='+', help='Masks to convert. Ex. images/*/mask.txt',
+                        required=False, default=None)
+    parser.add_argument('-act', '--actions', help='Convert the mask of every folder of images/*-*-*/Camera_*/*/',
+                        required=False, action='store_true')
+    parser.add_argument('-f', '--format', type=str, help='Format written next to each mask (default: bits)',
+                        required=False, default='bits', choices=MASK_FORMATS)
+    parser.add_argument('--remove', help='Remove the converted masks, the new ones are used first anyway',
+                        required=False, action='store_true')
+    parser.add_argument('-d', '--debug', help='Set the debug flag', required=False, action='store_true')
+    args = parser.parse_args()
+
+    mask_paths = []
+    for pattern in args.input or []:
+        mask_paths += glob.glob(pattern)
+    if args.actions:
+        mask_paths += [path for path in (find_mask(folder) for folder in glob.glob("images/*-*-*/Camera_*/*/"))
+                       if path is not None]
+    if not mask_paths:
+        parser.error("no mask to convert, give -i or -act")
+
+    converted = 0
+    for mask_path in sorted(set(mask_paths)):
+        output_path = os.path.join(os.path.dirname(mask_path), MASK_FILE_NAMES[args.format])
+        if os.path.abspath(output_path) == os.path.abspath(mask_path):
+            continue
+        mask = read_mask(mask_path)
+        write_mask(output_path, mask)
+        converted += 1
+        if args.debug:
+            print("DEBUG {} ({} bytes) -> {} ({} bytes)".format(mask_path, os.path.getsize(mask_path), output_path,
+                                                                os.path.getsize(output_path)))
+        if args.remove:
+            os.remove(mask_path)
+
+    print("Converted {} masks to {}".format(converted, args.format))
@@ -9,10 +9,7 @@ import json
 import os
 import re
 import csv
-from PIL import Image
 from math import sqrt, exp, log
-from matplotlib import cm
-from matplotlib import pyplot as plt
 import numpy as np
 # from pysal.weights.Distance import DistanceBand
 
@@ -48,9 +45,6 @@ class LeafRecognitionBaseline:
         self.rgb_image_np = self.get_image_np(self.cropped_rgb_img_filename)
         self.thermal_image_np = self.get_image_np(self.thermal_img_filename)
 
-        # Removing the alpha channel of the png thermal image
-        self.thermal_image_np = self.thermal_image_np[:, :, :-1]
-
     def calculate_vegetation_index(self):
 
         vegetation_index = np.empty((self.rgb_image_np.shape[0], self.rgb_image_np.shape[1]), dtype='uint16')
@@ -79,7 +73,10 @@ class LeafRecognitionBaseline:
 
     def get_image_np(self, image_path):
 
-        visual_img = Image.open(image_path)
+        from PIL import Image
+
+        # thermal pngs are palettized (older ones RGBA), always work on RGB
+        visual_img = Image.open(image_path).convert('RGB')
         visual_np = np.array(visual_img)
 
         return visual_np
@@ -89,6 +86,8 @@ class LeafRecognitionBaseline:
         Plot the rgb + thermal image (easy to see the pixel values)
         :return:
         """
+        from matplotlib import pyplot as plt
+
         rgb_np = self.rgb_image_np
         thermal_np = self.thermal_image_np
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import hashlib
+import os
+import os.path
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Raw2TempLutCache:
+    """
+    raw2temp is a pure function of the 16 bit raw count once the calibration
+    parameters are fixed, so every distinct parameter set gets a 65536 entry
+    lookup table and an image is converted with a single gather.
+
+    The tables are kept in a bounded LRU cache and can optionally be persisted
+    as .npy files, so consecutive captures from the same camera under the same
+    weather conditions skip the conversion entirely.
+    """
+
+    # Order of the raw2temp keyword arguments that make up the cache key
+    PARAMETER_NAMES = ['E', 'OD', 'RTemp', 'ATemp', 'IRWTemp', 'IRT', 'RH', 'PR1', 'PB', 'PF', 'PO', 'PR2']
+
+    def __init__(self, convert_function, max_entries=8, cache_dir=None, is_debug=False):
+        """
+        :param convert_function: raw2temp(raw_array, **parameters)
+        :param max_entries: number of tables kept in memory
+        :param cache_dir: folder for persisted tables, None keeps them in memory only
+        """
+        self.convert_function = convert_function
+        self.max_entries = max(1, max_entries)
+        self.cache_dir = cache_dir
+        self.is_debug = is_debug
+        self.luts = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    pass
+
+    def make_key(self, parameters):
+        """
+        :param parameters: dictionary of raw2temp keyword arguments
+        :return: hashable tuple of the parameter values
+        """
+        return tuple(float(parameters[name]) for name in Raw2TempLutCache.PARAMETER_NAMES)
+
+    def get_lut(self, parameters):
+        """
+        Return the lookup table for the given calibration parameters,
+        building (or loading) it on the first request
+        :param parameters: dictionary of raw2temp keyword arguments
+        :return: float64 array of 65536 temperatures in C
+        """
+        key = self.make_key(parameters)
+
+        with self.lock:
+            if key in self.luts:
+                self.hits += 1
+                lut = self.luts.pop(key)
+                self.luts[key] = lut
+                return lut
+            self.misses += 1
+
+        lut = self.load_lut(key)
+        if lut is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                lut = self.convert_function(np.arange(65536, dtype=np.uint16), **parameters)
+            lut.setflags(write=False)
+            self.save_lut(key, lut)
+            if self.is_debug:
+                print("DEBUG Built raw2temp lookup table for {}".format(key))
+
+        with self.lock:
+            self.luts[key] = lut
+            while len(self.luts) > self.max_entries:
+                self.luts.popitem(last=False)
+
+        return lut
+
+    def convert(self, raw, parameters):
+        """
+        Convert an array of raw counts to temperatures in C
+        :param raw: integer array of raw sensor counts
+        :param parameters: dictionary of raw2temp keyword arguments
+        :return:
+        """
+        return np.take(self.get_lut(parameters), raw)
+
+    def lut_path(self, key):
+        """
+        :return: path of the persisted table for the key
+        """
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'raw2temp_lut_{}.npy'.format(digest))
+
+    def load_lut(self, key):
+        """
+        :return: the persisted table, or None
+        """
+        if not self.cache_dir:
+            return None
+
+        path = self.lut_path(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            lut = np.load(path)
+        except (IOError, ValueError):
+            return None
+        if lut.shape != (65536,):
+            return None
+
+        lut.setflags(write=False)
+        return lut
+
+    def save_lut(self, key, lut):
+        """
+        Persist a table, written to a temporary file first so readers never see half a file
+        :return:
+        """
+        if not self.cache_dir:
+            return
+
+        path = self.lut_path(key)
+        tmp_path = path + '.{}.tmp'.format(os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fh:
+                np.save(fh, lut)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.rename(tmp_path, path)
+        except (IOError, OSError):
+            if self.is_debug:
+                print("DEBUG Unable to persist lookup table to {}".format(path))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+# The camera the tools were written for: a 80x60 thermal core next to a 640x480 visual camera,
+# whose field of view is the 504x342 center of the visual image
+LEGACY_THERMAL_SIZE = (80, 60)
+LEGACY_VISUAL_SIZE = (640, 480)
+LEGACY_CROP_SIZE = (504, 342)
+# Visual to IR field of view ratio assumed when the capture doesn't store one
+DEFAULT_REAL2IR = float(LEGACY_VISUAL_SIZE[0]) / LEGACY_CROP_SIZE[0]
+
+# Geometry modes
+GEOMETRY_AUTO = 'auto'
+GEOMETRY_LEGACY = 'legacy'
+GEOMETRY_METADATA = 'metadata'
+GEOMETRY_MODES = [GEOMETRY_AUTO, GEOMETRY_LEGACY, GEOMETRY_METADATA]
+
+
+def metadata_size(metadata, width_tag, height_tag):
+    """
+    :return: (width, height) stored in the metadata, None if the tags are missing
+    """
+    try:
+        return int(metadata[width_tag]), int(metadata[height_tag])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def metadata_float(metadata, tag, default=None):
+    try:
+        return float(metadata[tag])
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+class SensorGeometry:
+    """
+    Where the thermal image lies inside the visual image of a capture.
+
+    The part of the visual image seen by the thermal core is cropped and then
+    resized to the thermal resolution, so both line up pixel for pixel. With the
+    FLIR picture in picture parameters the crop is the visual width divided by
+    Real2IR, with the aspect ratio of the thermal image, centered on the middle
+    of the visual image shifted by OffsetX/OffsetY visual pixels.
+
+    legacy keeps the fixed 504x342 center crop of the 640x480 images (scaled for
+    other visual sizes), auto uses it for the 80x60 cameras it was tuned for, so
+    their masks and csv files don't change, and the metadata for every other sensor.
+    """
+
+    def __init__(self, thermal_size, visual_size, real2ir=None, offset=(0, 0), mode=GEOMETRY_AUTO):
+        """
+        :param thermal_size: (width, height) of the raw thermal image
+        :param visual_size: (width, height) of the embedded visual image
+        :param real2ir: visual to IR field of view ratio, None when unknown
+        :param offset: (x, y) shift of the IR field of view from the visual center, in visual pixels
+        :param mode: GEOMETRY_AUTO, GEOMETRY_LEGACY or GEOMETRY_METADATA
+        """
+        if mode not in GEOMETRY_MODES:
+            raise ValueError("Unknown geometry mode: {}".format(mode))
+
+        self.thermal_size = tuple(int(v) for v in thermal_size)
+        self.visual_size = tuple(int(v) for v in visual_size)
+        self.real2ir = real2ir if real2ir and real2ir > 0 else None
+        self.offset = tuple(int(v) for v in offset)
+        self.mode = mode
+
+    pass
+
+    @staticmethod
+    def from_metadata(metadata, thermal_size=None, visual_size=None, mode=GEOMETRY_AUTO):
+        """
+        :param metadata: exiftool style metadata of the capture
+        :param thermal_size: (width, height), read from RawThermalImageWidth/Height if None
+        :param visual_size: (width, height), read from EmbeddedImageWidth/Height if None
+        :return: SensorGeometry
+        """
+        if thermal_size is None:
+            thermal_size = metadata_size(metadata, 'RawThermalImageWidth', 'RawThermalImageHeight')
+        if visual_size is None:
+            visual_size = metadata_size(metadata, 'EmbeddedImageWidth', 'EmbeddedImageHeight')
+        if thermal_size is None or visual_size is None:
+            raise ValueError("The image sizes are neither given nor in the metadata")
+
+        offset = (metadata_float(metadata, 'OffsetX', 0), metadata_float(metadata, 'OffsetY', 0))
+        return SensorGeometry(thermal_size, visual_size, real2ir=metadata_float(metadata, 'Real2IR'), offset=offset,
+                              mode=mode)
+
+    def __repr__(self):
+        return "SensorGeometry(thermal={}, visual={}, real2ir={}, offset={}, crop={})".format(
+            self.thermal_size, self.visual_size, self.real2ir, self.offset, self.crop_box())
+
+    def uses_legacy_crop(self):
+        if self.mode == GEOMETRY_LEGACY:
+            return True
+        if self.mode == GEOMETRY_METADATA:
+            return False
+        return self.thermal_size == LEGACY_THERMAL_SIZE
+
+    def crop_box(self):
+        """
+        :return: (left, top, width, height) of the part of the visual image seen by the thermal core
+        """
+        visual_width, visual_height = self.visual_size
+
+        if self.uses_legacy_crop():
+            width = int(round(LEGACY_CROP_SIZE[0] * visual_width / float(LEGACY_VISUAL_SIZE[0])))
+            height = int(round(LEGACY_CROP_SIZE[1] * visual_height / float(LEGACY_VISUAL_SIZE[1])))
+            # same rounding as the former crop_center
+            return visual_width // 2 - width // 2, visual_height // 2 - height // 2, width, height
+
+        thermal_width, thermal_height = self.thermal_size
+        width = visual_width / (self.real2ir or DEFAULT_REAL2IR)
+        height = width * thermal_height / thermal_width
+        # the field of view can't be larger than the visual image
+        scale = min(1.0, visual_width / width, visual_height / height)
+        width = int(round(width * scale))
+        height = int(round(height * scale))
+
+        left = int(round(visual_width / 2.0 + self.offset[0] - width / 2.0))
+        top = int(round(visual_height / 2.0 + self.offset[1] - height / 2.0))
+        left = min(max(left, 0), visual_width - width)
+        top = min(max(top, 0), visual_height - height)
+        return left, top, width, height
+
+    def crop(self, visual_np):
+        """
+        :param visual_np: visual image of visual_size
+        :return: view of the part seen by the thermal core
+        """
+        left, top, width, height = self.crop_box()
+        return visual_np[top:top + height, left:left + width]
+
+    def downscale(self, cropped_visual_np):
+        """
+        Resize the cropped visual image to the thermal resolution
+        :return:
+        """
+        import cv2 as cv
+
+        return cv.resize(cropped_visual_np, self.thermal_size, interpolation=cv.INTER_AREA)
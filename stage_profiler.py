@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import functools
+import glob
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Process wide event counters, stages record how much they grew while they were open
+counters = {'subprocesses': 0, 'exiftool_calls': 0}
+counters_lock = threading.Lock()
+
+SUMMARY_COLUMNS = ['calls', 'wall_s', 'cpu_s', 'read_bytes', 'write_bytes', 'subprocesses', 'exiftool_calls']
+
+
+def count_event(name, n=1):
+    """
+    Increment a process wide counter, ex. count_event('subprocesses') when exiftool is spawned
+    :return:
+    """
+    with counters_lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def read_io_counters():
+    """
+    Bytes read and written by the process so far, files and pipes included
+    :return: (read bytes, written bytes), None when the platform doesn't report them
+    """
+    if os.path.isfile('/proc/self/io'):
+        values = {}
+        with open('/proc/self/io', 'r') as fh:
+            for line in fh:
+                name, _, value = line.partition(':')
+                values[name] = int(value)
+        return values['rchar'], values['wchar']
+
+    if sys.platform == 'win32':
+        import ctypes
+
+        class IoCounters(ctypes.Structure):
+            _fields_ = [(name, ctypes.c_ulonglong) for name in
+                        ['ReadOperationCount', 'WriteOperationCount', 'OtherOperationCount',
+                         'ReadTransferCount', 'WriteTransferCount', 'OtherTransferCount']]
+
+        io_counters = IoCounters()
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.GetProcessIoCounters(kernel32.GetCurrentProcess(), ctypes.byref(io_counters)):
+            return io_counters.ReadTransferCount, io_counters.WriteTransferCount
+
+    return None
+
+
+def read_peak_rss():
+    """
+    :return: peak resident set size of the process in bytes, None when the platform doesn't report it
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    if sys.platform == 'win32':
+        import ctypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+                       [(name, ctypes.c_size_t) for name in
+                        ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                         'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage',
+                         'PeakPagefileUsage']]
+
+        memory_counters = ProcessMemoryCounters()
+        memory_counters.cb = ctypes.sizeof(memory_counters)
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.K32GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(memory_counters),
+                                            memory_counters.cb):
+            return memory_counters.PeakWorkingSetSize
+
+    return None
+
+
+class NullStage:
+    """
+    Stage used when profiling is off, does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """
+    One open stage: snapshots the clocks and counters on enter and writes the difference on exit
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.python_peak = 0
+
+    pass
+
+    def __enter__(self):
+        stack = self.profiler.get_stack()
+        if self.profiler.trace_memory and tracemalloc.is_tracing():
+            # keep the peak reached so far by the enclosing stage before resetting it for this one
+            if stack:
+                stack[-1].python_peak = max(stack[-1].python_peak, tracemalloc.get_traced_memory()[1])
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        stack.append(self)
+
+        self.io_counters = read_io_counters()
+        with counters_lock:
+            self.counters = dict(counters)
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+
+        record = OrderedDict()
+        record['stage'] = self.name
+        record['item'] = self.profiler.get_item()
+        record['pid'] = os.getpid()
+        record['wall_s'] = round(wall, 6)
+        record['cpu_s'] = round(cpu, 6)
+
+        io_counters = read_io_counters()
+        if io_counters is not None and self.io_counters is not None:
+            record['read_bytes'] = io_counters[0] - self.io_counters[0]
+            record['write_bytes'] = io_counters[1] - self.io_counters[1]
+
+        with counters_lock:
+            for name, value in counters.items():
+                record[name] = value - self.counters.get(name, 0)
+
+        stack = self.profiler.get_stack()
+        stack.pop()
+        if self.profiler.trace_memory and tracemalloc.is_tracing():
+            self.python_peak = max(self.python_peak, tracemalloc.get_traced_memory()[1])
+            record['python_peak_bytes'] = self.python_peak
+            if stack:
+                stack[-1].python_peak = max(stack[-1].python_peak, self.python_peak)
+
+        record['peak_rss_bytes'] = read_peak_rss()
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+
+        self.profiler.record(record)
+        return False
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time, bytes read and written, subprocesses spawned,
+    exiftool calls and peak memory of named stages.
+
+    Every closed stage becomes one line of a JSON-lines trace, summary() aggregates
+    them per stage name. Stages can be nested, each one reports its inclusive cost.
+
+        with StageProfiler('trace.jsonl') as profiler:
+            fie = FlirImageExtractor(profiler=profiler)
+            with profiler.stage('my_stage'):
+                ...
+        profiler.print_summary()
+
+    CPU time and the I/O counters are those of the whole process, so stages of
+    different threads overlapping in time see each other's work. The CPU time of
+    the exiftool processes is not included, their share only shows up in the wall time.
+    """
+
+    def __init__(self, trace_path=None, trace_memory=False):
+        """
+        :param trace_path: JSON-lines file the stages are appended to, None keeps them in memory only
+        :param trace_memory: also record the peak python heap of every stage with tracemalloc (slower)
+        """
+        self.trace_path = trace_path
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.trace_file = None
+        self.records = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.started_tracemalloc = False
+        self.start_time = None
+        # clocks and counters when start() was called, the total record is the difference
+        self.cpu_start = None
+        self.io_counters = None
+        self.counters = None
+
+    pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def start(self):
+        """
+        Open the trace file and start tracing memory if requested
+        :return:
+        """
+        if self.trace_path and self.trace_file is None:
+            self.trace_file = open(self.trace_path, 'a')
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.io_counters = read_io_counters()
+        with counters_lock:
+            self.counters = dict(counters)
+        self.cpu_start = time.process_time()
+        self.start_time = time.perf_counter()
+
+    def close(self):
+        """
+        Write a last 'total' record covering the run since start() and close the trace file
+        :return:
+        """
+        if self.start_time is not None:
+            record = OrderedDict()
+            record['stage'] = 'total'
+            record['item'] = None
+            record['pid'] = os.getpid()
+            record['wall_s'] = round(time.perf_counter() - self.start_time, 6)
+            record['cpu_s'] = round(time.process_time() - self.cpu_start, 6)
+            io_counters = read_io_counters()
+            if io_counters is not None and self.io_counters is not None:
+                record['read_bytes'] = io_counters[0] - self.io_counters[0]
+                record['write_bytes'] = io_counters[1] - self.io_counters[1]
+            with counters_lock:
+                for name, value in counters.items():
+                    record[name] = value - self.counters.get(name, 0)
+            record['peak_rss_bytes'] = read_peak_rss()
+            self.record(record)
+            self.start_time = None
+
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+    def get_stack(self):
+        """
+        :return: stages currently open in this thread, innermost last
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def stage(self, name):
+        """
+        :return: context manager timing the code of the with block as the given stage
+        """
+        return Stage(self, name)
+
+    def set_item(self, item):
+        """
+        Name of what the current thread is processing (ex. the image path), stored with every stage record
+        :return:
+        """
+        self.local.item = item
+
+    def get_item(self):
+        return getattr(self.local, 'item', None)
+
+    def record(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(record) + '\n')
+                self.trace_file.flush()
+
+    def summary(self):
+        return summarize(self.records)
+
+    def print_summary(self):
+        print_summary(self.summary())
+
+
+def profile_stage(profiler, name):
+    """
+    :param profiler: StageProfiler or None
+    :return: the stage context manager of the profiler, a no-op one if profiling is off
+    """
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name)
+
+
+def profiled(name):
+    """
+    Decorator timing a method as the given stage when its instance has a profiler
+    :param name: stage name
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return method(self, *args, **kwargs)
+            with self.profiler.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_trace(trace_path):
+    """
+    :return: list of the records of a JSON-lines trace
+    """
+    records = []
+    with open(trace_path, 'r') as fh:
+        for line in fh:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def merge_traces(trace_path, part_paths):
+    """
+    Append the traces written by worker processes to trace_path and delete them
+    :return:
+    """
+    with open(trace_path, 'a') as out:
+        for part_path in part_paths:
+            with open(part_path, 'r') as fh:
+                out.write(fh.read())
+            os.remove(part_path)
+
+
+def worker_trace_path(trace_path):
+    """
+    Trace file of the current worker process, merged into trace_path by merge_worker_traces
+    """
+    return '{}.{}.part'.format(trace_path, os.getpid())
+
+
+def merge_worker_traces(trace_path):
+    merge_traces(trace_path, sorted(glob.glob(glob.escape(trace_path) + '.*.part')))
+
+
+def summarize(records):
+    """
+    Aggregate stage records by stage name
+    :return: OrderedDict stage -> totals, the slowest stage first
+    """
+    stages = {}
+    for record in records:
+        totals = stages.setdefault(record['stage'], dict((column, 0) for column in SUMMARY_COLUMNS))
+        totals['calls'] += 1
+        for column in SUMMARY_COLUMNS[1:]:
+            if record.get(column) is not None:
+                totals[column] += record[column]
+        peak_rss = record.get('peak_rss_bytes')
+        if peak_rss is not None:
+            totals['peak_rss_bytes'] = max(totals.get('peak_rss_bytes', 0), peak_rss)
+        python_peak = record.get('python_peak_bytes')
+        if python_peak is not None:
+            totals['python_peak_bytes'] = max(totals.get('python_peak_bytes', 0), python_peak)
+
+    return OrderedDict(sorted(stages.items(), key=lambda item: (item[0] == 'total', -item[1]['wall_s'])))
+
+
+def print_summary(summary):
+    """
+    Print the summary as a table, sizes in MB
+    :return:
+    """
+    mb = 1024.0 * 1024.0
+    print("{:<28} {:>7} {:>10} {:>10} {:>10} {:>9} {:>9} {:>6} {:>8} {:>9} {:>9}".format(
+        'stage', 'calls', 'wall s', 'wall ms', 'cpu s', 'read MB', 'write MB', 'procs', 'exiftool', 'rss MB',
+        'heap MB'))
+    for stage, totals in summary.items():
+        print("{:<28} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>9.2f} {:>9.2f} {:>6} {:>8} {:>9} {:>9}".format(
+            stage, totals['calls'], totals['wall_s'], 1000.0 * totals['wall_s'] / totals['calls'], totals['cpu_s'],
+            totals['read_bytes'] / mb, totals['write_bytes'] / mb, totals['subprocesses'], totals['exiftool_calls'],
+            '{:.1f}'.format(totals['peak_rss_bytes'] / mb) if 'peak_rss_bytes' in totals else '-',
+            '{:.1f}'.format(totals['python_peak_bytes'] / mb) if 'python_peak_bytes' in totals else '-'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the per stage summary of a --profile trace')
+    parser.add_argument('trace', type=str, help='JSON-lines trace written with --profile')
+    parser.add_argument('--json', help='Print the summary as json instead of a table', required=False,
+                        action='store_true')
+    args = parser.parse_args()
+
+    summary = summarize(read_trace(args.trace))
+    if args.json:
+        print(json.dumps(summary, indent=1))
+    else:
+        print_summary(summary)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import glob
+import json
+import os
+import os.path
+import time
+
+import numpy as np
+
+ARCHIVE_VERSION = 1
+ARCHIVE_INDEX_FILENAME = 'index.json'
+
+
+def capture_key(flir_img_filename):
+    """
+    Name of a capture inside the archive, the image path with "/" separators
+    ex. images/2019-08-28/Camera_1/img_20190828_121055_010.jpg
+    """
+    return os.path.normpath(flir_img_filename).replace("\\", "/")
+
+
+def to_json_value(value):
+    """
+    json.dump fallback for the numpy scalars found in metadata
+    """
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def write_json(path, content):
+    """
+    Write a json file through a temporary file so readers never see half of it
+    :return:
+    """
+    tmp_path = path + '.{}.tmp'.format(os.getpid())
+    with open(tmp_path, 'w') as fh:
+        json.dump(content, fh, indent=1, sort_keys=True, default=to_json_value)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+class ThermalArchiveWriter:
+    """
+    Collects the raw thermal counts, the downscaled rgb image and the metadata of
+    many captures and writes them as shards of a binary archive folder.
+
+    A shard holds up to shard_size captures of the same size as two stacked .npy
+    files (<shard>_raw.npy uint16, <shard>_rgb.npy uint8) and a <shard>.json file
+    listing the captures with their metadata and raw2temp parameters. Shard names
+    are unique per process, so several batch workers can write to the same archive;
+    build_archive_index() then merges the shards into index.json.
+    """
+
+    def __init__(self, archive_dir, shard_size=256, is_debug=False):
+        """
+        :param archive_dir: archive folder, created if missing
+        :param shard_size: maximum number of captures per shard
+        """
+        self.archive_dir = archive_dir
+        self.shard_size = max(1, shard_size)
+        self.is_debug = is_debug
+        # (raw shape, rgb shape) -> list of pending captures
+        self.pending = {}
+        self.shard_count = 0
+
+        if not os.path.isdir(self.archive_dir):
+            try:
+                os.makedirs(self.archive_dir)
+            except OSError:
+                # created meanwhile by another worker
+                if not os.path.isdir(self.archive_dir):
+                    raise
+
+    pass
+
+    def add(self, flir_img_filename, raw_thermal_np, rgb_np, metadata, calibration_parameters):
+        """
+        Queue one capture, a shard is written as soon as shard_size captures of the same size are queued
+        :param flir_img_filename: source image
+        :param raw_thermal_np: 2D raw sensor counts
+        :param rgb_np: downscaled rgb image
+        :param metadata: metadata of the image
+        :param calibration_parameters: raw2temp keyword arguments used for the image
+        :return:
+        """
+        raw_thermal_np = np.asarray(raw_thermal_np).astype(np.uint16)
+        rgb_np = np.asarray(rgb_np).astype(np.uint8)
+
+        group = (raw_thermal_np.shape, rgb_np.shape)
+        self.pending.setdefault(group, []).append({
+            'key': capture_key(flir_img_filename),
+            'raw': raw_thermal_np,
+            'rgb': rgb_np,
+            'metadata': dict(metadata),
+            'calibration_parameters': dict(calibration_parameters),
+        })
+
+        if len(self.pending[group]) >= self.shard_size:
+            self.write_shard(self.pending.pop(group))
+
+    def flush(self):
+        """
+        Write every queued capture
+        :return:
+        """
+        for group in list(self.pending):
+            self.write_shard(self.pending.pop(group))
+
+    def close(self):
+        self.flush()
+
+    def write_shard(self, captures):
+        """
+        Write a list of captures of the same size as one shard
+        :return: name of the shard
+        """
+        self.shard_count += 1
+        shard_name = 'shard_{:x}_{}_{:04d}'.format(int(time.time() * 1000000), os.getpid(), self.shard_count)
+        shard_path = os.path.join(self.archive_dir, shard_name)
+
+        np.save(shard_path + '_raw.npy', np.stack([capture['raw'] for capture in captures]))
+        np.save(shard_path + '_rgb.npy', np.stack([capture['rgb'] for capture in captures]))
+
+        # the json is written last, a shard without it is ignored
+        write_json(shard_path + '.json', {
+            'version': ARCHIVE_VERSION,
+            'created': time.time(),
+            'captures': [{'key': capture['key'], 'metadata': capture['metadata'],
+                          'calibration_parameters': capture['calibration_parameters']} for capture in captures],
+        })
+
+        if self.is_debug:
+            print("DEBUG Wrote {} captures to archive shard {}".format(len(captures), shard_path))
+
+        return shard_name
+
+
+def build_archive_index(archive_dir):
+    """
+    Merge the shards of an archive into index.json.
+    When a capture was archived more than once the most recent shard wins,
+    shards left without any capture are deleted
+    :param archive_dir:
+    :return: the index
+    """
+    shards = []
+    for shard_json_path in glob.glob(os.path.join(archive_dir, 'shard_*.json')):
+        with open(shard_json_path, 'r') as fh:
+            shard = json.load(fh)
+        shards.append((shard['created'], os.path.basename(shard_json_path)[:-len('.json')], shard))
+    shards.sort(key=lambda s: (s[0], s[1]))
+
+    captures = {}
+    for _, shard_name, shard in shards:
+        for slot, capture in enumerate(shard['captures']):
+            captures[capture['key']] = {'shard': shard_name, 'slot': slot, 'metadata': capture['metadata'],
+                                        'calibration_parameters': capture['calibration_parameters']}
+
+    index = {'version': ARCHIVE_VERSION, 'captures': captures}
+    write_json(os.path.join(archive_dir, ARCHIVE_INDEX_FILENAME), index)
+
+    # shards whose captures were all archived again later are not needed anymore
+    live_shards = set(entry['shard'] for entry in captures.values())
+    for _, shard_name, _ in shards:
+        if shard_name not in live_shards:
+            for suffix in ['.json', '_raw.npy', '_rgb.npy']:
+                shard_file_path = os.path.join(archive_dir, shard_name + suffix)
+                # files of a damaged shard may already be gone
+                if os.path.isfile(shard_file_path):
+                    os.remove(shard_file_path)
+
+    return index
+
+
+def archived_captures(archive_dir):
+    """
+    Captures an archive holds, according to its index.json, whose shard files are all still there
+    :param archive_dir:
+    :return: set of capture keys, empty when the archive or its index is missing
+    """
+    try:
+        with open(os.path.join(archive_dir, ARCHIVE_INDEX_FILENAME), 'r') as fh:
+            captures = json.load(fh)['captures']
+    except (IOError, OSError, ValueError, KeyError):
+        return set()
+
+    shard_exists = {}
+    for entry in captures.values():
+        shard_name = entry['shard']
+        if shard_name not in shard_exists:
+            shard_path = os.path.join(archive_dir, shard_name)
+            shard_exists[shard_name] = all(os.path.isfile(shard_path + suffix)
+                                           for suffix in ['.json', '_raw.npy', '_rgb.npy'])
+    return set(key for key, entry in captures.items() if shard_exists[entry['shard']])
+
+
+class ThermalArchive:
+    """
+    Read access to an archive written by ThermalArchiveWriter.
+
+    The shards are opened as memory maps, so raw() and rgb() return views of the
+    files and nothing is read until the pixels are used. Temperatures are computed
+    from the raw counts with the raw2temp parameters stored for each capture.
+    """
+
+    def __init__(self, archive_dir, mmap_mode='r', lut_cache=None):
+        """
+        :param archive_dir: archive folder
+        :param mmap_mode: np.load mmap_mode, None reads the shards into memory
+        :param lut_cache: Raw2TempLutCache used by thermal(), created on first use if None
+        """
+        self.archive_dir = archive_dir
+        self.mmap_mode = mmap_mode
+        self.lut_cache = lut_cache
+        self.shards = {}
+
+        index_path = os.path.join(archive_dir, ARCHIVE_INDEX_FILENAME)
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as fh:
+                self.index = json.load(fh)
+        else:
+            self.index = build_archive_index(archive_dir)
+
+    pass
+
+    def __len__(self):
+        return len(self.index['captures'])
+
+    def __contains__(self, flir_img_filename):
+        return capture_key(flir_img_filename) in self.index['captures']
+
+    def keys(self, prefix=''):
+        """
+        :param prefix: only keep the captures whose key starts with it, ex. "images/2019-08-28/"
+        :return: sorted list of capture keys
+        """
+        return sorted(key for key in self.index['captures'] if key.startswith(prefix))
+
+    def get_entry(self, flir_img_filename):
+        try:
+            return self.index['captures'][capture_key(flir_img_filename)]
+        except KeyError:
+            raise KeyError("{} is not in the archive {}".format(flir_img_filename, self.archive_dir))
+
+    def get_shard(self, shard_name):
+        """
+        Open (once) the raw and rgb stacks of a shard
+        :return: (raw stack, rgb stack)
+        """
+        if shard_name not in self.shards:
+            shard_path = os.path.join(self.archive_dir, shard_name)
+            self.shards[shard_name] = (np.load(shard_path + '_raw.npy', mmap_mode=self.mmap_mode),
+                                       np.load(shard_path + '_rgb.npy', mmap_mode=self.mmap_mode))
+        return self.shards[shard_name]
+
+    def metadata(self, flir_img_filename):
+        return self.get_entry(flir_img_filename)['metadata']
+
+    def calibration_parameters(self, flir_img_filename):
+        return self.get_entry(flir_img_filename)['calibration_parameters']
+
+    def raw(self, flir_img_filename):
+        """
+        :return: 2D uint16 raw sensor counts of the capture
+        """
+        entry = self.get_entry(flir_img_filename)
+        return self.get_shard(entry['shard'])[0][entry['slot']]
+
+    def rgb(self, flir_img_filename):
+        """
+        :return: downscaled rgb image of the capture
+        """
+        entry = self.get_entry(flir_img_filename)
+        return self.get_shard(entry['shard'])[1][entry['slot']]
+
+    def thermal(self, flir_img_filename):
+        """
+        :return: 2D temperatures in C, identical to the Temp(c) column of the csv
+        """
+        if self.lut_cache is None:
+            from flir_image_extractor import FlirImageExtractor
+            from raw2temp_lut import Raw2TempLutCache
+            self.lut_cache = Raw2TempLutCache(FlirImageExtractor.raw2temp)
+
+        return self.lut_cache.convert(self.raw(flir_img_filename), self.calibration_parameters(flir_img_filename))
+
+    def stack(self, flir_img_filenames, field='raw'):
+        """
+        Stack one field of many captures, ex. all the captures of a day
+        :param flir_img_filenames: list of images or capture keys of the same size
+        :param field: 'raw', 'rgb' or 'thermal'
+        :return: array with one capture per row
+        """
+        read = {'raw': self.raw, 'rgb': self.rgb, 'thermal': self.thermal}[field]
+        return np.stack([read(flir_img_filename) for flir_img_filename in flir_img_filenames])
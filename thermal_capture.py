@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+
+class ThermalCapture(object):
+    """
+    Immutable result of FlirImageExtractor.extract() for a single image.
+
+    The arrays are flagged read-only and the record can't be modified once built,
+    so it can be handed between threads freely. Only the decoded arrays and the
+    metadata are kept (not the file bytes), which keeps pickling for process pools cheap.
+    The encoded embedded image is only kept when it is written out as it is.
+    Arrays that were not asked for are None.
+    """
+
+    __slots__ = ('flir_img_filename', 'metadata', 'calibration_parameters', 'rgb_image_np', 'raw_thermal_np',
+                 'thermal_image_np', 'cropped_visual_np', 'downscaled_rgb_image_np', 'embedded_image_bytes')
+
+    def __init__(self, flir_img_filename, metadata, calibration_parameters, rgb_image_np, raw_thermal_np,
+                 thermal_image_np, cropped_visual_np, downscaled_rgb_image_np, embedded_image_bytes=None):
+        values = (flir_img_filename, dict(metadata), dict(calibration_parameters), rgb_image_np, raw_thermal_np,
+                  thermal_image_np, cropped_visual_np, downscaled_rgb_image_np, embedded_image_bytes)
+        self._set_values(values)
+
+    def _set_values(self, values):
+        for name, value in zip(ThermalCapture.__slots__, values):
+            if hasattr(value, 'setflags'):
+                # a read only view, the arrays of the caller stay writable
+                value = value.view()
+                value.setflags(write=False)
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ThermalCapture is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ThermalCapture is immutable")
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in ThermalCapture.__slots__)
+
+    def __setstate__(self, state):
+        self._set_values(state)
+
+    def __repr__(self):
+        return "ThermalCapture({!r}, thermal shape={})".format(
+            self.flir_img_filename, getattr(self.thermal_image_np, 'shape', None))
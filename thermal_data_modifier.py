@@ -2,26 +2,106 @@ import argparse
 import sys
 import os
 import glob
+import time
+import traceback
 
 import csv
+from collections import OrderedDict
+
 import numpy as np
-import cv2 as cv
+
+from stage_profiler import StageProfiler, profiled, profile_stage, worker_trace_path, merge_worker_traces, \
+    read_trace, summarize, print_summary
+from thermal_values import read_thermal_size, thermal_classes_path, read_thermal_classes, write_thermal_classes, \
+    load_thermal_values
+from sensor_geometry import LEGACY_THERMAL_SIZE
+from leaf_mask import find_mask, read_mask, resize_mask, file_digest, resized_mask_cache_path, \
+    read_resized_mask_cache, write_resized_mask_cache
 
 
 # -*- coding: utf-8 -*-
 
+METRIC_LABELS = ['Temp avg', 'Leaf Temp avg', 'Noise Temp avg', 'avg diff',
+                 'Leaf Temp peak', 'Leaf Temp Low', 'Noise Temp Peak', 'Noise Temp Low']
+
+# Columns of the table -act writes, one row per folder: images/<date>/<camera>/<capture>/
+SUMMARY_COLUMNS = ['date', 'camera', 'capture', 'folder'] + METRIC_LABELS + ['error']
+SUMMARY_FILE = 'leaf_metrics.csv'
+
+
+def running_sum(values):
+    """
+    Sum in file order, with the rounding of a running total, so the averages don't change
+    in the last digits compared to adding the values one by one
+    :return: float
+    """
+    if values.shape[0] == 0:
+        return 0.0
+    return float(np.cumsum(values)[-1])
+
+
 class ThermalDataModifier:
 
-    def __init__(self, is_debug=False, directory=''):
+    def __init__(self, is_debug=False, directory='', profiler=None, print_errors=True):
+        """
+        :param print_errors: print why a folder is skipped, batches report it in their table instead
+        """
         self.is_debug = is_debug
         self.directory = directory
+        # optional StageProfiler
+        self.profiler = profiler
+        self.print_errors = print_errors
+        # why the last call of process_thermal_data didn't compute the metrics, None if it did
+        self.error = None
         self.unmodified_data_suffix = '_thermal_values.csv'
 
+    def fail(self, message, *details):
+        """
+        Remember why the folder is skipped
+        :param details: extra lines printed after the message
+        :return:
+        """
+        self.error = message
+        if self.print_errors:
+            print(message)
+            for detail in details:
+                print(detail)
+
+    def get_leaf_mask(self, path_to_mask, thermal_size, digest=None):
+        """
+        The mask at the thermal resolution. Resizing it is cached next to it, keyed by the
+        sha1 of the mask and the thermal size, so the next runs neither parse nor resize it
+        :param thermal_size: (width, height)
+        :param digest: sha1 of the mask, computed if None
+        :return: bool array, True for leaves
+        """
+        width, height = thermal_size
+        if digest is None:
+            digest = file_digest(path_to_mask)
+        cache_path = resized_mask_cache_path(path_to_mask, thermal_size)
+
+        leaf_mask = read_resized_mask_cache(cache_path, digest, thermal_size)
+        if leaf_mask is not None:
+            if self.is_debug:
+                print('DEBUG Using the {}x{} mask cached in {}'.format(height, width, cache_path))
+            return leaf_mask
+
+        new_mask = resize_mask(read_mask(path_to_mask), thermal_size)
+        np.savetxt(os.path.join(self.directory, 'mask_{}x{}.txt'.format(height, width)), new_mask, fmt='%d')
+        leaf_mask = new_mask != 0
+        write_resized_mask_cache(cache_path, digest, leaf_mask)
+        if self.is_debug:
+            print('DEBUG Mask successfully loaded!')
+            print('DEBUG Mask was downscaled to {}x{}!'.format(height, width))
+        return leaf_mask
+
+    @profiled('process_thermal_data')
     def process_thermal_data(self):
         """
         Maps the extracted mask to the thermal data
-        :return:
+        :return: OrderedDict of the METRIC_LABELS metrics, None if the folder was skipped (see self.error)
         """
+        self.error = None
 
         if self.is_debug:
             if os.path.exists(self.directory):
@@ -30,123 +110,77 @@ class ThermalDataModifier:
                 print("DEBUG Error! Provided directory does not exist!")
 
 
-        path_to_mask = os.path.join(self.directory + '\\' + 'mask.txt')
+        path_to_mask = find_mask(self.directory)
         
-        if os.path.exists(path_to_mask):
-            mask = np.loadtxt(path_to_mask)
-            new_mask = cv.resize(mask, dsize=(80, 60), interpolation=cv.INTER_CUBIC)
-            np.savetxt(os.path.join(self.directory + '\\' + 'mask_60x80.txt'),new_mask, fmt='%d')
-            it = np.nditer(new_mask, flags=['multi_index'])
-            if self.is_debug:
-                print('DEBUG Mask successfully loaded!')
-                print('DEBUG Mask was downscaled to 60x80!')
-        else:
-            print("Mask not found! Please add a mask.txt file to the following folder: "+ self.directory)
+        if path_to_mask is None:
+            self.fail("Mask not found! Please add a mask.txt (or mask.bits, mask.rle, mask.png) file to the following "
+                      "folder: "+ self.directory)
             return
 
         unmodified_data_suffix = '_thermal_values.csv'
-        path_to_csv = self.directory + '\\' + '*{}'.format(unmodified_data_suffix)
+        path_to_csv = os.path.join(self.directory, '*{}'.format(unmodified_data_suffix))
 
         # List of csv files with givn suffix inside the folder
         loaded_csv_files = glob.glob(path_to_csv)
 
         if loaded_csv_files.__len__() > 1:
-            print('Multiple themal values csv files found inside the folder: ' + self.directory)
-            print(loaded_csv_files)
-            print('Please remove the extra file(s)')
-            print('Exiting..')
+            self.fail('Multiple themal values csv files found inside the folder: ' + self.directory,
+                      loaded_csv_files, 'Please remove the extra file(s)', 'Exiting..')
             return
         elif loaded_csv_files.__len__() < 1:
-            print('No themal values csv file found inside the folder: ' + self.directory)
-            print('Please add a file')
-            print('Exiting..')
+            self.fail('No themal values csv file found inside the folder: ' + self.directory,
+                      'Please add a file', 'Exiting..')
             return
 
         if self.is_debug:
             print("DEBUG Using csv file: " + loaded_csv_files[0])
 
-        #Create another csv containing class information
-        with open(loaded_csv_files[0], 'r') as csvInput:
-
-            leaves = 0
-            reader = csv.reader(csvInput)
-
-            all = []
-            row = next(reader)
-            row.append('Class')
-            all.append(row)
-
-            for row in reader:
-                if not it.finished:
-                    #check if the csv has been modified before
-                    if (len(row)-1) >=6:
-                        if self.is_debug:
-                            print('DEBUG csv already contains class information and will not be modified')
-                        return
-                    if it[0] != 0:
-                        leaves+=1
-                        row.append('Leaf')
-                    else:
-                        row.append('Noise')
-                    it.iternext()
-                    all.append(row)
-
-            if leaves == 0:
-                if self.is_debug:
-                    print("DEBUG: the mask.txt file in the folder does not contain any leaf information")
-                return
-            with open(loaded_csv_files[0], 'w') as csvOutput:
-                writer = csv.writer(csvOutput, lineterminator='\n')
-                writer.writerows(all)
+        # the mask covers the cropped rgb image, bring it to the resolution of the thermal data
+        thermal_size = read_thermal_size(loaded_csv_files[0]) or LEGACY_THERMAL_SIZE
+        digest = file_digest(path_to_mask)
 
-        if self.is_debug:
-            print('DEBUG csv modified')
-            print('DEBUG The file now also contains information regarding which pixels correspond to leaves')
-
-        with open(loaded_csv_files[0], 'r') as csvInput:
-            reader = csv.reader(csvInput)
-            next(reader)
-
-            total_counter = 0
-            leaf_counter = 0
-            noise_counter = 0
-
-            total_image_temp = 0
-            total_leaf_temp = 0
-            total_noise_temp = 0
-
-            lowest_leaf_temp = 9999
-            highest_leaf_temp = -9999
-
-            lowest_noise_temp = 9999
-            highest_noise_temp = -9999
-
-            for row in reader:
-                temp_value = float(row[2])
-                total_counter += 1
-                total_image_temp += temp_value
-                if row[6] == 'Leaf':
-                    leaf_counter += 1
-                    total_leaf_temp += temp_value
-                    if temp_value > highest_leaf_temp:
-                        highest_leaf_temp = temp_value
-                    if temp_value < lowest_leaf_temp:
-                        lowest_leaf_temp = temp_value
-                else:
-                    noise_counter += 1
-                    total_noise_temp += temp_value
-                    if temp_value > highest_noise_temp:
-                        highest_noise_temp = temp_value
-                    if temp_value < lowest_noise_temp:
-                        lowest_noise_temp = temp_value
-
-            if leaf_counter > 0:
-                average_leaf_temp = total_leaf_temp/leaf_counter
+        with profile_stage(self.profiler, 'resize_mask'):
+            leaf_mask = self.get_leaf_mask(path_to_mask, thermal_size, digest)
+
+        # the classes go to a one bit per pixel sidecar, the csv itself is never rewritten
+        with profile_stage(self.profiler, 'label_pixels'):
+            classes_path = thermal_classes_path(loaded_csv_files[0])
+            current_classes = read_thermal_classes(classes_path, digest)
+            if current_classes is not None and current_classes.shape == leaf_mask.shape:
+                if self.is_debug:
+                    print('DEBUG ' + classes_path + ' is up to date with the mask')
             else:
-                print("DEBUG you have provided an empty mask, edit the mask and try again.")
-                return()
-            average_image_temp = total_image_temp/total_counter
-            average_noise_temp = total_noise_temp/noise_counter
+                write_thermal_classes(classes_path, leaf_mask, digest)
+                if self.is_debug:
+                    print('DEBUG The classes of the pixels were written to ' + classes_path)
+
+        with profile_stage(self.profiler, 'load_values'):
+            values = load_thermal_values(loaded_csv_files[0])
+            temperatures = values.temperatures
+            is_leaf = values.is_leaf
+
+        if not np.any(is_leaf):
+            self.error = "the mask.txt file in the folder does not contain any leaf information"
+            if self.is_debug:
+                print("DEBUG: " + self.error)
+            return
+
+        if np.all(is_leaf):
+            self.fail("The mask covers the whole image, there is no noise to compare the leaves with: "
+                      + self.directory)
+            return
+
+        with profile_stage(self.profiler, 'compute_metrics'):
+            leaf_temperatures = temperatures[is_leaf]
+            noise_temperatures = temperatures[~is_leaf]
+
+            total_counter = temperatures.shape[0]
+            leaf_counter = leaf_temperatures.shape[0]
+            noise_counter = noise_temperatures.shape[0]
+
+            average_leaf_temp = running_sum(leaf_temperatures) / leaf_counter
+            average_image_temp = running_sum(temperatures) / total_counter
+            average_noise_temp = running_sum(noise_temperatures) / noise_counter
             diff = abs(average_leaf_temp - average_noise_temp)
 
             if self.is_debug:
@@ -155,11 +189,11 @@ class ThermalDataModifier:
                 print('Total number of temperature values:', total_counter)
                 print('DEBUG Metrics successfully exported into output.csv')
 
-            metric_labels = ['Temp avg', 'Leaf Temp avg', 'Noise Temp avg', 'avg diff',
-                             'Leaf Temp peak', 'Leaf Temp Low', 'Noise Temp Peak', 'Noise Temp Low']
+            metric_labels = METRIC_LABELS
 
-            metrics = [average_image_temp, average_leaf_temp, average_noise_temp, diff, highest_leaf_temp,
-                       lowest_leaf_temp, highest_noise_temp, lowest_noise_temp]
+            metrics = [average_image_temp, average_leaf_temp, average_noise_temp, diff,
+                       float(leaf_temperatures.max()), float(leaf_temperatures.min()),
+                       float(noise_temperatures.max()), float(noise_temperatures.min())]
 
             with open(os.path.join(self.directory,'output.csv'), 'w') as csvOutput:
                 writer = csv.writer(csvOutput, lineterminator='\n')
@@ -170,24 +204,155 @@ class ThermalDataModifier:
 
                 writer.writerows(all)
 
+        return OrderedDict(zip(metric_labels, metrics))
+
+def folder_keys(folder_path):
+    """
+    :param folder_path: ex. images/2020-08-14/Camera_1/img_20200814_100000_00000/
+    :return: (date, camera, capture) folder names, empty for the levels the path doesn't have
+    """
+    parts = [part for part in folder_path.replace("\\", "/").split('/') if part]
+    return tuple(([''] * 3 + parts)[-3:])
+
+
+# Settings of the current batch worker process
+worker_is_debug = False
+worker_profiler = None
+
+
+def init_folder_worker(is_debug=False, profile_path=None):
+    """
+    :param profile_path: trace of --profile, each worker writes its own part of it
+    :return:
+    """
+    from multiprocessing.util import Finalize
+
+    global worker_is_debug, worker_profiler
+    worker_is_debug = is_debug
+    if profile_path:
+        worker_profiler = StageProfiler(worker_trace_path(profile_path))
+        worker_profiler.start()
+        Finalize(worker_profiler, worker_profiler.close, exitpriority=5)
+
+
+def process_folder(folder_path):
+    """
+    Compute the metrics of one folder, failures are returned instead of raised or printed
+    :return: (folder path, OrderedDict of metrics or None, error message or None)
+    """
+    if worker_profiler is not None:
+        worker_profiler.set_item(folder_path)
+    tdm = ThermalDataModifier(is_debug=worker_is_debug, directory=folder_path, profiler=worker_profiler,
+                              print_errors=False)
+    try:
+        metrics = tdm.process_thermal_data()
+    except Exception:
+        if worker_is_debug:
+            traceback.print_exc()
+        return folder_path, None, traceback.format_exc().strip().splitlines()[-1]
+    if worker_is_debug:
+        print("-------------------------------------------------------")
+    return folder_path, metrics, tdm.error
+
+
+def process_folders_batch(folder_path_list, jobs=1, is_debug=False, profile_path=None):
+    """
+    Compute the metrics of every folder, fanned out over a pool of processes when jobs > 1
+    :param profile_path: JSON-lines trace receiving the stages of every folder, None disables profiling
+    :return: list of (folder path, metrics or None, error message or None), in the order of folder_path_list
+    """
+    if not folder_path_list:
+        return []
+
+    if jobs <= 1:
+        init_folder_worker(is_debug, profile_path)
+        try:
+            return [process_folder(folder_path) for folder_path in folder_path_list]
+        finally:
+            if worker_profiler is not None:
+                worker_profiler.close()
+                merge_worker_traces(profile_path)
+
+    import multiprocessing
+
+    # thousands of small folders: hand them out in chunks, a few per worker to keep the load balanced
+    chunksize = max(1, len(folder_path_list) // (jobs * 8))
+    pool = multiprocessing.Pool(processes=jobs, initializer=init_folder_worker, initargs=(is_debug, profile_path))
+    try:
+        return pool.map(process_folder, folder_path_list, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+        if profile_path:
+            merge_worker_traces(profile_path)
+
+
+def write_summary_table(path, results):
+    """
+    Write the metrics of every folder to one csv, SUMMARY_COLUMNS, with the error of the skipped folders
+    :param results: see process_folders_batch
+    :return:
+    """
+    if sys.version_info[0] < 3:
+        csvfile = open(path, 'wb')
+    else:
+        csvfile = open(path, 'w', newline='')
+    with csvfile:
+        writer = csv.writer(csvfile, lineterminator='\n')
+        writer.writerow(SUMMARY_COLUMNS)
+        for folder_path, metrics, error in results:
+            values = [metrics[label] for label in METRIC_LABELS] if metrics else [''] * len(METRIC_LABELS)
+            if metrics is None and error is None:
+                error = 'no metrics'
+            writer.writerow(list(folder_keys(folder_path)) + [folder_path] + values + [error or ''])
+
+
+def print_batch_summary(results, elapsed_time, summary_path):
+    """
+    Print how many folders succeeded or failed and the wall time of the batch
+    :return:
+    """
+    failures = len([result for result in results if result[1] is None])
+    print("Total number of folders: {}, succeeded: {}, failed: {}, wall time: {:.2f} s, metrics: {}".format(
+        len(results), len(results) - failures, failures, elapsed_time, summary_path))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Modifies the thermal data and generates metrics')
     parser.add_argument('-dir', '--directory', type=str, help='Path to directory. Ex. images/test2/', required=False)
     parser.add_argument('-act', '--actions', help='Performs the action for all images inside folders with .csv and mask.txt files',required=False,  action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes used with -act', required=False,
+                        default=1)
+    parser.add_argument('-o', '--summary', type=str, help='Table of the metrics of every folder written by -act '
+                        '(default: {})'.format(SUMMARY_FILE), required=False, default=SUMMARY_FILE)
+    parser.add_argument('--profile', type=str, help='Time every stage into this JSON-lines trace and print a summary table',
+                        required=False, default=None)
     parser.add_argument('-d', '--debug', help='Set the debug flag', required=False, action='store_true')
     parsed_args = parser.parse_args()
-    
-    if parsed_args.actions:
-        folder_path_list = glob.glob("images/*-*-*/Camera_*/*/")
 
-        for folder_path in folder_path_list:
-            tdm = ThermalDataModifier(is_debug=parsed_args.debug, directory=folder_path)
-            tdm.process_thermal_data()
-            if parsed_args.debug:
-                print("-------------------------------------------------------")
+    if parsed_args.actions:
+        folder_path_list = sorted(glob.glob("images/*-*-*/Camera_*/*/"))
+
+        if parsed_args.profile:
+            # start a new trace, the workers append to it
+            open(parsed_args.profile, 'w').close()
+
+        start_time = time.time()
+        results = process_folders_batch(folder_path_list, jobs=parsed_args.jobs, is_debug=parsed_args.debug,
+                                        profile_path=parsed_args.profile)
+        write_summary_table(parsed_args.summary, results)
+        print_batch_summary(results, time.time() - start_time, parsed_args.summary)
+        if parsed_args.profile:
+            print_summary(summarize(read_trace(parsed_args.profile)))
     else:
-        tdm = ThermalDataModifier(is_debug=parsed_args.debug, directory=parsed_args.directory)
+        profiler = None
+        if parsed_args.profile:
+            profiler = StageProfiler(parsed_args.profile)
+            profiler.start()
+            profiler.set_item(parsed_args.directory)
+        tdm = ThermalDataModifier(is_debug=parsed_args.debug, directory=parsed_args.directory, profiler=profiler)
         tdm.process_thermal_data()
-    
-    
+
+        if profiler is not None:
+            profiler.close()
+            profiler.print_summary()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from sensor_geometry import SensorGeometry, GEOMETRY_AUTO, GEOMETRY_LEGACY, GEOMETRY_METADATA, GEOMETRY_MODES
+
+# How the rgb image is brought to the thermal resolution
+REGISTRATION_RESIZE = 'resize'
+REGISTRATION_REMAP = 'remap'
+REGISTRATION_MODES = [REGISTRATION_RESIZE, REGISTRATION_REMAP]
+
+# Tags of a camera entry of the alignment file, same names as the metadata they replace
+ALIGNMENT_TAGS = ['Real2IR', 'OffsetX', 'OffsetY']
+
+
+def load_alignment(path):
+    """
+    Per camera alignment parameters, a json file keyed by camera model, ex.
+    {"FLIR AX8": {"Real2IR": 1.27, "OffsetX": -4, "OffsetY": 10}}
+    :return: dictionary camera model -> dictionary of ALIGNMENT_TAGS
+    """
+    with open(path, 'r') as fh:
+        alignment = json.load(fh)
+
+    for camera_model, parameters in alignment.items():
+        unknown_tags = set(parameters) - set(ALIGNMENT_TAGS)
+        if unknown_tags:
+            raise ValueError("Unknown alignment parameters for {}: {}".format(camera_model,
+                                                                              ", ".join(sorted(unknown_tags))))
+    return alignment
+
+
+def aligned_geometry(alignment, metadata, thermal_size, visual_size, mode):
+    """
+    :param alignment: see load_alignment
+    :return: SensorGeometry from the alignment entry of the camera of the capture, None if it has none
+    """
+    parameters = alignment.get(metadata.get('CameraModel'))
+    if parameters is None:
+        return None
+
+    aligned_metadata = dict(metadata)
+    aligned_metadata.update(parameters)
+    # calibrated cameras use their parameters even when auto would pick the legacy crop
+    return SensorGeometry.from_metadata(aligned_metadata, thermal_size=thermal_size, visual_size=visual_size,
+                                        mode=GEOMETRY_LEGACY if mode == GEOMETRY_LEGACY else GEOMETRY_METADATA)
+
+
+class RegistrationMaps:
+    """
+    cv.remap lookup maps between the rgb and the thermal pixels of one geometry.
+
+    forward gives for every thermal pixel the rgb position it sees, so registering
+    an rgb image into the thermal grid is one remap call. inverse gives for every rgb
+    pixel its thermal position, to project temperatures onto the full resolution rgb
+    image. Both are converted to OpenCV's fixed point format, which remaps faster.
+
+    A bilinear remap only reads the 2x2 rgb pixels around each thermal pixel, which
+    aliases badly when the thermal grid is several times coarser. In that case the crop
+    is first averaged down (cv.INTER_AREA) to twice the thermal resolution, prefilter_size,
+    and forward points into that copy: each thermal pixel interpolates the 2x2 block it
+    covers, which matches the area average of the resize registration.
+    """
+
+    def __init__(self, geometry):
+        """
+        :param geometry: SensorGeometry
+        """
+        import cv2 as cv
+
+        self.geometry = geometry
+        left, top, width, height = geometry.crop_box()
+        thermal_width, thermal_height = geometry.thermal_size
+        visual_width, visual_height = geometry.visual_size
+        scale_x = float(width) / thermal_width
+        scale_y = float(height) / thermal_height
+
+        # pixel centers of one grid expressed in the coordinates of the other
+        thermal_x = np.arange(thermal_width, dtype=np.float32)
+        thermal_y = np.arange(thermal_height, dtype=np.float32)
+        if scale_x > 2 or scale_y > 2:
+            # the crop averaged down to twice the thermal resolution, see register
+            self.prefilter_size = (2 * thermal_width, 2 * thermal_height)
+            forward_x, forward_y = np.meshgrid(2 * thermal_x + 0.5, 2 * thermal_y + 0.5)
+        else:
+            self.prefilter_size = None
+            forward_x, forward_y = np.meshgrid(left + (thermal_x + 0.5) * scale_x - 0.5,
+                                               top + (thermal_y + 0.5) * scale_y - 0.5)
+        self.forward = cv.convertMaps(forward_x, forward_y, cv.CV_16SC2)
+
+        visual_x = np.arange(visual_width, dtype=np.float32)
+        visual_y = np.arange(visual_height, dtype=np.float32)
+        inverse_x, inverse_y = np.meshgrid((visual_x + 0.5 - left) / scale_x - 0.5,
+                                           (visual_y + 0.5 - top) / scale_y - 0.5)
+        self.inverse = cv.convertMaps(inverse_x, inverse_y, cv.CV_16SC2)
+
+    pass
+
+    def register(self, visual_np):
+        """
+        Resample the rgb image into the thermal grid
+        :param visual_np: rgb image of the visual size of the geometry
+        :return: image of the thermal size
+        """
+        import cv2 as cv
+
+        if self.prefilter_size is not None:
+            visual_np = cv.resize(self.geometry.crop(visual_np), self.prefilter_size, interpolation=cv.INTER_AREA)
+        return cv.remap(visual_np, self.forward[0], self.forward[1], cv.INTER_LINEAR)
+
+    def project(self, thermal_np, fill_value=np.nan):
+        """
+        Resample the thermal image onto the full resolution rgb image
+        :param thermal_np: temperatures of the thermal size of the geometry
+        :param fill_value: value of the rgb pixels outside the thermal field of view
+        :return: float array of the visual size
+        """
+        import cv2 as cv
+
+        return cv.remap(np.asarray(thermal_np, dtype=np.float64), self.inverse[0], self.inverse[1], cv.INTER_LINEAR,
+                        borderMode=cv.BORDER_CONSTANT, borderValue=fill_value)
+
+    def float_maps(self):
+        """
+        :return: forward x, forward y, inverse x, inverse y maps as float32 arrays, forward in the
+        coordinates of the crop averaged down to prefilter_size when there is one
+        """
+        import cv2 as cv
+
+        forward_x, forward_y = cv.convertMaps(self.forward[0], self.forward[1], cv.CV_32FC1)
+        inverse_x, inverse_y = cv.convertMaps(self.inverse[0], self.inverse[1], cv.CV_32FC1)
+        return forward_x, forward_y, inverse_x, inverse_y
+
+
+class RegistrationMapCache:
+    """
+    A camera model at a given resolution always has the same geometry, so its maps
+    are built once and shared by every image (and thread) in a bounded LRU cache
+    """
+
+    def __init__(self, max_entries=8, is_debug=False):
+        self.max_entries = max(1, max_entries)
+        self.is_debug = is_debug
+        self.maps = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    pass
+
+    def make_key(self, geometry):
+        """
+        :return: hashable description of the pixel mapping of the geometry
+        """
+        return geometry.thermal_size, geometry.visual_size, geometry.crop_box()
+
+    def get_maps(self, geometry):
+        """
+        :param geometry: SensorGeometry
+        :return: RegistrationMaps
+        """
+        key = self.make_key(geometry)
+
+        with self.lock:
+            if key in self.maps:
+                self.hits += 1
+                maps = self.maps.pop(key)
+                self.maps[key] = maps
+                return maps
+            self.misses += 1
+
+        maps = RegistrationMaps(geometry)
+        if self.is_debug:
+            print("DEBUG Built registration maps for {}".format(geometry))
+
+        with self.lock:
+            self.maps[key] = maps
+            while len(self.maps) > self.max_entries:
+                self.maps.popitem(last=False)
+
+        return maps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the rgb <-> thermal registration maps of a FLIR image and its '
+                                                 'temperatures projected onto the rgb image')
+    parser.add_argument('-i', '--input', type=str, help='Input image. Ex. img.jpg', required=True)
+    parser.add_argument('-o', '--output', type=str, help='Output .npz file with the forward_x, forward_y, inverse_x, '
+                        'inverse_y maps, the prefilter_size and the thermal_on_rgb temperatures', required=True)
+    parser.add_argument('--alignment', type=str, help='Json file of per camera Real2IR, OffsetX and OffsetY',
+                        required=False, default=None)
+    parser.add_argument('--geometry', type=str, help='How the rgb image is cropped (default: auto)', required=False,
+                        default=GEOMETRY_AUTO, choices=GEOMETRY_MODES)
+    parser.add_argument('-d', '--debug', help='Set the debug flag', required=False, action='store_true')
+    args = parser.parse_args()
+
+    from flir_image_extractor import FlirImageExtractor
+
+    fie = FlirImageExtractor(is_debug=args.debug, geometry=args.geometry, alignment_file=args.alignment)
+    fie.process_image(args.input)
+    registration_maps = fie.registration_maps.get_maps(fie.get_geometry())
+    forward_x, forward_y, inverse_x, inverse_y = registration_maps.float_maps()
+    prefilter_size = np.array(registration_maps.prefilter_size or (), dtype=int)
+    np.savez_compressed(args.output, forward_x=forward_x, forward_y=forward_y, inverse_x=inverse_x,
+                        inverse_y=inverse_y, prefilter_size=prefilter_size,
+                        thermal_on_rgb=registration_maps.project(fie.get_thermal_np()))
+    fie.close()
+    print("Saved the registration maps of {} to {}".format(registration_maps.geometry, args.output))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import os.path
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from leaf_mask import read_packed_bits, write_packed_bits
+
+# Columns of the <image>_thermal_values.csv files
+THERMAL_VALUES_HEADER = ['x', 'y', 'Temp(c)', 'R', 'G', 'B']
+THERMAL_VALUES_SUFFIX = '_thermal_values.csv'
+
+# Typed columns of the csv
+THERMAL_VALUES_TYPES = ['<i4', '<i4', '<f8', '<i4', '<i4', '<i4']
+THERMAL_VALUES_DTYPE = np.dtype(list(zip(THERMAL_VALUES_HEADER, THERMAL_VALUES_TYPES)))
+
+# Parsed csv memoized next to it: <image>_thermal_values.cache, a header (magic, rows, size and mtime of the csv)
+# followed by each column of THERMAL_VALUES_DTYPE in turn, memory mapped by the next reads
+THERMAL_VALUES_CACHE_SUFFIX = '_thermal_values.cache'
+VALUES_HEADER = struct.Struct('<4sIQq')
+VALUES_MAGIC = b'TVAL'
+
+# Leaf / noise class of every pixel, one bit per pixel next to the csv: <image>_thermal_classes.bits
+THERMAL_CLASSES_SUFFIX = '_thermal_classes.bits'
+CLASSES_MAGIC = b'CLSB'
+# Values of the Class column older versions appended to the csv
+CLASS_NAMES = ['Noise', 'Leaf']
+
+# Rows formatted and written per chunk
+THERMAL_VALUES_CHUNK_ROWS = 4096
+
+
+def thermal_values_columns(thermal_np, rgb_np):
+    """
+    Assemble the thermal_values table as numpy columns
+    :param thermal_np: 2D array of temperatures in C
+    :param rgb_np: 3D RGB image, usually the downscaled visual image of the same size
+    :return: x, y, temperature, R, G, B flat arrays in row major order
+    """
+    x, y = np.indices(thermal_np.shape)
+    rgb_values = rgb_np.reshape(-1, rgb_np.shape[-1])
+
+    # Like the original zip of the two pixel lists: stop at the shorter one
+    rows = min(thermal_np.size, rgb_values.shape[0])
+    return (x.ravel()[:rows], y.ravel()[:rows], thermal_np.ravel()[:rows],
+            rgb_values[:rows, 0], rgb_values[:rows, 1], rgb_values[:rows, 2])
+
+
+def write_thermal_values_csv(path, thermal_np, rgb_np, chunk_rows=THERMAL_VALUES_CHUNK_ROWS):
+    """
+    Write the x,y,Temp(c),R,G,B table, streamed to disk chunk by chunk.
+
+    The bytes are the ones csv.writer produced: CRLF line endings, integers for the
+    coordinates and the colors, and the shortest repr of the temperature that
+    round trips to the same float64. The file is written in binary so Python 2 and 3
+    (and Windows) give identical files.
+    :param path: output csv file
+    :param thermal_np: 2D array of temperatures in C
+    :param rgb_np: 3D RGB image
+    :param chunk_rows: rows formatted per write
+    :return:
+    """
+    columns = thermal_values_columns(thermal_np, rgb_np)
+    integer_columns = np.column_stack([columns[0], columns[1], columns[3], columns[4], columns[5]]).astype(np.int64)
+    temperatures = columns[2].astype(np.float64)
+
+    with open(path, 'wb') as fh:
+        fh.write((','.join(THERMAL_VALUES_HEADER) + '\r\n').encode('ascii'))
+        for start in range(0, temperatures.shape[0], chunk_rows):
+            stop = start + chunk_rows
+            lines = ['%d,%d,%r,%d,%d,%d\r\n' % (x, y, t, r, g, b)
+                     for (x, y, r, g, b), t in zip(integer_columns[start:stop].tolist(),
+                                                   temperatures[start:stop].tolist())]
+            fh.write(''.join(lines).encode('ascii'))
+
+
+def read_thermal_size(path, tail_bytes=256):
+    """
+    Size of the thermal image a thermal_values csv was written from, read from its last row
+    (x is the row and y the column of the pixel) without parsing the rest of the file
+    :param path: thermal_values csv file, with or without the Class column
+    :return: (width, height), None if the file has no rows
+    """
+    with open(path, 'rb') as fh:
+        fh.seek(0, 2)
+        size = fh.tell()
+        fh.seek(max(0, size - tail_bytes))
+        lines = fh.read().splitlines()
+
+    for line in reversed(lines):
+        fields = line.split(b',')
+        try:
+            return int(fields[1]) + 1, int(fields[0]) + 1
+        except (IndexError, ValueError):
+            continue
+    return None
+
+
+def parse_thermal_values(lines):
+    """
+    :param lines: data rows of a thermal_values csv, as bytes, with or without the Class column
+    :return: structured array of THERMAL_VALUES_DTYPE, one record per row
+    """
+    if not lines:
+        return np.zeros(0, dtype=THERMAL_VALUES_DTYPE)
+    # floats are parsed exactly, the temperatures come back bit for bit as they were written
+    return np.loadtxt(lines, delimiter=',', usecols=range(len(THERMAL_VALUES_HEADER)), dtype=THERMAL_VALUES_DTYPE,
+                      ndmin=1)
+
+
+def csv_key(csv_path):
+    """
+    :return: (size, mtime in ns) of the csv, what its cache is keyed by
+    """
+    stat = os.stat(csv_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def thermal_values_cache_path(csv_path):
+    """
+    :return: path of the parsed values cache of a thermal_values csv
+    """
+    if csv_path.endswith(THERMAL_VALUES_SUFFIX):
+        return csv_path[:-len(THERMAL_VALUES_SUFFIX)] + THERMAL_VALUES_CACHE_SUFFIX
+    return os.path.splitext(csv_path)[0] + THERMAL_VALUES_CACHE_SUFFIX
+
+
+def columns_dtype(rows):
+    """
+    :return: dtype of one record holding every column of a table of the given rows, one after the other
+    """
+    return np.dtype([(name, column_type, (rows,)) for name, column_type in zip(THERMAL_VALUES_HEADER,
+                                                                               THERMAL_VALUES_TYPES)])
+
+
+def read_thermal_values_cache(cache_path, key):
+    """
+    :param key: see csv_key
+    :return: OrderedDict column name -> read only array mapped from the cache, None if there is no cache or it is stale
+    """
+    try:
+        with open(cache_path, 'rb') as fh:
+            header = fh.read(VALUES_HEADER.size)
+        if len(header) < VALUES_HEADER.size:
+            return None
+        magic, rows, size, mtime_ns = VALUES_HEADER.unpack(header)
+        if magic != VALUES_MAGIC or (size, mtime_ns) != tuple(key):
+            return None
+        if os.path.getsize(cache_path) != VALUES_HEADER.size + columns_dtype(rows).itemsize:
+            return None
+        if rows == 0:
+            return OrderedDict((name, np.zeros(0, dtype=THERMAL_VALUES_DTYPE[name])) for name in THERMAL_VALUES_HEADER)
+        table = np.memmap(cache_path, dtype=columns_dtype(rows), mode='r', offset=VALUES_HEADER.size, shape=(1,))
+    except (IOError, OSError, ValueError):
+        return None
+    return OrderedDict((name, table[name][0]) for name in THERMAL_VALUES_HEADER)
+
+
+def write_thermal_values_cache(cache_path, key, table):
+    """
+    Write to a temporary file first, so parallel readers never see half a file
+    :param table: structured array of THERMAL_VALUES_DTYPE
+    :return:
+    """
+    tmp_path = cache_path + '.{}.tmp'.format(os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(VALUES_HEADER.pack(VALUES_MAGIC, table.shape[0], key[0], key[1]))
+            for name in THERMAL_VALUES_HEADER:
+                fh.write(np.ascontiguousarray(table[name]).tobytes())
+        os.replace(tmp_path, cache_path)
+    except (IOError, OSError):
+        # without the cache the csv is parsed again next time
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_thermal_values_columns(csv_path, use_cache=True):
+    """
+    Parse a thermal_values csv once: the typed columns are cached next to it, keyed by the
+    size and mtime of the csv, and memory mapped by every later read
+    :return: OrderedDict column name -> array, the THERMAL_VALUES_HEADER columns
+    """
+    cache_path = thermal_values_cache_path(csv_path)
+    key = csv_key(csv_path)
+    if use_cache:
+        columns = read_thermal_values_cache(cache_path, key)
+        if columns is not None:
+            return columns
+
+    with open(csv_path, 'rb') as fh:
+        table = parse_thermal_values(fh.read().splitlines()[1:])
+    if use_cache:
+        write_thermal_values_cache(cache_path, key, table)
+    return OrderedDict((name, table[name]) for name in THERMAL_VALUES_HEADER)
+
+
+def thermal_classes_path(csv_path):
+    """
+    :return: path of the class sidecar of a thermal_values csv
+    """
+    if csv_path.endswith(THERMAL_VALUES_SUFFIX):
+        return csv_path[:-len(THERMAL_VALUES_SUFFIX)] + THERMAL_CLASSES_SUFFIX
+    return os.path.splitext(csv_path)[0] + THERMAL_CLASSES_SUFFIX
+
+
+def read_thermal_classes(path, digest=None):
+    """
+    :param digest: sha1 of the mask the classes have to come from, None accepts any mask
+    :return: bool array of the thermal size, True for leaves, None if there is no sidecar or it is stale
+    """
+    classes = read_packed_bits(path, CLASSES_MAGIC)
+    if classes is None:
+        return None
+
+    is_leaf, classes_digest = classes
+    if digest is not None and classes_digest != digest:
+        return None
+    return is_leaf
+
+
+def write_thermal_classes(path, is_leaf, digest):
+    """
+    :param is_leaf: bool array of the thermal size, True for leaves
+    :param digest: sha1 of the mask the classes come from
+    :return:
+    """
+    write_packed_bits(path, is_leaf, CLASSES_MAGIC, digest)
+
+
+class ThermalValues:
+    """
+    Typed columns of a thermal_values csv, with the class of each pixel when it has been labelled
+    """
+
+    def __init__(self, columns, is_leaf=None):
+        """
+        :param columns: OrderedDict of the THERMAL_VALUES_HEADER columns, pixels in row major order
+        :param is_leaf: bool array of the same length, None if the pixels have no class
+        """
+        self.columns = columns
+        # float64 array of the Temp(c) column
+        self.temperatures = columns['Temp(c)']
+        self.is_leaf = is_leaf
+
+    pass
+
+
+def load_thermal_values(csv_path, use_cache=True):
+    """
+    Read a thermal_values csv together with its classes: from the _thermal_classes.bits sidecar,
+    else from the Class column older versions appended to the csv
+    :param use_cache: memoize the parsed csv, see read_thermal_values_columns
+    :return: ThermalValues, the rows past the end of the classes are dropped
+    """
+    columns = read_thermal_values_columns(csv_path, use_cache=use_cache)
+    rows = columns['Temp(c)'].shape[0]
+
+    is_leaf = read_thermal_classes(thermal_classes_path(csv_path))
+    if is_leaf is not None:
+        # the sidecar covers the thermal image, pixels in row major order like the csv
+        is_leaf = is_leaf.ravel()
+        rows = min(rows, is_leaf.shape[0])
+        is_leaf = is_leaf[:rows]
+        columns = OrderedDict((name, column[:rows]) for name, column in columns.items())
+    else:
+        is_leaf = read_class_column(csv_path)
+
+    return ThermalValues(columns, is_leaf)
+
+
+def read_class_column(csv_path):
+    """
+    :return: bool array of the Class column older versions appended to the csv, True for leaves, None if it has none
+    """
+    with open(csv_path, 'rb') as fh:
+        header = fh.readline().rstrip()
+        if header.split(b',')[-1] != b'Class':
+            return None
+        rows = fh.read().splitlines()
+
+    leaf = CLASS_NAMES[1].encode('ascii')
+    return np.array([row.rsplit(b',', 1)[1] == leaf for row in rows], dtype=bool)
@@ -17,12 +17,17 @@ import numpy as np
 
 import shutil
 
+from exiftool_pool import ExifToolPool
+
 
 class FlirImageExtractor:
 
-    def __init__(self, exiftool_path="exiftool", is_debug=False):
+    def __init__(self, exiftool_path="exiftool", is_debug=False, exiftool_workers=1):
         self.exiftool_path = exiftool_path
         self.is_debug = is_debug
+        # number of long lived "-stay_open" exiftool processes, 0 spawns exiftool for every image
+        self.exiftool_workers = exiftool_workers
+        self.exiftool_pool = None
         self.is_debug_number_of_images = 0
         self.flir_img_filename = ""
         self.rgb_image_np = None
@@ -62,7 +67,12 @@ class FlirImageExtractor:
         """
         image_tag = "-EmbeddedImage"
 
-        visual_img_bytes = subprocess.check_output([self.exiftool_path, image_tag, "-b", self.flir_img_filename], shell=True)
+        if self.exiftool_workers > 0:
+            if self.exiftool_pool is None:
+                self.exiftool_pool = ExifToolPool(self.exiftool_path, size=self.exiftool_workers, is_debug=self.is_debug)
+            visual_img_bytes = self.exiftool_pool.execute(image_tag, "-b", self.flir_img_filename)
+        else:
+            visual_img_bytes = subprocess.check_output([self.exiftool_path, image_tag, "-b", self.flir_img_filename], shell=True)
         visual_img_stream = io.BytesIO(visual_img_bytes)
 
         visual_img = Image.open(visual_img_stream)
@@ -71,6 +81,16 @@ class FlirImageExtractor:
         return visual_np
 
 
+    def close(self):
+        """
+        Stop the exiftool workers
+        :return:
+        """
+        if self.exiftool_pool is not None:
+            self.exiftool_pool.close()
+            self.exiftool_pool = None
+
+
     def crop_center(self, img, cropx, cropy):
         """
         Crop the image to the given dimensions
@@ -152,12 +172,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract and visualize Flir Image data', formatter_class=SmartFormatter)
     parser.add_argument('-exif', '--exiftool', type=str, help='Custom path to exiftool', required=False,
                         default='exiftool')
+    parser.add_argument('-w', '--exiftool-workers', type=int, help='R|Number of persistent exiftool processes.\n'
+                        '0 starts a new exiftool for every image', required=False, default=1)
     parser.add_argument('-d', '--debug', help='Set the debug flag', required=False,
                         action='store_true')
     parser.add_argument("--crop", type=str2bool, nargs='?', const=True, default=False, help="Crop the visual spectrum images.")
     args = parser.parse_args()
 
-    fie = FlirImageExtractor(exiftool_path=args.exiftool, is_debug=args.debug)
+    fie = FlirImageExtractor(exiftool_path=args.exiftool, is_debug=args.debug, exiftool_workers=args.exiftool_workers)
 
     if not os.path.isdir('./images'):
         raise Exception('Folder with name "images" does not exist.')
@@ -178,5 +200,6 @@ if __name__ == '__main__':
         if args.debug:
             print ("-------------------------------------------------------")
     
+    fie.close()
     print("Total number of images: ",len(image_path_list))
         
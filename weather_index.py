@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import os.path
+import re
+
+import numpy as np
+
+WEATHER_FILE = 'images/weather_data.xlsx'
+WEATHER_INDEX_VERSION = 1
+
+# Lookup modes
+EXACT = 'exact'
+NEAREST = 'nearest'
+INTERPOLATE = 'interpolate'
+LOOKUP_MODES = [EXACT, NEAREST, INTERPOLATE]
+
+
+def parse_float(value):
+    """
+    Float value of a weather cell, numbers are used as they are, text like "33.7 C" is parsed
+    :return: float, or None for empty cells
+    """
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        return float(value)
+    digits = re.findall(r"[-+]?\d*\.\d+|\d+", str(value))
+    if not digits:
+        return None
+    return float(digits[0])
+
+
+def capture_time(image_path):
+    """
+    Date and time of a capture from its path.
+    The date comes from the day folder (images/2019-08-28/Camera_1/img_20190828_121055_010.jpg)
+    or from the file name (images/Radiation_3_img_20200814_140618_019.jpg),
+    the time from the file name
+    :return: (date "YYYY-MM-DD", time "HH:MM:SS"), or None if the path has neither
+    """
+    parts = re.split(r"[\\/]", image_path)
+    match = re.search(r"(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})", parts[-1])
+    if match is None:
+        return None
+
+    date = "{}-{}-{}".format(*match.groups()[:3])
+    for part in parts[:-1]:
+        if re.match(r"^\d{4}-\d{2}-\d{2}$", part):
+            date = part
+            break
+
+    return date, "{}:{}:{}".format(*match.groups()[3:])
+
+
+def to_seconds(date, time):
+    """
+    :return: seconds since the epoch of a "YYYY-MM-DD" date and "HH:MM:SS" time
+    """
+    return int(np.datetime64("{}T{}".format(date, time), 's').astype(np.int64))
+
+
+class WeatherIndex:
+    """
+    Atmospheric temperature and relative humidity of the weather_data.xlsx file,
+    indexed by time.
+
+    The file has three station column groups (DateTime, Temp, RH), they are merged
+    into a single table sorted by time so each lookup is a binary search. Parsing
+    the Excel file is slow, so the table is cached in a .npz sidecar next to it and
+    only parsed again when the xlsx mtime or size changes.
+
+    When a time appears more than once the reading the former row scan ended up
+    with wins: the last row, and in that row the first station.
+    """
+
+    def __init__(self, xlsx_path=WEATHER_FILE, cache_path=None, is_debug=False):
+        """
+        :param xlsx_path: weather file
+        :param cache_path: sidecar file, defaults to <xlsx name>_index.npz
+        """
+        self.xlsx_path = xlsx_path
+        self.cache_path = cache_path
+        if self.cache_path is None:
+            self.cache_path = os.path.splitext(xlsx_path)[0] + '_index.npz'
+        self.is_debug = is_debug
+
+        self.times = np.zeros(0, dtype=np.int64)
+        self.at = np.zeros(0)
+        self.rh = np.zeros(0)
+        self.load()
+
+    pass
+
+    def __len__(self):
+        return self.times.shape[0]
+
+    def load(self):
+        """
+        Load the sidecar if it matches the xlsx, parse the xlsx (and rewrite the sidecar) otherwise
+        :return:
+        """
+        stat = os.stat(self.xlsx_path)
+        if self.load_cache(stat):
+            return
+
+        self.times, self.at, self.rh = WeatherIndex.parse_xlsx(self.xlsx_path)
+        self.save_cache(stat)
+
+        if self.is_debug:
+            print("DEBUG Indexed {} weather readings of {}".format(len(self), self.xlsx_path))
+
+    def load_cache(self, stat):
+        """
+        :param stat: os.stat of the xlsx
+        :return: True if the sidecar was up to date and loaded
+        """
+        if not os.path.isfile(self.cache_path):
+            return False
+
+        try:
+            with np.load(self.cache_path) as cache:
+                if (int(cache['version']) != WEATHER_INDEX_VERSION or float(cache['source_mtime']) != stat.st_mtime or
+                        int(cache['source_size']) != stat.st_size):
+                    return False
+                self.times, self.at, self.rh = cache['times'], cache['at'], cache['rh']
+        except (IOError, ValueError, KeyError):
+            return False
+
+        return True
+
+    def save_cache(self, stat):
+        """
+        Write the sidecar, through a temporary file so an interrupted run keeps the previous one
+        :return:
+        """
+        tmp_path = self.cache_path + '.{}.tmp'.format(os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fh:
+                np.savez(fh, version=WEATHER_INDEX_VERSION, source_mtime=stat.st_mtime, source_size=stat.st_size,
+                         times=self.times, at=self.at, rh=self.rh)
+            if os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            if self.is_debug:
+                print("DEBUG Unable to write the weather index to {}".format(self.cache_path))
+
+    @staticmethod
+    def parse_xlsx(xlsx_path):
+        """
+        Merge the three station column groups of the weather file into one table sorted by time
+        :return: (times in seconds since the epoch, atmospheric temperatures, relative humidities)
+        """
+        import pandas as pd
+
+        dfs = pd.read_excel(xlsx_path, header=None, skiprows=1, keep_default_na=False)
+
+        rows = []
+        for row_number, row in enumerate(dfs.itertuples(index=False)):
+            for station in range(len(row) // 3):
+                date_time, at, rh = row[3 * station:3 * station + 3]
+                date_time = pd.to_datetime(date_time, errors='coerce') if date_time != '' else pd.NaT
+                at = parse_float(at)
+                if date_time is pd.NaT or at is None:
+                    continue
+                rh = parse_float(rh)
+                rows.append((int(np.datetime64(date_time.to_pydatetime(), 's').astype(np.int64)), row_number,
+                             -station, at, np.nan if rh is None else rh))
+
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+
+        table = np.array(rows)
+        times = table[:, 0].astype(np.int64)
+        # sort by time, then row, then station (first station last) and keep the last reading of each time
+        order = np.lexsort((table[:, 2], table[:, 1], times))
+        table, times = table[order], times[order]
+        keep = np.append(times[1:] != times[:-1], True)
+
+        return times[keep], table[keep, 3], table[keep, 4]
+
+    def lookup(self, seconds, mode=EXACT, tolerance=0):
+        """
+        Weather at a given time
+        :param seconds: time in seconds since the epoch
+        :param mode: EXACT, NEAREST reading within tolerance, or INTERPOLATE between the readings around it
+        :param tolerance: maximum distance in seconds to the readings used by NEAREST and INTERPOLATE
+        :return: (atmospheric temperature, relative humidity), or None
+        """
+        if mode not in LOOKUP_MODES:
+            raise ValueError("Unknown weather lookup mode: {}".format(mode))
+
+        n = len(self)
+        i = int(np.searchsorted(self.times, seconds))
+        if i < n and self.times[i] == seconds:
+            return float(self.at[i]), float(self.rh[i])
+        if mode == EXACT:
+            return None
+
+        before = i - 1 if i > 0 and seconds - self.times[i - 1] <= tolerance else None
+        after = i if i < n and self.times[i] - seconds <= tolerance else None
+
+        if mode == INTERPOLATE and before is not None and after is not None:
+            weight = float(seconds - self.times[before]) / float(self.times[after] - self.times[before])
+            return (float(self.at[before] + weight * (self.at[after] - self.at[before])),
+                    float(self.rh[before] + weight * (self.rh[after] - self.rh[before])))
+
+        candidates = [j for j in (before, after) if j is not None]
+        if not candidates:
+            return None
+        nearest = min(candidates, key=lambda j: abs(self.times[j] - seconds))
+        return float(self.at[nearest]), float(self.rh[nearest])
+
+    def lookup_image(self, image_path, mode=EXACT, tolerance=0):
+        """
+        Weather of a capture.
+        EXACT keeps the original matching of the xlsx: the reading at quarter past the hour of the capture,
+        NEAREST and INTERPOLATE use the capture time itself
+        :param image_path: image, or folder of an extracted image
+        :return: (atmospheric temperature, relative humidity), or None
+        """
+        when = capture_time(image_path.rstrip("\\/"))
+        if when is None:
+            return None
+
+        date, time = when
+        if mode == EXACT:
+            time = time[:2] + ":15:00"
+
+        return self.lookup(to_seconds(date, time), mode=mode, tolerance=tolerance)